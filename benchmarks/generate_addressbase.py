@@ -0,0 +1,109 @@
+"""Generates synthetic AddressBase Premium CSV files for benchmarking the importer.
+
+Each UPRN gets a BLPU (21), cross references (23), an LPI (24), a classification (32) and
+sometimes an organisation (31) and a DPA (28), in roughly the proportions of a real delivery.
+The file starts with a header (10) and ends with a trailer (99) like the real thing.
+
+    python -m benchmarks.generate_addressbase /tmp/addressbase --records 1000000
+"""
+
+import argparse
+import csv
+import io
+import os
+import random
+from typing import Iterator, List
+from zipfile import ZipFile, ZIP_DEFLATED
+
+THOROUGHFARES = [
+    'HIGH STREET', 'STATION ROAD', 'MAIN STREET', 'PARK ROAD', 'CHURCH ROAD', 'CHURCH STREET', 'LONDON ROAD',
+    'VICTORIA ROAD', 'GREEN LANE', 'MANOR ROAD', 'CHURCH LANE', 'PARK AVENUE', 'THE AVENUE', 'THE CRESCENT',
+    'QUEENS ROAD', 'NEW ROAD', 'GRANGE ROAD', 'KINGS ROAD', 'KINGSWAY', 'WINDSOR ROAD', 'HIGHFIELD ROAD',
+    'MILL LANE', 'ALEXANDER ROAD', 'YORK ROAD', 'ST. JOHNS ROAD', 'MAIN ROAD', 'BROADWAY', 'KING STREET',
+    'THE GREEN', 'SPRINGFIELD ROAD', 'GEORGE STREET', 'PARK LANE', 'VICTORIA STREET', 'ALBERT ROAD',
+    'QUEENSWAY', 'NEW STREET', 'QUEEN STREET', 'WEST STREET', 'NORTH STREET', 'MANCHESTER ROAD',
+]  # type: List[str]
+BUILDING_NAMES = ['ROSE COTTAGE', 'THE COTTAGE', 'THE OLD RECTORY', 'THE LODGE', 'THE BARN', 'THE COACH HOUSE']
+POST_TOWNS = ['EXETER', 'PLYMOUTH', 'TORQUAY', 'BARNSTAPLE', 'TIVERTON', 'NEWTON ABBOT', 'HONITON', 'CREDITON']
+ORGANISATIONS = ['OVAL INSURANCE', 'MANN EGERTON VOLKSWAGON', 'THE CORNER SHOP', 'DEVON COUNTY COUNCIL']
+
+# average rows of each type per UPRN, taken from the sample file sx9090tail.csv
+XREFS_PER_UPRN = 2.8
+ORGANISATION_CHANCE = 0.22
+DPA_CHANCE = 0.49
+FLAT_CHANCE = 0.1
+ADDRESSES_PER_POSTCODE = 15
+
+
+def _postcode(number: int) -> str:
+    outward = 'EX{}'.format(number % 40 + 1)
+    inward = '{}{}{}'.format(number // 40 % 10, chr(65 + number // 400 % 26), chr(65 + number // 10400 % 26))
+    return '{} {}'.format(outward, inward)
+
+
+def generate_rows(nof_records: int, seed: int = 0) -> Iterator[List[str]]:
+    """Yields about nof_records rows, including the header and trailer"""
+    rng = random.Random(seed)
+    pro_order = 0
+    uprn = 10000000000
+    yield ['10', 'GeoPlace', '9999', '2014-05-19', '1', '2014-05-19', '09:01:38', '1.0', 'F']
+    rows = 1
+    while rows < nof_records - 1:
+        uprn += rng.randint(1, 50)
+        address_number = uprn // 40
+        postcode = _postcode(address_number // ADDRESSES_PER_POSTCODE)
+        thoroughfare = THOROUGHFARES[address_number // ADDRESSES_PER_POSTCODE % len(THOROUGHFARES)]
+        group = []  # type: List[List[str]]
+        group.append(['21', 'I', '', str(uprn), '1', '2', '2009-06-16', '', '{:.2f}'.format(rng.uniform(250000, 330000)),
+                      '{:09.2f}'.format(rng.uniform(50000, 150000)), '1', '1110', '2005-07-07', '', '2013-02-11',
+                      '2005-07-07', 'S', postcode, '0'])
+        for _ in range(int(XREFS_PER_UPRN) + (1 if rng.random() < XREFS_PER_UPRN % 1 else 0)):
+            group.append(['23', 'I', '', str(uprn), '1110X{:09d}'.format(rng.randint(0, 10 ** 9)), str(rng.randint(0, 10 ** 8)),
+                          '', '7666VC', '2005-07-07', '', '2009-06-16', '2005-07-07'])
+        group.append(['24', 'I', '', str(uprn), '1110L{:09d}'.format(rng.randint(0, 10 ** 9)), 'ENG', '1', '2005-07-07',
+                      '', '2009-06-16', '2005-07-07', '', '', '', '', '', '1', '', '', '', '', '14201310', '1', '', '', 'Y'])
+        if rng.random() < ORGANISATION_CHANCE:
+            group.append(['31', 'I', '', str(uprn), '1110O{:09d}'.format(rng.randint(0, 10 ** 9)),
+                          rng.choice(ORGANISATIONS), '', '2005-07-07', '', '2010-11-11', '2005-07-07'])
+        group.append(['32', 'I', '', str(uprn), '1110C{:09d}'.format(rng.randint(0, 10 ** 9)), 'RD04',
+                      'AddressBase Premium Classification Scheme', '1.0', '2005-07-07', '', '2010-11-11', '2005-07-07'])
+        if rng.random() < DPA_CHANCE:
+            is_flat = rng.random() < FLAT_CHANCE
+            group.append([
+                '28', 'I', '', str(uprn), '', str(rng.randint(0, 10 ** 8)),
+                rng.choice(ORGANISATIONS) if rng.random() < ORGANISATION_CHANCE else '', '',
+                'FLAT {}'.format(rng.randint(1, 20)) if is_flat else '',
+                rng.choice(BUILDING_NAMES) if is_flat or rng.random() < 0.1 else '',
+                str(address_number % 200 + 1) if not is_flat else '', '', thoroughfare, '', '',
+                POST_TOWNS[address_number % len(POST_TOWNS)], postcode, 'S', '', '', '', '', '', '',
+                '2014-04-22', '2005-07-07', '', '2009-06-16', '2005-07-07',
+            ])
+        for row in group:
+            pro_order += 1
+            row[2] = str(pro_order)
+            yield row
+        rows += len(group)
+    yield ['99', '0', str(pro_order + 1), '2014-06-07', '09:01:38']
+
+
+def write_zip(path: str, nof_records: int, seed: int = 0) -> str:
+    """Writes a zip holding one CSV file, streaming the rows so any size can be generated"""
+    member_name = os.path.splitext(os.path.basename(path))[0]
+    with ZipFile(path, 'w', ZIP_DEFLATED) as zipfile:
+        with zipfile.open(member_name, 'w', force_zip64=True) as member:
+            with io.TextIOWrapper(member, encoding='utf-8', newline='') as text_file:
+                writer = csv.writer(text_file, quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+                writer.writerows(generate_rows(nof_records, seed))
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates a synthetic AddressBase Premium delivery.')
+    parser.add_argument('directory', help='top level directory to create, laid out like an AddressBase delivery')
+    parser.add_argument('--records', type=int, default=10000, help='number of CSV rows to generate (default: 10000)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    delivery_directory = os.path.join(args.directory, 'synthetic')
+    os.makedirs(delivery_directory, exist_ok=True)
+    print(write_zip(os.path.join(delivery_directory, 'synthetic-{}.csv.zip'.format(args.records)), args.records, args.seed))
@@ -0,0 +1,139 @@
+"""Times each stage of the importer on an AddressBase zip and prints the results as JSON.
+
+The file is read once per pass, each pass doing one more stage than the last, and a stage's
+time is the difference between its pass and the one before:
+
+    scan       grouping the lines by UPRN and parsing the records the import uses (scan_record_groups)
+    actions    building the elasticsearch actions (get_action_dicts)
+    serialise  turning the actions into bulk request bodies, which a stub sink discards
+
+For comparison, csv_reader_rows_per_second is the rate of a pass which only runs csv.reader
+over every line and groups the rows by UPRN, as the importer used to.
+
+    python -m benchmarks.import_benchmark --records 100000
+    python -m benchmarks.import_benchmark --zip /path/to/addressbase.csv.zip
+"""
+
+import argparse
+import csv
+from io import TextIOWrapper
+from itertools import groupby
+import json
+from operator import itemgetter
+import os
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterable
+from zipfile import ZipFile
+
+from elasticsearch.helpers import expand_action  # type: ignore
+from elasticsearch.serializer import JSONSerializer  # type: ignore
+
+from benchmarks.generate_addressbase import write_zip
+from import_addressbase.importing import BULK_CHUNK_SIZE, UPRN, _chunks, get_action_dicts, scan_record_groups
+
+
+class StubBulkSink(object):
+    """Stands in for elasticsearch: serialises bulk bodies the way the client does, then drops them"""
+
+    def __init__(self) -> None:
+        self.serializer = JSONSerializer()
+        self.requests = 0
+        self.bytes = 0
+
+    def _dumps(self, data: Dict[str, Any]) -> bytes:
+        # the body is sent as UTF-8 bytes; newer clients' serializers already return bytes
+        serialised = self.serializer.dumps(data)
+        return serialised if isinstance(serialised, bytes) else serialised.encode('utf-8')
+
+    def send(self, actions: Iterable[Dict[str, Any]]) -> None:
+        for chunk in _chunks(actions, BULK_CHUNK_SIZE):
+            lines = []
+            for action in chunk:
+                action_line, data = expand_action(action)
+                lines.append(self._dumps(action_line))
+                if data is not None:
+                    lines.append(self._dumps(data))
+            body = b'\n'.join(lines) + b'\n'
+            self.requests += 1
+            self.bytes += len(body)
+
+
+def _csv_reader(csv_file) -> int:
+    rows = 0
+    for _, group in groupby(csv.reader(csv_file), itemgetter(UPRN)):
+        rows += len(list(group))
+    return rows
+
+
+def _scan(csv_file) -> int:
+    groups = 0
+    for _ in scan_record_groups(csv_file):
+        groups += 1
+    return groups
+
+
+def _actions(csv_file) -> int:
+    actions = 0
+    for _ in get_action_dicts(csv_file):
+        actions += 1
+    return actions
+
+
+def _serialise(csv_file) -> int:
+    sink = StubBulkSink()
+    sink.send(get_action_dicts(csv_file))
+    return sink.bytes
+
+
+def _time_pass(zip_path: str, run: Callable[[Any], int]) -> Dict[str, float]:
+    with ZipFile(zip_path, 'r') as zipfile:
+        name = zipfile.namelist()[0]
+        with zipfile.open(name) as member, TextIOWrapper(member, encoding='utf-8', newline='') as csv_file:
+            started_at = time.perf_counter()
+            count = run(csv_file)
+            return {'seconds': time.perf_counter() - started_at, 'count': count}
+
+
+def run_benchmark(zip_path: str) -> Dict[str, Any]:
+    passes = [('scan', _scan), ('actions', _actions), ('serialise', _serialise)]
+    pass_results = {name: _time_pass(zip_path, run) for name, run in passes}
+    csv_reader_pass = _time_pass(zip_path, _csv_reader)
+    rows = csv_reader_pass['count']
+
+    stages = {}  # type: Dict[str, Dict[str, float]]
+    previous_seconds = 0.0
+    for name, _ in passes:
+        seconds = max(pass_results[name]['seconds'] - previous_seconds, 0.0)
+        previous_seconds = pass_results[name]['seconds']
+        stages[name] = {'seconds': round(seconds, 4), 'rows_per_second': round(rows / seconds, 1) if seconds else None}
+
+    total_seconds = pass_results['serialise']['seconds']
+    return {
+        'file': os.path.basename(zip_path),
+        'rows': rows,
+        'uprn_groups': pass_results['scan']['count'],
+        'actions': pass_results['actions']['count'],
+        'bulk_bytes': pass_results['serialise']['count'],
+        'total_seconds': round(total_seconds, 4),
+        'rows_per_second': round(rows / total_seconds, 1) if total_seconds else None,
+        'stages': stages,
+        'csv_reader_rows_per_second': round(rows / csv_reader_pass['seconds'], 1) if csv_reader_pass['seconds'] else None,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the stages of an AddressBase import.')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--zip', help='an AddressBase zip file to benchmark')
+    source.add_argument('--records', type=int, default=10000,
+                        help='generate a synthetic file with this many rows (default: 10000)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.zip:
+        print(json.dumps(run_benchmark(args.zip), indent=2, sort_keys=True))
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            zip_path = write_zip(os.path.join(directory, 'synthetic-{}.csv.zip'.format(args.records)), args.records, args.seed)
+            print(json.dumps(run_benchmark(zip_path), indent=2, sort_keys=True))
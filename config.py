@@ -7,10 +7,46 @@ CONFIG_DICT = {
     'LOGGING_CONFIG_FILE_PATH': os.environ['LOGGING_CONFIG_FILE_PATH'],
     'FAULT_LOG_FILE_PATH': os.environ['FAULT_LOG_FILE_PATH'],
     'ELASTIC_SEARCH_ENDPOINT': os.environ['ELASTIC_SEARCH_ENDPOINT'],
+    # searched by the API and written by the importer. After a full reload it is an alias, see index_versions.
+    'ELASTICSEARCH_INDEX_NAME': os.environ.get('ELASTICSEARCH_INDEX_NAME', 'address-search-api-index'),
     'MAX_NUMBER_SEARCH_RESULTS': int(os.environ['MAX_NUMBER_SEARCH_RESULTS']),
     'SEARCH_RESULTS_PER_PAGE': int(os.environ['SEARCH_RESULTS_PER_PAGE']),
     'PORT': int(os.environ['PORT']),
-}  # type: Dict[str, Union[bool, str, int]]
+    # connection pool settings for the long-lived elasticsearch client each worker holds
+    'ELASTICSEARCH_MAX_CONNECTIONS': int(os.environ.get('ELASTICSEARCH_MAX_CONNECTIONS', '10')),
+    'ELASTICSEARCH_TIMEOUT_SECONDS': float(os.environ.get('ELASTICSEARCH_TIMEOUT_SECONDS', '10')),
+    'ELASTICSEARCH_MAX_RETRIES': int(os.environ.get('ELASTICSEARCH_MAX_RETRIES', '3')),
+    'ELASTICSEARCH_RETRY_ON_TIMEOUT': os.environ.get('ELASTICSEARCH_RETRY_ON_TIMEOUT', 'true').lower() == 'true',
+    # per-worker cache of /search results, dropped whenever an import writes a new data generation
+    'SEARCH_CACHE_MAX_ENTRIES': int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', '10000')),
+    'SEARCH_CACHE_TTL_SECONDS': float(os.environ.get('SEARCH_CACHE_TTL_SECONDS', '300')),
+    'DATA_GENERATION_CHECK_SECONDS': float(os.environ.get('DATA_GENERATION_CHECK_SECONDS', '5')),
+    # optional file written by `import.py --postcode-snapshot`; postcode searches are served from it when set
+    'POSTCODE_SNAPSHOT_FILE_PATH': os.environ.get('POSTCODE_SNAPSHOT_FILE_PATH', ''),
+    # /health answers from a check made this often in the background (0 checks on every request), and
+    # reports an error if the last check is older than HEALTH_CHECK_STALE_SECONDS
+    'HEALTH_CHECK_INTERVAL_SECONDS': float(os.environ.get('HEALTH_CHECK_INTERVAL_SECONDS', '5')),
+    'HEALTH_CHECK_STALE_SECONDS': float(os.environ.get('HEALTH_CHECK_STALE_SECONDS', '30')),
+    # POST /search/batch limits: queries per request, and queries per elasticsearch multi-search
+    'MAX_BATCH_SEARCH_QUERIES': int(os.environ.get('MAX_BATCH_SEARCH_QUERIES', '1000')),
+    'MSEARCH_CHUNK_SIZE': int(os.environ.get('MSEARCH_CHUNK_SIZE', '100')),
+    # /suggest returns this many addresses, and gives up on elasticsearch after the timeout
+    'SUGGEST_SIZE': int(os.environ.get('SUGGEST_SIZE', '5')),
+    'SUGGEST_TIMEOUT_SECONDS': float(os.environ.get('SUGGEST_TIMEOUT_SECONDS', '0.5')),
+    # how long clients and CDNs may reuse a /search response without revalidating it. The ETag makes
+    # revalidating cheap, so 0, which makes them revalidate every time, is usually enough.
+    'SEARCH_RESPONSE_MAX_AGE_SECONDS': int(os.environ.get('SEARCH_RESPONSE_MAX_AGE_SECONDS', '0')),
+    # the largest radius a /search?near= request may ask for, as a national-scale circle would match millions
+    'MAX_NEAR_RADIUS_METRES': float(os.environ.get('MAX_NEAR_RADIUS_METRES', '1000')),
+    # where each worker keeps its timing histograms, so /metrics can report all of them. Emptied when gunicorn
+    # starts; when not set /metrics only reports the worker that answers it.
+    'METRICS_DIRECTORY': os.environ.get('METRICS_DIRECTORY', ''),
+    # searches taking at least this long are logged with their elasticsearch queries (0 turns this off)
+    'SLOW_QUERY_LOG_THRESHOLD_MS': float(os.environ.get('SLOW_QUERY_LOG_THRESHOLD_MS', '1000')),
+    # 'elasticsearch', or 'sqlite' to serve from the file written by `import.py --sqlite-database`
+    'SEARCH_BACKEND': os.environ.get('SEARCH_BACKEND', 'elasticsearch'),
+    'SQLITE_DATABASE_FILE_PATH': os.environ.get('SQLITE_DATABASE_FILE_PATH', ''),
+}  # type: Dict[str, Union[bool, str, int, float]]
 
 settings = os.environ.get('SETTINGS')
 
@@ -21,3 +57,5 @@ elif settings == 'test':
     CONFIG_DICT['DEBUG'] = True
     CONFIG_DICT['TESTING'] = True
     CONFIG_DICT['FAULT_LOG_FILE_PATH'] = '/dev/null'
+    CONFIG_DICT['SEARCH_CACHE_MAX_ENTRIES'] = 0
+    CONFIG_DICT['HEALTH_CHECK_INTERVAL_SECONDS'] = 0
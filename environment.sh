@@ -3,7 +3,28 @@ export SETTINGS='dev'
 export LOGGING_CONFIG_FILE_PATH='logging_config.json'
 export FAULT_LOG_FILE_PATH='/var/log/applications/address-search-api-fault.log'
 export ELASTIC_SEARCH_ENDPOINT='http://localhost:9200'
+export ELASTICSEARCH_INDEX_NAME='address-search-api-index'
 export MAX_NUMBER_SEARCH_RESULTS=50
 export PYTHONPATH=.
 export SEARCH_RESULTS_PER_PAGE=20
 export PORT='8002'
+export ELASTICSEARCH_MAX_CONNECTIONS=10
+export ELASTICSEARCH_TIMEOUT_SECONDS=10
+export ELASTICSEARCH_MAX_RETRIES=3
+export ELASTICSEARCH_RETRY_ON_TIMEOUT='true'
+export SEARCH_CACHE_MAX_ENTRIES=10000
+export SEARCH_CACHE_TTL_SECONDS=300
+export DATA_GENERATION_CHECK_SECONDS=5
+export POSTCODE_SNAPSHOT_FILE_PATH=''
+export HEALTH_CHECK_INTERVAL_SECONDS=5
+export HEALTH_CHECK_STALE_SECONDS=30
+export MAX_BATCH_SEARCH_QUERIES=1000
+export MSEARCH_CHUNK_SIZE=100
+export SUGGEST_SIZE=5
+export SUGGEST_TIMEOUT_SECONDS=0.5
+export SEARCH_RESPONSE_MAX_AGE_SECONDS=0
+export MAX_NEAR_RADIUS_METRES=1000
+export METRICS_DIRECTORY=''
+export SLOW_QUERY_LOG_THRESHOLD_MS=1000
+export SEARCH_BACKEND='elasticsearch'
+export SQLITE_DATABASE_FILE_PATH=''
@@ -0,0 +1,18 @@
+# gevent has to patch the standard library before anything else imports it. The worker would only
+# patch it after post_fork has imported the service, leaving the thread-locals made on import, such as
+# the request timings in service.metrics, shared by every greenlet in the worker.
+from gevent import monkey
+monkey.patch_all()
+
+import os  # noqa: E402
+
+# Each async worker can have hundreds of searches waiting on elasticsearch at once, so it needs
+# a bigger connection pool than a sync worker. This must be set before config is imported.
+os.environ.setdefault('ELASTICSEARCH_MAX_CONNECTIONS', os.environ.get('GUNICORN_WORKER_CONNECTIONS', '200'))
+
+from gunicorn_settings import on_starting, on_reload, when_ready, on_exit, post_fork  # noqa: E402,F401
+
+# with the socket module patched, the elasticsearch client's urllib3 connections yield to other
+# requests instead of blocking the worker while they wait
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '200'))
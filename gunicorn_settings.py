@@ -9,6 +9,10 @@ LOGGER = logging.getLogger(__name__)
 
 def on_starting(server):
     LOGGER.info('Starting the server')
+    # the metrics files of the last run's workers would otherwise be added to this run's
+    from config import CONFIG_DICT
+    from service.metrics import clear_metrics_directory
+    clear_metrics_directory(CONFIG_DICT['METRICS_DIRECTORY'])
 
 
 def on_reload(server):
@@ -21,3 +25,10 @@ def when_ready(server):
 
 def on_exit(server):
     LOGGER.info('Stopping the server')
+
+
+def post_fork(server, worker):
+    # each worker gets its own pooled elasticsearch client; sockets must not be shared across a fork
+    from service import es_access
+    es_access.init_client()
+    LOGGER.info('Created elasticsearch client for worker {}'.format(worker.pid))
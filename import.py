@@ -1,13 +1,112 @@
 import argparse  # type: ignore
 
 from config import CONFIG_DICT
-from import_addressbase import import_csv
-from zipfile import ZipFile  # type: ignore
-import argparse  # type: ignore
+from elasticsearch import Elasticsearch  # type: ignore
+from import_addressbase import (
+    delete_legacy_types, load_csv, load_failed, migrate_to_single_type, prepare_index, write_data_generation,
+    PostcodeSnapshotBuilder,
+)
+from import_addressbase.checkpoints import ImportCheckpoints
+from import_addressbase.index_versions import (
+    create_bulk_load_index, finish_bulk_load, prune_versions, switch_alias,
+)
+from import_addressbase.joining import load_joined
+from import_addressbase.sqlite_index import SqliteIndexWriter
+from zipfile import ZipFile, ZipInfo  # type: ignore
+import logging
+from multiprocessing import Pool
 import os  # type: ignore
-from io import StringIO  # type: ignore
+from io import TextIOWrapper  # type: ignore
+import resource  # type: ignore
+from typing import Any, Callable, Dict, Iterator, List, Optional, TextIO, Tuple
 
 ELASTICSEARCH_ENDPOINT = str(CONFIG_DICT['ELASTIC_SEARCH_ENDPOINT'])
+# the index, or with --full-reload the alias, that the API searches
+INDEX_NAME = str(CONFIG_DICT['ELASTICSEARCH_INDEX_NAME'])
+
+LOGGER = logging.getLogger(__name__)
+
+# set in each worker process by _init_worker
+_worker_client = None
+_worker_bulk_threads = 1
+_worker_checkpoints = None
+_worker_index_name = INDEX_NAME
+
+
+def _peak_rss_kb() -> int:
+    """The most memory the process has had resident at any time since it started"""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _rss_kb() -> Optional[int]:
+    """The memory the process has resident now, or None where /proc isn't available"""
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * resource.getpagesize() // 1024
+
+
+def _make_client(bulk_threads: int):
+    # one connection per bulk sender thread
+    return Elasticsearch([ELASTICSEARCH_ENDPOINT], maxsize=max(bulk_threads, 1))
+
+
+def _checkpoint_key(zip_path: str, info: ZipInfo) -> str:
+    # the CRC and size tell a file apart from a different one with the same name
+    return '{}:{}:{:08x}:{}'.format(os.path.abspath(zip_path), info.filename, info.CRC, info.file_size)
+
+
+def import_zip_file(zip_path: str, load: Callable[..., Dict[str, Any]],
+                    checkpoints: ImportCheckpoints = None) -> List[Dict[str, Any]]:
+    """Calls load(csv_file, name) for each CSV file in the zip and returns the import summaries.
+    With checkpoints, files that have already been imported are skipped and load is also given
+    the file's checkpoint, as load(csv_file, name, checkpoint=checkpoint).
+    """
+    summaries = []
+    with ZipFile(zip_path, 'r') as zipfile:
+        # The zip file may have mulitple files in it (it shouldn't but could have) so loop over them
+        for info in zipfile.infolist():
+            name = info.filename
+            kwargs = {}  # type: Dict[str, Any]
+            if checkpoints is not None:
+                checkpoint = checkpoints.for_file(_checkpoint_key(zip_path, info))
+                if checkpoint.completed:
+                    LOGGER.info('Skipping {} from {}, it has already been imported'.format(name, zip_path))
+                    continue
+                kwargs['checkpoint'] = checkpoint
+            # Decode the member as it is read rather than unzipping it into memory first, so memory
+            # use doesn't grow with the size of the file. newline='' is what the csv module expects.
+            with zipfile.open(info) as member, TextIOWrapper(member, encoding='utf-8', newline='') as csv_file:
+                summaries.append(load(csv_file, name, **kwargs))
+            LOGGER.info('Imported {} from {}, RSS {} KB, peak RSS since the import started {} KB'.format(
+                name, zip_path, _rss_kb(), _peak_rss_kb()))
+    return summaries
+
+
+def open_csv_files(zip_paths: List[str]) -> Iterator[Tuple[str, TextIO]]:
+    """Yields (name, csv_file) for each CSV file in the zips, one open at a time"""
+    for zip_path in zip_paths:
+        with ZipFile(zip_path, 'r') as zipfile:
+            for name in zipfile.namelist():
+                with zipfile.open(name) as member, TextIOWrapper(member, encoding='utf-8', newline='') as csv_file:
+                    yield name, csv_file
+
+
+def _init_worker(bulk_threads: int, checkpoint_dir: str = None, index_name: str = INDEX_NAME) -> None:
+    global _worker_client, _worker_bulk_threads, _worker_checkpoints, _worker_index_name
+    _worker_client = _make_client(bulk_threads)
+    _worker_bulk_threads = bulk_threads
+    _worker_checkpoints = ImportCheckpoints(checkpoint_dir) if checkpoint_dir else None
+    _worker_index_name = index_name
+
+
+def _import_zip_file_in_worker(zip_path: str) -> List[Dict[str, Any]]:
+    return import_zip_file(zip_path, lambda csv_file, name, **kwargs: load_csv(
+        _worker_client, csv_file, None, name, _worker_bulk_threads, index_name=_worker_index_name, **kwargs),
+        _worker_checkpoints)
 
 
 # Method to read from a 2 level directory and grab multiple zip files
@@ -18,7 +117,7 @@ ELASTICSEARCH_ENDPOINT = str(CONFIG_DICT['ELASTIC_SEARCH_ENDPOINT'])
 # --------------------addressbase_file.csv-2014.zip
 # ----------------directory3
 # --------------------addressbase_file.csv-2013.zip
-def handle_zip_files_in_folder(path):
+def find_zip_files(path: str) -> Iterator[str]:
     # This will iterate over 2 levels of folder structure looking for multiple zip files
     for dir_entry in os.listdir(path):
         dir_entry_path = os.path.join(path, dir_entry)
@@ -27,18 +126,138 @@ def handle_zip_files_in_folder(path):
                 inner_dir_entry_path = os.path.join(dir_entry_path, inner_dir_entry)
                 # we only care about Address Base zip files so ignore everything else
                 if os.path.isfile(inner_dir_entry_path) and os.path.splitext(inner_dir_entry_path)[-1].lower() == ".zip":
-                    zipfile = ZipFile(inner_dir_entry_path, 'r')
-                    # The zip file may have mulitple files in it (it shouldn't but could have) so loop over them
-                    for name in zipfile.namelist():
-                        # unzip the file, make sure it's in utf-8 format
-                        data_file = (zipfile.open(name).read()).decode("utf-8")
-                        # Then call the main import program with a StringIO file rather than a plain String.
-                        import_csv(StringIO(data_file), [ELASTICSEARCH_ENDPOINT])
+                    yield inner_dir_entry_path
 
 
-if __name__ == '__main__':
+def handle_zip_files_in_folder(path: str, snapshot_path: str = None, workers: int = 1, bulk_threads: int = 1,
+                               checkpoint_dir: str = None, join_memory_mb: int = None, full_reload: bool = False,
+                               replace_unaliased_index: bool = False) -> None:
+    """Imports every zip file in the folder. The index is set up once, then the files are either
+    imported one by one or, with more than one worker, shared out between worker processes.
+    With a checkpoint directory, an interrupted import picks up where it stopped when run again.
+    With a join memory budget, DPAs are joined to BLPUs across all the files instead of file by file.
+    A full reload loads a new version of the index and then switches the search alias over to it,
+    unless loading any of the files failed.
+    """
+    client = _make_client(bulk_threads)
+    if full_reload:
+        index_name = create_bulk_load_index(client, INDEX_NAME)
+    else:
+        index_name = INDEX_NAME
+        prepare_index(client, index_name)
+    zip_paths = list(find_zip_files(path))
+
+    snapshot_builder = PostcodeSnapshotBuilder() if snapshot_path else None
+    checkpoints = ImportCheckpoints(checkpoint_dir) if checkpoint_dir else None
+    summaries = []  # type: List[Dict[str, Any]]
+    if join_memory_mb:
+        summaries.append(load_joined(client, lambda: open_csv_files(zip_paths), join_memory_mb * 1024 * 1024,
+                                     snapshot_builder, bulk_threads, index_name=index_name))
+    elif workers > 1:
+        with Pool(workers, initializer=_init_worker, initargs=(bulk_threads, checkpoint_dir, index_name)) as pool:
+            for zip_summaries in pool.imap_unordered(_import_zip_file_in_worker, zip_paths):
+                summaries += zip_summaries
+    else:
+        for zip_path in zip_paths:
+            summaries += import_zip_file(zip_path, lambda csv_file, name, **kwargs: load_csv(
+                client, csv_file, snapshot_builder, name, bulk_threads, index_name=index_name, **kwargs), checkpoints)
+
+    failed = [summary['file'] for summary in summaries if load_failed(summary)]
+    if failed and full_reload:
+        # deleted, so that it can't be mistaken for a previous version to roll back to
+        client.indices.delete(index=index_name)
+        raise RuntimeError('Loading {} failed, so the search alias has not been switched to {}, which has been '
+                           'deleted'.format(', '.join(failed), index_name))
+    if failed:
+        LOGGER.error('Loading {} failed'.format(', '.join(failed)))
+
+    if snapshot_builder is not None:
+        snapshot_builder.write(snapshot_path)
+    if full_reload:
+        finish_bulk_load(client, index_name, INDEX_NAME)
+    # a new generation makes the API workers drop the search results they have cached
+    write_data_generation(client, index_name)
+    if full_reload:
+        switch_alias(client, index_name, INDEX_NAME, replace_unaliased_index)
+        prune_versions(client, INDEX_NAME)
+
+
+def handle_zip_files_in_folder_for_sqlite(path: str, sqlite_path: str) -> None:
+    """Imports every zip file in the folder into a SQLite index instead of elasticsearch"""
+    writer = SqliteIndexWriter(sqlite_path)
+    try:
+        for zip_path in find_zip_files(path):
+            import_zip_file(zip_path, writer.load_csv)
+        writer.write_data_generation()
+    finally:
+        writer.close()
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    """Parses the command line, exiting with usage if the options can't be used together"""
     parser = argparse.ArgumentParser(description='Imports AddressBase CSV files into elasticsearch.')
-    parser.add_argument('directory', help='AddressBase CSV filename')
-    args = parser.parse_args()
+    parser.add_argument('directory', nargs='?', help='AddressBase CSV filename')
+    parser.add_argument('--postcode-snapshot', help='also write a postcode snapshot file for the API to serve from '
+                                                    '(use with a full load, not a change only update)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to import zip files with (default: 1). Files are imported '
+                             'in no particular order, so only use more than one for a full load')
+    parser.add_argument('--bulk-threads', type=int, default=1,
+                        help='number of threads sending bulk requests for each file (default: 1)')
+    parser.add_argument('--sqlite-database',
+                        help='import into this SQLite file, for the sqlite search backend, instead of elasticsearch')
+    parser.add_argument('--checkpoint-dir',
+                        help='record progress in this directory so that an interrupted import resumes where it '
+                             'stopped when run again with the same directory')
+    parser.add_argument('--join-across-files', action='store_true',
+                        help='join each DPA to its BLPU wherever it is in the files, rather than only when the two '
+                             'are next to each other. The files are read twice')
+    parser.add_argument('--join-memory-mb', type=int, default=256,
+                        help='memory for BLPU coordinates when joining across files, beyond which they are '
+                             'partitioned on disk (default: 256)')
+    parser.add_argument('--full-reload', action='store_true',
+                        help='load a new version of the index, then switch the search alias over to it. Searches '
+                             'carry on against the current version until the switch')
+    parser.add_argument('--replace-unaliased-index', action='store_true',
+                        help='with --full-reload, delete the index if it is not yet an alias, so the alias can '
+                             'be created. Only needed for the first full reload')
+    parser.add_argument('--rollback-to', metavar='INDEX',
+                        help='switch the search alias back to this earlier version of the index, then exit')
+    parser.add_argument('--migrate-to-single-type', action='store_true',
+                        help='copy addresses indexed by an earlier version into the single address type, then exit. '
+                             'The earlier types are kept for the API to search until it is upgraded')
+    parser.add_argument('--delete-legacy-types', action='store_true',
+                        help='delete the addresses indexed by an earlier version, once the upgraded API is deployed, '
+                             'then exit')
+    args = parser.parse_args(argv)
+    if not (args.directory or args.migrate_to_single_type or args.delete_legacy_types or args.rollback_to):
+        parser.error('a directory is required')
+    if args.postcode_snapshot and args.workers > 1:
+        parser.error('--postcode-snapshot can only be used with a single worker')
+    if args.sqlite_database and (args.workers > 1 or args.postcode_snapshot):
+        parser.error('--sqlite-database can only be used with a single worker and no postcode snapshot')
+    if args.checkpoint_dir and (args.postcode_snapshot or args.sqlite_database):
+        parser.error('--checkpoint-dir cannot be used with --postcode-snapshot or --sqlite-database')
+    if args.join_across_files and (args.workers > 1 or args.checkpoint_dir or args.sqlite_database):
+        parser.error('--join-across-files can only be used with a single worker, no checkpoints and elasticsearch')
+    if args.full_reload and (args.checkpoint_dir or args.sqlite_database):
+        parser.error('--full-reload cannot be used with --checkpoint-dir or --sqlite-database')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
 
-    handle_zip_files_in_folder(args.directory)
+    if args.rollback_to:
+        switch_alias(_make_client(args.bulk_threads), args.rollback_to, INDEX_NAME)
+    elif args.migrate_to_single_type:
+        migrate_to_single_type(_make_client(args.bulk_threads), INDEX_NAME)
+    elif args.delete_legacy_types:
+        delete_legacy_types(_make_client(args.bulk_threads), INDEX_NAME)
+    elif args.sqlite_database:
+        handle_zip_files_in_folder_for_sqlite(args.directory, args.sqlite_database)
+    else:
+        handle_zip_files_in_folder(args.directory, args.postcode_snapshot, args.workers, args.bulk_threads,
+                                   args.checkpoint_dir, args.join_memory_mb if args.join_across_files else None,
+                                   args.full_reload, args.replace_unaliased_index)
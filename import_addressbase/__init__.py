@@ -1 +1,5 @@
-from import_addressbase.importing import import_csv, make_es_actions, make_es_mappings
+from import_addressbase.importing import (
+    delete_legacy_types, import_csv, load_csv, load_failed, make_es_actions, make_es_mappings, migrate_to_single_type,
+    prepare_index, write_data_generation,
+)
+from import_addressbase.postcode_snapshot import PostcodeSnapshot, PostcodeSnapshotBuilder
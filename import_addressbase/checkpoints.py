@@ -0,0 +1,68 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FileCheckpoint(object):
+    """How far the import of one file has got, kept in its own JSON file so that parallel
+    workers never write to the same one. rows_done always ends at a UPRN group boundary.
+    """
+
+    def __init__(self, path: str, file_key: str) -> None:
+        self.path = path
+        self.file_key = file_key
+        self.rows_done = 0
+        self.batches = 0
+        self.completed = False
+        if os.path.isfile(path):
+            with open(path, 'rt') as file:
+                saved = json.load(file)
+            # a checkpoint for a different file with the same name is no use
+            if saved.get('file') == file_key:
+                self.rows_done = saved['rows_done']
+                self.batches = saved['batches']
+                self.completed = saved['completed']
+
+    def save(self, rows_done: int) -> None:
+        self.rows_done = rows_done
+        self.batches += 1
+        self._write()
+
+    def complete(self) -> None:
+        self.completed = True
+        self._write()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'file': self.file_key,
+            'rows_done': self.rows_done,
+            'batches': self.batches,
+            'completed': self.completed,
+            'updated': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        }
+
+    def _write(self) -> None:
+        # written to a temporary file and renamed, so a crash never leaves a half written checkpoint
+        temp_path = '{}.tmp'.format(self.path)
+        with open(temp_path, 'wt') as file:
+            json.dump(self.to_dict(), file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+
+class ImportCheckpoints(object):
+    """A directory of FileCheckpoints, one per imported file"""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def for_file(self, file_key: str) -> FileCheckpoint:
+        file_name = '{}.json'.format(hashlib.sha1(file_key.encode('utf-8')).hexdigest())
+        return FileCheckpoint(os.path.join(self.directory, file_name), file_key)
@@ -1,22 +1,34 @@
 #!/usr/bin/env python
 
-from betterprint import pprint                  # type: ignore
-from copy import deepcopy                       # type: ignore
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import csv                                      # type: ignore
+from datetime import datetime
 from elasticsearch import Elasticsearch         # type: ignore
 from elasticsearch.client import IndicesClient  # type: ignore
-from elasticsearch.helpers import bulk          # type: ignore
-from itertools import groupby
+from elasticsearch.helpers import bulk, scan, streaming_bulk  # type: ignore
+from itertools import islice
 import logging
 import logging.config  # type: ignore
 from operator import itemgetter  # type: ignore
-from typing import Dict, Iterator, List, Union
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
 
+from config import CONFIG_DICT
+from import_addressbase.checkpoints import FileCheckpoint
+from import_addressbase.national_grid import to_latitude_longitude
+from import_addressbase.progress import ImportProgress
 from record_types import Header, BLPU, DPA
 
 LOGGER = logging.getLogger(__name__)
 
-INDEX_NAME = 'address-search-api-index'
+# the index, or after a full reload the alias (see index_versions), that the API searches
+INDEX_NAME = str(CONFIG_DICT['ELASTICSEARCH_INDEX_NAME'])
+# the API drops its cached search results whenever this document changes
+DATA_GENERATION_DOC_TYPE = 'data_generation'
+DATA_GENERATION_DOC_ID = 'current'
+
+# number of actions sent in each bulk request
+BULK_CHUNK_SIZE = 500
 
 HEADER_ID = 10  # Header record                (contains entry date)
 BLPU_ID = 21    # Basic Land and Property Unit (contains coordinates)
@@ -29,6 +41,16 @@ CHANGE_TYPE = 1
 CHANGE_TYPE_CODE = 2
 UPRN = 3
 
+# the BLPU columns make_es_actions uses
+BLPU_X_COORDINATE = BLPU._fields.index('x_coordinate')
+BLPU_Y_COORDINATE = BLPU._fields.index('y_coordinate')
+
+# lines are told apart by these prefixes before they are parsed
+HEADER_PREFIX = '{},'.format(HEADER_ID)
+BLPU_PREFIX = '{},'.format(BLPU_ID)
+DPA_PREFIX = '{},'.format(DPA_ID)
+PARSED_PREFIXES = frozenset([HEADER_PREFIX, BLPU_PREFIX, DPA_PREFIX])
+
 # change_type values
 INSERT = 'I'
 UPDATE = 'U'
@@ -39,14 +61,57 @@ ADDRESS_KEY_FIELDS = [
     'thoroughfare_name', 'double_dependent_locality', 'dependent_locality', 'post_town', 'postcode',
 ]  # type: List[str]
 
-TYPE_TO_INDEX_MAPPING = {
-    'address_by_joined_fields': 'joined_fields',
-    'address_by_postcode': 'postcode',
-}  # type: Dict[str, str]
+# the order postcode search results are returned in, see service.es_access.get_addresses_for_postcode
+POSTCODE_SORT_FIELDS = [
+    'thoroughfare_name', 'dependent_thoroughfare_name', 'building_number', 'building_name', 'sub_building_name',
+]  # type: List[str]
+# and the order phrase search results are returned in
+PHRASE_SORT_FIELDS = [
+    'sub_building_name', 'building_name', 'building_number', 'dependent_thoroughfare_name', 'thoroughfare_name',
+]  # type: List[str]
+NUMERIC_SORT_FIELDS = ['building_number']  # type: List[str]
+# Each address has a key for each order, worked out by make_sort_key_string, so that elasticsearch
+# sorts on one doc_values field rather than loading all five fields into the heap and comparing them
+POSTCODE_SORT_KEY_FIELD = 'postcode_sort_key'
+PHRASE_SORT_KEY_FIELD = 'phrase_sort_key'
+# ends each string value in a sort key. It sorts before any character of an address, so a value sorts
+# before longer values starting with it, as it does on its own.
+SORT_KEY_SEPARATOR = '\x01'
+# numbers are zero-padded to the width of the largest elasticsearch integer, so they sort as strings
+SORT_KEY_NUMBER_WIDTH = 10
+
+# the DPA columns make_es_actions uses, which is all the scanner keeps of a DPA
+DPA_ADDRESS_FIELDS = [
+    'change_type', 'uprn', 'organisation_name', 'department_name', 'sub_building_name', 'building_name',
+    'building_number', 'dependent_thoroughfare_name', 'thoroughfare_name', 'double_dependent_locality',
+    'dependent_locality', 'post_town', 'postcode',
+]  # type: List[str]
+DpaAddress = namedtuple('DpaAddress', DPA_ADDRESS_FIELDS)
+_dpa_address_columns = itemgetter(*[DPA._fields.index(field) for field in DPA_ADDRESS_FIELDS])
+# all make_es_actions needs of a BLPU
+Coordinates = namedtuple('Coordinates', ['x_coordinate', 'y_coordinate'])
+# consecutive lines with the same UPRN, see scan_record_groups
+RecordGroup = namedtuple('RecordGroup', ['rows', 'header', 'blpus', 'dpas'])
+
+# a completion field, which elasticsearch keeps as an in-memory prefix structure for /suggest.
+# It is only for elasticsearch, so the postcode snapshot and SQLite index leave it out.
+SUGGEST_FIELD = 'suggest'
+# a geo_point of the BLPU's position for searches near a point, null for addresses without coordinates.
+# It is also only for elasticsearch: the SQLite index searches the x and y coordinates instead.
+LOCATION_FIELD = 'location'
+# The sort keys are too: the postcode snapshot and the SQLite index order by the fields themselves.
+ELASTICSEARCH_ONLY_FIELDS = [
+    SUGGEST_FIELD, LOCATION_FIELD, POSTCODE_SORT_KEY_FIELD, PHRASE_SORT_KEY_FIELD,
+]  # type: List[str]
+
+# every address is indexed once, as this type, for both postcode and phrase searches
+ADDRESS_DOC_TYPE = 'address'
+# earlier versions indexed each address twice, once per type. See migrate_to_single_type.
+LEGACY_DOC_TYPES = ['address_by_joined_fields', 'address_by_postcode']  # type: List[str]
 
 
-def make_es_mappings(client) -> None:
-    no_index_properties = {
+def make_es_mappings(client, index_name: str = INDEX_NAME) -> None:
+    properties = {
         'uprn': {'type': 'string', 'index': 'no'},
         'organisation_name': {'type': 'string', 'index': 'no'},
         'department_name': {'type': 'string', 'index': 'no'},
@@ -58,27 +123,74 @@ def make_es_mappings(client) -> None:
         'double_dependent_locality': {'type': 'string', 'index': 'no'},
         'dependent_locality': {'type': 'string', 'index': 'no'},
         'post_town': {'type': 'string', 'index': 'no'},
-        'postcode': {'type': 'string', 'index': 'no'},
+        # postcode searches are exact, phrase searches are not
+        'postcode': {'type': 'string', 'index': 'not_analyzed'},
         'x_coordinate': {'type': 'float', 'index': 'no'},
         'y_coordinate': {'type': 'float', 'index': 'no'},
-        'joined_fields': {'type': 'string', 'index': 'no'},
+        'joined_fields': {'type': 'string', 'index': 'analyzed'},
         'entry_datetime': {'type': 'date', 'format': 'date_time_no_millis', 'index': 'no'},
-    }  # type: Dict[str, Dict[str, str]]
+        # the standard analyzer, unlike the completion default, keeps building numbers
+        SUGGEST_FIELD: {'type': 'completion', 'analyzer': 'standard', 'payloads': True},
+        # lat_lon also indexes the latitude and longitude as numbers, which geo_distance filters
+        # with optimize_bbox 'indexed' use to narrow the candidates to a bounding box first
+        LOCATION_FIELD: {'type': 'geo_point', 'lat_lon': True},
+        # doc_values keeps the sort keys on disk rather than in the heap
+        POSTCODE_SORT_KEY_FIELD: {'type': 'string', 'index': 'not_analyzed', 'doc_values': True},
+        PHRASE_SORT_KEY_FIELD: {'type': 'string', 'index': 'not_analyzed', 'doc_values': True},
+    }  # type: Dict[str, Dict[str, Any]]
+
+    mapping = {ADDRESS_DOC_TYPE: {'properties': properties}}
+    IndicesClient(client).put_mapping(index=index_name, doc_type=ADDRESS_DOC_TYPE, body=mapping)
+
+
+def make_sort_key(doc: Dict[str, Union[str, float]], fields: List[str]) -> Tuple:
+    """Builds a key which orders documents the way elasticsearch sorts them on the given fields
+    with 'missing': '_last'. Absent and null fields are missing. So is an empty number, which
+    elasticsearch indexes as null, but an empty string is a value and sorts before the others.
+    """
+    key = []  # type: List[Tuple]
+    for field in fields:
+        value = doc.get(field)
+        if field in NUMERIC_SORT_FIELDS:
+            key.append((0, int(value)) if value not in (None, '') else (1, 0))
+        else:
+            key.append((0, value) if value is not None else (1, ''))
+    return tuple(key)
 
-    def make_es_mapping(doc_type: str, index_field: str) -> Dict[str, Dict[str, Dict[str, Dict[str, str]]]]:
-        mapping = {doc_type: {'properties': deepcopy(no_index_properties)}}  # type: Dict[str, Dict[str, Dict[str, Dict[str, str]]]]
-        # postcode searches are exact, anything else is not
-        mapping[doc_type]['properties'][index_field]['index'] = 'not_analyzed' if index_field == 'postcode' else 'analyzed'
-        return mapping
 
-    mapping_tuples = [(doc_type, make_es_mapping(doc_type, index_field)) for doc_type, index_field in TYPE_TO_INDEX_MAPPING.items()]
-    for doc_type, mapping in mapping_tuples:
-        IndicesClient(client).put_mapping(index=INDEX_NAME, doc_type=doc_type, body=mapping)
+def make_sort_key_string(doc: Dict[str, Union[str, float]], fields: List[str]) -> str:
+    """make_sort_key as a single string which sorts in the same order"""
+    parts = []  # type: List[str]
+    for field, (missing, value) in zip(fields, make_sort_key(doc, fields)):
+        if missing:
+            parts.append('1')
+        elif field in NUMERIC_SORT_FIELDS:
+            parts.append('0' + str(value).zfill(SORT_KEY_NUMBER_WIDTH))
+        else:
+            parts.append('0' + value + SORT_KEY_SEPARATOR)
+    return ''.join(parts)
+
+
+def make_suggest(uprn: str, key_values: List[str], joined_fields: str) -> Dict[str, Any]:
+    """The completion field value for an address. Typing the start of any part of the address from the
+    building onwards, such as the street or the postcode, suggests it.
+    """
+    inputs = [', '.join(key_values[start:]) for start in range(len(key_values))]
+    return {'input': inputs, 'output': joined_fields, 'payload': {'uprn': uprn}}
+
+
+def make_location(x_coordinate: float, y_coordinate: float) -> Union[Dict[str, float], None]:
+    """The geo_point value for National Grid coordinates. AddressBase has 0,0 for an unknown position."""
+    if not x_coordinate and not y_coordinate:
+        return None
+    latitude, longitude = to_latitude_longitude(x_coordinate, y_coordinate)
+    return {'lat': latitude, 'lon': longitude}
 
 
 def make_es_actions(dpa: DPA, blpu: BLPU, entry_datetime: str) -> List[Dict[str, Union[str, Dict[str, Union[str, float]]]]]:
-    dpa_dict = vars(dpa)
-    joined_fields = ', '.join([dpa_dict[f] for f in ADDRESS_KEY_FIELDS if dpa_dict[f]])
+    dpa_dict = dpa._asdict()
+    key_values = [dpa_dict[f] for f in ADDRESS_KEY_FIELDS if dpa_dict[f]]
+    joined_fields = ', '.join(key_values)
     x_coord = 0.0
     y_coord = 0.0
     if blpu:
@@ -101,71 +213,261 @@ def make_es_actions(dpa: DPA, blpu: BLPU, entry_datetime: str) -> List[Dict[str,
         'x_coordinate': x_coord,
         'y_coordinate': y_coord,
         'entry_datetime': entry_datetime,
-    }  # type: Dict[str, Union[str, float]]
+        SUGGEST_FIELD: make_suggest(dpa.uprn, key_values, joined_fields),
+        LOCATION_FIELD: make_location(x_coord, y_coord),
+    }  # type: Dict[str, Any]
+    doc[POSTCODE_SORT_KEY_FIELD] = make_sort_key_string(doc, POSTCODE_SORT_FIELDS)
+    doc[PHRASE_SORT_KEY_FIELD] = make_sort_key_string(doc, PHRASE_SORT_FIELDS)
+
+    action_dict_cases = {
+        INSERT: {'_op_type': 'index', '_index': INDEX_NAME, '_type': ADDRESS_DOC_TYPE, '_id': dpa.uprn, '_source': doc},
+        UPDATE: {'_op_type': 'update', '_index': INDEX_NAME, '_type': ADDRESS_DOC_TYPE, '_id': dpa.uprn, 'doc': doc},
+        DELETE: {'_op_type': 'delete', '_index': INDEX_NAME, '_type': ADDRESS_DOC_TYPE, '_id': dpa.uprn},
+    }  # type: Dict[str, Dict[str, Union[str, Dict[str, Union[str, float]]]]]
+    return [action_dict_cases[dpa.change_type]]
 
-    def make_action(doc_type: str) -> Dict[str, Union[str, Dict[str, Union[str, float]]]]:
-        action_dict_cases = {
-            INSERT: {'_op_type': 'index', '_index': INDEX_NAME, '_type': doc_type, '_id': dpa.uprn, '_source': doc},
-            UPDATE: {'_op_type': 'update', '_index': INDEX_NAME, '_type': doc_type, '_id': dpa.uprn, 'doc': doc},
-            DELETE: {'_op_type': 'delete', '_index': INDEX_NAME, '_type': doc_type, '_id': dpa.uprn},
-        }  # type: Dict[str, Dict[str, Union[str, Dict[str, Union[str, float]]]]]
-        return action_dict_cases[dpa.change_type]
 
-    actions = [make_action(doctype) for doctype in TYPE_TO_INDEX_MAPPING.keys()]
-    return actions
+def _entry_datetime(header: Header) -> str:
+    # we use 'date_time_no_millis' format: yyyy-MM-dd’T'HH:mm:ssZZ
+    # we assume UTC (+00) as the spec doesn't specify a timezone
+    return '{}T{}+00'.format(header.entry_date, header.time_stamp)
+
+
+def scan_record_groups(lines: Iterable[str], progress: ImportProgress = None) -> Iterator[RecordGroup]:
+    """Groups consecutive lines by UPRN, as groupby(csv.reader(lines), itemgetter(UPRN)) would, but
+    only the header, BLPU and DPA lines are parsed, and only the columns make_es_actions uses are kept.
+    The other record types are most of the file, so they are skipped once their UPRN has been read.
+    """
+    progress = progress or ImportProgress()
+    row_counts = {HEADER_PREFIX: 0, BLPU_PREFIX: 0, DPA_PREFIX: 0, None: 0}  # type: Dict[str, int]
+    group_uprn = None  # type: str
+    rows = 0
+    header = None  # type: Header
+    blpus = []  # type: List[Coordinates]
+    dpas = []  # type: List[DpaAddress]
+    try:
+        for line in lines:
+            prefix = line[:3]
+            if prefix not in PARSED_PREFIXES:
+                fields = line.split(',', UPRN + 1)
+                # a trailer or blank line may not have a UPRN column
+                uprn = fields[UPRN] if len(fields) > UPRN else ''
+                prefix = None
+            elif prefix == BLPU_PREFIX:
+                # the columns up to the coordinates are codes, numbers and dates, which never have commas in them,
+                # so splitting on commas finds the coordinates. Quotes, such as around change_type, are left on.
+                fields = line.split(',', BLPU_Y_COORDINATE + 1)
+                uprn = fields[UPRN]
+            else:
+                row = next(csv.reader([line]))
+                uprn = row[UPRN]
 
+            if uprn != group_uprn:
+                if rows:
+                    yield RecordGroup(rows, header, blpus, dpas)
+                    rows = 0
+                    header = None
+                    blpus = []
+                    dpas = []
+                group_uprn = uprn
+            rows += 1
+            row_counts[prefix] += 1
 
-def get_action_dicts(csv_file) -> Iterator[Dict[str, Union[str, Dict[str, Union[str, float]]]]]:
+            if prefix == DPA_PREFIX:
+                dpas.append(DpaAddress(*_dpa_address_columns(row)))
+            elif prefix == BLPU_PREFIX:
+                blpus.append(Coordinates(fields[BLPU_X_COORDINATE], fields[BLPU_Y_COORDINATE]))
+            elif prefix == HEADER_PREFIX:
+                header = Header(*row)
+        if rows:
+            yield RecordGroup(rows, header, blpus, dpas)
+    finally:
+        # counted here rather than per line, which is a noticeable part of the time spent on a skipped line
+        progress.count_rows(HEADER_ID, row_counts[HEADER_PREFIX])
+        progress.count_rows(BLPU_ID, row_counts[BLPU_PREFIX])
+        progress.count_rows(DPA_ID, row_counts[DPA_PREFIX])
+        progress.count_rows(None, row_counts[None])
+
+
+def get_action_dicts(csv_file, snapshot_builder=None, progress: ImportProgress = None, skip_rows: int = 0,
+                     resume_rows: deque = None) -> Iterator[Dict[str, Union[str, Dict[str, Union[str, float]]]]]:
     """A generator which yields elasticsearch action dicts for groups of records
-    with one DPA and zero or one BPLU
+    with one DPA and zero or one BPLU. The actions are also given to snapshot_builder, if there is one.
+
+    To resume an import, skip_rows rows (which must end at a UPRN group boundary) are skipped without
+    being parsed, apart from the header. AddressBase rows never span lines, so rows are skipped as lines.
+    For each action yielded, the row a resumed import could start from once the action has been
+    acknowledged is appended to resume_rows, if it is given.
     """
-    data_reader = csv.reader(csv_file)
+    progress = progress or ImportProgress()
+    lines = progress.track_lines(csv_file)
     entry_datetime = None  # type: str
+    for line in islice(lines, skip_rows):
+        if line.startswith(HEADER_PREFIX):
+            entry_datetime = _entry_datetime(Header(*next(csv.reader([line]))))
+    row_number = skip_rows
 
-    for _, group in groupby(data_reader, itemgetter(UPRN)):
-        rows = list(group)
-        if len(rows) == 1 and int(rows[0][RECORD_IDENTIFIER]) == HEADER_ID:
-            header = Header(*rows[0])
-            # we use 'date_time_no_millis' format: yyyy-MM-dd’T'HH:mm:ssZZ
-            # we assume UTC (+00) as the spec doesn't specify a timezone
-            entry_datetime = '{}T{}+00'.format(header.entry_date, header.time_stamp)
+    for group in scan_record_groups(lines, progress):
+        group_start_row = row_number
+        row_number += group.rows
+        if group.rows == 1 and group.header is not None:
+            entry_datetime = _entry_datetime(group.header)
 
             continue
 
-        blpu_list = []  # type: List[BLPU]
-        dpa_list = []   # type: List[DPA]
-        # create namedtuples from each line
-        for row in rows:
-            rec_type = int(row[RECORD_IDENTIFIER])
-            # create a record using the values in the row
-            if rec_type == BLPU_ID:
-                blpu_list += [BLPU(*row)]
-            elif rec_type == DPA_ID:
-                dpa_list += [DPA(*row)]
-
         # we must have one DPA and zero or one BPLU
-        if len(dpa_list) == 1 and len(blpu_list) in [0, 1]:
-            dpa = dpa_list[0]
+        if len(group.dpas) == 1 and len(group.blpus) in [0, 1]:
+            progress.count_group(skipped=False)
+            dpa = group.dpas[0]
             blpu = []
-            if len(blpu_list) == 1:
-                blpu = blpu_list[0]
+            if len(group.blpus) == 1:
+                blpu = group.blpus[0]
             action_dicts = make_es_actions(dpa, blpu, entry_datetime)
+            if snapshot_builder is not None:
+                snapshot_builder.add_actions(action_dicts)
 
-            pprint(action_dicts, width=1)
-
-            for action_dict in action_dicts:
+            for position, action_dict in enumerate(action_dicts):
+                if resume_rows is not None:
+                    # the group is only done once its last action is
+                    resume_rows.append(row_number if position == len(action_dicts) - 1 else group_start_row)
                 yield action_dict
+        else:
+            progress.count_group(skipped=True)
 
 
-def import_csv(csv_file: str, nodes: List[str]) -> None:
-    client = Elasticsearch(nodes)
-    # create index if it doesn't exist
-    if INDEX_NAME not in client.indices.status()['indices']:
-        doc_type = list(TYPE_TO_INDEX_MAPPING.keys())[0]
-        client.index(index=INDEX_NAME, doc_type=doc_type, body={})
+def write_data_generation(client, index_name: str = INDEX_NAME) -> str:
+    generation = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    client.index(index=index_name, doc_type=DATA_GENERATION_DOC_TYPE, id=DATA_GENERATION_DOC_ID,
+                 body={'generation': generation}, refresh=True)
+    return generation
+
+
+def prepare_index(client, index_name: str = INDEX_NAME) -> None:
+    """Creates the index if it doesn't exist and puts the mappings. Only needs doing once per import run.
+    index_name may be an alias, see index_versions.
+    """
+    if not client.indices.exists(index=index_name):
+        client.indices.create(index=index_name)
+    make_es_mappings(client, index_name)
+
+
+def migrate_to_single_type(client, index_name: str = INDEX_NAME) -> int:
+    """Copies the addresses from the old two-type layout into ADDRESS_DOC_TYPE. The old types are
+    kept, as the API searches them until the version that searches ADDRESS_DOC_TYPE is deployed.
+    delete_legacy_types removes them after that. Returns the number of addresses copied.
+    """
+    prepare_index(client, index_name)
+    legacy_docs = scan(client, index=index_name, doc_type='address_by_postcode', query={'query': {'match_all': {}}})
+    actions = ({'_op_type': 'index', '_index': index_name, '_type': ADDRESS_DOC_TYPE, '_id': hit['_id'],
+                '_source': hit['_source']} for hit in legacy_docs)
+    copied, _ = bulk(client, actions, chunk_size=BULK_CHUNK_SIZE)
+    write_data_generation(client, index_name)
+    LOGGER.info('Migrated {} addresses to the {} type'.format(copied, ADDRESS_DOC_TYPE))
+    return copied
+
+
+def delete_legacy_types(client, index_name: str = INDEX_NAME) -> None:
+    """Deletes the old two-type layout's documents, once the API no longer searches them"""
+    for doc_type in LEGACY_DOC_TYPES:
+        if client.indices.exists_type(index=index_name, doc_type=doc_type):
+            client.indices.delete_mapping(index=index_name, doc_type=doc_type)
+            LOGGER.info('Deleted the {} type'.format(doc_type))
+
+
+def _chunks(items: Iterable, size: int) -> Iterator[List]:
+    chunk = []  # type: List
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _send_bulk_chunk(client, chunk: List[Dict[str, Any]]) -> List[Tuple[bool, Any]]:
+    return list(streaming_bulk(client, chunk, chunk_size=len(chunk), raise_on_error=False))
+
+
+def _parallel_bulk(client, action_dicts: Iterable[Dict[str, Any]], bulk_threads: int) -> Iterator[Tuple[bool, Any]]:
+    """Sends chunks of actions from several threads. Only a few chunks are queued
+    per thread, so actions are still read lazily and memory use stays flat.
+    """
+    pending = deque()  # type: deque
+    with ThreadPoolExecutor(max_workers=bulk_threads) as executor:
+        for chunk in _chunks(action_dicts, BULK_CHUNK_SIZE):
+            pending.append(executor.submit(_send_bulk_chunk, client, chunk))
+            if len(pending) >= bulk_threads * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _to_index(action_dicts: Iterable[Dict[str, Any]], index_name: str) -> Iterator[Dict[str, Any]]:
+    for action_dict in action_dicts:
+        action_dict['_index'] = index_name
+        yield action_dict
+
+
+def _bulk_results(client, action_dicts: Iterable[Dict[str, Any]], bulk_threads: int) -> Iterator[Tuple[bool, Any]]:
+    if bulk_threads > 1:
+        return _parallel_bulk(client, action_dicts, bulk_threads)
+    return streaming_bulk(client, action_dicts, chunk_size=BULK_CHUNK_SIZE, raise_on_error=False)
+
+
+def load_csv(client, csv_file, snapshot_builder=None, file_name: str = '', bulk_threads: int = 1,
+             checkpoint: FileCheckpoint = None, index_name: str = INDEX_NAME) -> Dict[str, Any]:
+    """Sends the file's actions to an index that prepare_index (or index_versions.create_bulk_load_index)
+    has already set up, and returns a summary of what was done.
+
+    With a checkpoint, the import starts from the checkpoint's row and the row to resume from
+    is saved each time a bulk batch has been acknowledged. An error stopping the load is logged and
+    given in the summary's 'error', see load_failed.
+    """
+    progress = ImportProgress(file_name)
+    skip_rows = checkpoint.rows_done if checkpoint else 0
+    if skip_rows:
+        LOGGER.info('Resuming {} from row {}'.format(file_name, skip_rows))
+    resume_rows = deque()  # type: deque
+    error = None
     try:
-        make_es_mappings(client)
-        action_dicts = get_action_dicts(csv_file)
-        bulk(client, action_dicts)
+        action_dicts = get_action_dicts(csv_file, snapshot_builder, progress, skip_rows, resume_rows)
+        if index_name != INDEX_NAME:
+            action_dicts = _to_index(action_dicts, index_name)
+        acknowledged = 0
+        for succeeded, item in _bulk_results(client, action_dicts, bulk_threads):
+            progress.count_bulk_result(succeeded)
+            if not succeeded:
+                LOGGER.warning('Bulk action failed: {}'.format(item))
+            resume_row = resume_rows.popleft()
+            acknowledged += 1
+            if checkpoint and acknowledged % BULK_CHUNK_SIZE == 0:
+                checkpoint.save(resume_row)
+        if checkpoint:
+            checkpoint.complete()
     except Exception as e:
         LOGGER.error('An error occurred when processing a bulk update', exc_info=e)
+        error = e
+    return _with_error(progress.finish(), error)
+
+
+def _with_error(summary: Dict[str, Any], error: Exception = None) -> Dict[str, Any]:
+    if error is not None:
+        summary['error'] = '{}: {}'.format(type(error).__name__, error)
+    return summary
+
+
+def load_failed(summary: Dict[str, Any]) -> bool:
+    """Whether a load stopped with an error or any of its bulk actions failed"""
+    return 'error' in summary or summary['bulk_failed'] > 0
+
+
+def import_csv(csv_file: str, nodes: List[str], snapshot_builder=None, file_name: str = '') -> Dict[str, Any]:
+    """Imports the file and returns a summary of what was done"""
+    client = Elasticsearch(nodes)
+    try:
+        prepare_index(client)
+        return load_csv(client, csv_file, snapshot_builder, file_name)
+    finally:
+        # even a failed bulk update may have changed some documents
+        write_data_generation(client)
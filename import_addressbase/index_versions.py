@@ -0,0 +1,119 @@
+"""Full reloads into a new, versioned index, which the search alias is switched to once it is ready.
+
+The API only ever searches the alias (INDEX_NAME by default), so a reload never slows searches down.
+The index being loaded has refreshing turned off and no replicas. Both are restored when the load
+finishes, then the index is force merged and warmed before the alias is switched to it in a single
+atomic update. Earlier versions are kept, so a rollback is switching the alias back to one of them.
+"""
+
+from datetime import datetime
+import logging
+import re
+from typing import Dict, List
+
+from elasticsearch import NotFoundError  # type: ignore
+
+from import_addressbase.importing import (
+    ADDRESS_DOC_TYPE, INDEX_NAME, PHRASE_SORT_KEY_FIELD, POSTCODE_SORT_KEY_FIELD, make_es_mappings,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# the fastest settings for loading an index that nothing is searching yet
+BULK_LOAD_SETTINGS = {'index': {'refresh_interval': '-1', 'number_of_replicas': 0}}  # type: Dict[str, Dict]
+# used when there is no live index to copy the settings from
+DEFAULT_REFRESH_INTERVAL = '1s'
+DEFAULT_NUMBER_OF_REPLICAS = 1
+# how many versions, including the live one, prune_versions keeps
+VERSIONS_TO_KEEP = 2
+VERSION_FORMAT = '%Y%m%d%H%M%S'
+
+
+def version_name(alias: str = INDEX_NAME, now: datetime = None) -> str:
+    return '{}-{}'.format(alias, (now or datetime.utcnow()).strftime(VERSION_FORMAT))
+
+
+def list_versions(client, alias: str = INDEX_NAME) -> List[str]:
+    """Returns the names of the alias's versioned indexes, oldest first"""
+    pattern = re.compile(r'^{}-\d{{14}}$'.format(re.escape(alias)))
+    try:
+        names = client.indices.get_settings(index='{}-*'.format(alias)).keys()
+    except NotFoundError:
+        return []
+    return sorted(name for name in names if pattern.match(name))
+
+
+def get_alias_target(client, alias: str = INDEX_NAME) -> List[str]:
+    """Returns the indexes the alias currently points to"""
+    try:
+        return sorted(client.indices.get_alias(name=alias).keys())
+    except NotFoundError:
+        return []
+
+
+def create_bulk_load_index(client, alias: str = INDEX_NAME) -> str:
+    """Creates a new version of the index, set up for bulk loading, and returns its name"""
+    index_name = version_name(alias)
+    client.indices.create(index=index_name, body={'settings': BULK_LOAD_SETTINGS})
+    make_es_mappings(client, index_name)
+    LOGGER.info('Created {} for a full reload'.format(index_name))
+    return index_name
+
+
+def _live_settings(client, alias: str) -> Dict[str, str]:
+    """The refresh interval and replicas of the index the alias points to, to give the new version"""
+    settings = {'refresh_interval': DEFAULT_REFRESH_INTERVAL, 'number_of_replicas': DEFAULT_NUMBER_OF_REPLICAS}
+    for index_name in get_alias_target(client, alias):
+        index_settings = client.indices.get_settings(index=index_name)[index_name]['settings']['index']
+        for key in settings:
+            if key in index_settings:
+                settings[key] = index_settings[key]
+    return settings
+
+
+def finish_bulk_load(client, index_name: str, alias: str = INDEX_NAME) -> None:
+    """Gives the loaded index the live index's settings, then merges its segments and warms it with
+    the sorts the API uses, so the first searches after the switch aren't slow
+    """
+    settings = _live_settings(client, alias)
+    client.indices.put_settings(index=index_name, body={'index': settings})
+    client.indices.refresh(index=index_name)
+    client.indices.optimize(index=index_name, max_num_segments=1)
+    for sort_key_field in [POSTCODE_SORT_KEY_FIELD, PHRASE_SORT_KEY_FIELD]:
+        client.search(index=index_name, doc_type=ADDRESS_DOC_TYPE, size=1,
+                      body={'query': {'match_all': {}}, 'sort': [{sort_key_field: {'missing': '_last'}}]})
+    LOGGER.info('Finished loading {} with settings {}'.format(index_name, settings))
+
+
+def switch_alias(client, index_name: str, alias: str = INDEX_NAME, replace_unaliased_index: bool = False) -> List[str]:
+    """Atomically points the alias at index_name, and returns the indexes it pointed to before.
+
+    Before the first full reload, the live index may be a plain index with the alias's name. That index
+    has to be deleted first, which leaves a moment with nothing to search, so only happens when asked.
+    """
+    previous = get_alias_target(client, alias)
+    if not previous and client.indices.exists(index=alias):
+        if not replace_unaliased_index:
+            raise ValueError('{} is an index rather than an alias. It has to be deleted before the alias can be '
+                             'created, which must be asked for explicitly'.format(alias))
+        LOGGER.warning('Deleting the index {} so that an alias can take its name'.format(alias))
+        client.indices.delete(index=alias)
+
+    actions = [{'remove': {'index': name, 'alias': alias}} for name in previous if name != index_name]
+    actions.append({'add': {'index': index_name, 'alias': alias}})
+    client.indices.update_aliases(body={'actions': actions})
+    LOGGER.info('Switched {} from {} to {}'.format(alias, previous or 'nothing', index_name))
+    return previous
+
+
+def prune_versions(client, alias: str = INDEX_NAME, keep: int = VERSIONS_TO_KEEP) -> List[str]:
+    """Deletes all but the newest keep versions, never deleting one the alias points to.
+    Returns the names of the deleted indexes.
+    """
+    live = set(get_alias_target(client, alias))
+    versions = list_versions(client, alias)
+    deleted = [name for name in versions[:max(len(versions) - keep, 0)] if name not in live]
+    for name in deleted:
+        client.indices.delete(index=name)
+        LOGGER.info('Deleted old index version {}'.format(name))
+    return deleted
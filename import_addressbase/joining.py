@@ -0,0 +1,275 @@
+"""Joins DPA records to their BLPU coordinates by UPRN, whatever order or file the records are in.
+
+get_action_dicts only pairs a DPA with a BLPU in the same run of rows. Here the input is read twice:
+the first pass collects every BLPU's coordinates, the second joins each DPA against them.
+
+The coordinates are held in compact arrays while they fit in the memory budget. Beyond that they
+are spilled to disk and split into partitions by UPRN. The DPA rows are partitioned the same way
+during the second pass, and then each partition is joined in memory in turn. Records with the
+same UPRN always land in the same partition, in the order they were read.
+"""
+
+from array import array
+from bisect import bisect_left
+import csv
+import json
+import logging
+import math
+import os
+import struct
+import tempfile
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, TextIO, Tuple
+
+from import_addressbase.importing import (
+    BLPU_PREFIX, BLPU_X_COORDINATE, BLPU_Y_COORDINATE, INDEX_NAME, UPRN, Coordinates, DpaAddress,
+    _bulk_results, _entry_datetime, _to_index, _with_error, make_es_actions, scan_record_groups,
+)
+from import_addressbase.progress import ImportProgress
+
+LOGGER = logging.getLogger(__name__)
+
+# uprn, x and y, as stored in the arrays and in spill files
+COORDINATE_RECORD = struct.Struct('<qdd')
+BYTES_PER_COORDINATE = COORDINATE_RECORD.size
+# what a coordinate takes at the peak of CoordinateIndex.freeze(), which the memory budget has to allow for:
+# the arrays, an int of about 44 bytes in the list it sorts, and the sorted copies of the arrays
+PEAK_BYTES_PER_COORDINATE = 96
+# how many spilled coordinates are read at a time
+SPILL_READ_RECORDS = 10000
+
+OpenFiles = Callable[[], Iterable[Tuple[str, TextIO]]]
+
+
+class CoordinateIndex(object):
+    """BLPU coordinates by UPRN, in three parallel arrays. Call freeze() before get()."""
+
+    def __init__(self) -> None:
+        self._uprns = array('q')
+        self._xs = array('d')
+        self._ys = array('d')
+
+    def __len__(self) -> int:
+        return len(self._uprns)
+
+    @property
+    def nbytes(self) -> int:
+        """The most memory the coordinates need, which is while freeze() sorts them"""
+        return len(self._uprns) * PEAK_BYTES_PER_COORDINATE
+
+    def add(self, uprn: int, x: float, y: float) -> None:
+        self._uprns.append(uprn)
+        self._xs.append(x)
+        self._ys.append(y)
+
+    def records(self) -> Iterator[Tuple[int, float, float]]:
+        return zip(self._uprns, self._xs, self._ys)
+
+    def freeze(self) -> None:
+        """Sorts by UPRN. Where a UPRN was added more than once, the last coordinates win."""
+        count = len(self._uprns)
+        # one int per coordinate holding both the UPRN and the position it was added at, which is
+        # about half the memory of sorting positions by a key
+        order = [uprn * count + i for i, uprn in enumerate(self._uprns)]
+        order.sort()
+        uprns, xs, ys = array('q'), array('d'), array('d')
+        for packed in order:
+            uprn, i = divmod(packed, count)
+            if uprns and uprns[-1] == uprn:
+                # equal UPRNs are in the order they were added, so this one was added later
+                xs[-1], ys[-1] = self._xs[i], self._ys[i]
+            else:
+                uprns.append(uprn)
+                xs.append(self._xs[i])
+                ys.append(self._ys[i])
+        del order
+        self._uprns, self._xs, self._ys = uprns, xs, ys
+
+    def get(self, uprn: int) -> Optional[Coordinates]:
+        index = bisect_left(self._uprns, uprn)
+        if index == len(self._uprns) or self._uprns[index] != uprn:
+            return None
+        return Coordinates(self._xs[index], self._ys[index])
+
+
+class JoinStats(object):
+    """Counts what the join did, and what get_action_dicts would have done with the same rows"""
+
+    def __init__(self) -> None:
+        self.blpus = 0
+        self.dpas = 0
+        self.joined = 0
+        self.partitions = 1
+        # DPAs that shared a run of rows with exactly one BLPU, and so were joined before
+        self.contiguous_joins = 0
+        # DPAs that were dropped before, because their run had more than one DPA or BLPU
+        self.contiguous_dropped = 0
+
+    def summary(self) -> Dict[str, int]:
+        return {
+            'blpus': self.blpus,
+            'dpas': self.dpas,
+            'joined': self.joined,
+            'without_coordinates': self.dpas - self.joined,
+            'partitions': self.partitions,
+            'contiguous_joins': self.contiguous_joins,
+            'contiguous_dropped': self.contiguous_dropped,
+            'recovered_joins': self.joined - self.contiguous_joins,
+        }
+
+
+class ExternalJoin(object):
+    """Yields the action dicts for every DPA in the files given by open_files, which is called once
+    per pass and must return (name, csv_file) pairs.
+    """
+
+    def __init__(self, memory_budget_bytes: int, work_dir: str = None, progress: ImportProgress = None) -> None:
+        self.memory_budget_bytes = max(memory_budget_bytes, PEAK_BYTES_PER_COORDINATE)
+        self.work_dir = work_dir
+        self.progress = progress or ImportProgress()
+        self.stats = JoinStats()
+
+    def actions(self, open_files: OpenFiles) -> Iterator[Dict[str, Any]]:
+        with tempfile.TemporaryDirectory(prefix='addressbase-join-', dir=self.work_dir) as temp_dir:
+            spill_path = os.path.join(temp_dir, 'coordinates')
+            coordinates = self._collect_coordinates(open_files, spill_path)
+            if coordinates is not None:
+                coordinates.freeze()
+                yield from self._join(self._dpas(open_files), coordinates)
+            else:
+                yield from self._join_partitions(open_files, spill_path, temp_dir)
+        LOGGER.info('Join summary {}'.format(json.dumps(self.stats.summary(), sort_keys=True)))
+
+    def _collect_coordinates(self, open_files: OpenFiles, spill_path: str) -> Optional[CoordinateIndex]:
+        """First pass. Returns the coordinates, or None if they didn't fit and were spilled to spill_path."""
+        coordinates = CoordinateIndex()
+        spill_file = None
+        try:
+            for name, csv_file in open_files():
+                for line in csv_file:
+                    # only BLPU rows are parsed in this pass. As in scan_record_groups, no column before the
+                    # coordinates has a comma in it, so splitting on commas finds them.
+                    if not line.startswith(BLPU_PREFIX):
+                        continue
+                    fields = line.split(',', BLPU_Y_COORDINATE + 1)
+                    coordinates.add(int(fields[UPRN]), float(fields[BLPU_X_COORDINATE]),
+                                    float(fields[BLPU_Y_COORDINATE]))
+                    self.stats.blpus += 1
+                    if coordinates.nbytes >= self.memory_budget_bytes:
+                        if spill_file is None:
+                            LOGGER.info('BLPU coordinates exceed the join memory budget, spilling to disk')
+                            spill_file = open(spill_path, 'wb')
+                        _write_coordinates(spill_file, coordinates.records())
+                        coordinates = CoordinateIndex()
+            if spill_file is None:
+                return coordinates
+            _write_coordinates(spill_file, coordinates.records())
+            return None
+        finally:
+            if spill_file is not None:
+                spill_file.close()
+
+    def _dpas(self, open_files: OpenFiles) -> Iterator[Tuple[DpaAddress, str]]:
+        """Second pass. Yields each DPA with its file's entry datetime, counting what the
+        contiguous-only join would have made of its run of rows
+        """
+        for name, csv_file in open_files():
+            entry_datetime = None  # type: str
+            for group in scan_record_groups(self.progress.track_lines(csv_file), self.progress):
+                if group.header is not None:
+                    entry_datetime = _entry_datetime(group.header)
+                if len(group.dpas) == 1 and len(group.blpus) == 1:
+                    self.stats.contiguous_joins += 1
+                elif len(group.dpas) > 1 or (group.dpas and len(group.blpus) > 1):
+                    self.stats.contiguous_dropped += len(group.dpas)
+                for dpa in group.dpas:
+                    yield dpa, entry_datetime
+
+    def _join(self, dpas: Iterable[Tuple[DpaAddress, str]], coordinates: CoordinateIndex) -> Iterator[Dict[str, Any]]:
+        for dpa, entry_datetime in dpas:
+            blpu = coordinates.get(int(dpa.uprn))
+            self.stats.dpas += 1
+            if blpu is not None:
+                self.stats.joined += 1
+            self.progress.count_group(skipped=False)
+            yield from make_es_actions(dpa, blpu, entry_datetime)
+
+    def _join_partitions(self, open_files: OpenFiles, spill_path: str, temp_dir: str) -> Iterator[Dict[str, Any]]:
+        spilled = os.path.getsize(spill_path) // BYTES_PER_COORDINATE
+        # the partitions are split by UPRN, so they're not quite even; one more leaves room for that
+        partitions = math.ceil(spilled * PEAK_BYTES_PER_COORDINATE / self.memory_budget_bytes) + 1
+        self.stats.partitions = partitions
+        LOGGER.info('Joining in {} partitions'.format(partitions))
+        coordinate_paths = [os.path.join(temp_dir, 'coordinates-{}'.format(i)) for i in range(partitions)]
+        dpa_paths = [os.path.join(temp_dir, 'dpas-{}.csv'.format(i)) for i in range(partitions)]
+
+        coordinate_files = [open(path, 'wb') for path in coordinate_paths]
+        try:
+            for record in _read_coordinates(spill_path):
+                coordinate_files[record[0] % partitions].write(COORDINATE_RECORD.pack(*record))
+        finally:
+            for file in coordinate_files:
+                file.close()
+        os.remove(spill_path)
+
+        dpa_files = [open(path, 'wt', newline='') for path in dpa_paths]
+        try:
+            writers = [csv.writer(file) for file in dpa_files]
+            for dpa, entry_datetime in self._dpas(open_files):
+                writers[int(dpa.uprn) % partitions].writerow(list(dpa) + [entry_datetime])
+        finally:
+            for file in dpa_files:
+                file.close()
+
+        for coordinate_path, dpa_path in zip(coordinate_paths, dpa_paths):
+            coordinates = CoordinateIndex()
+            for record in _read_coordinates(coordinate_path):
+                coordinates.add(*record)
+            coordinates.freeze()
+            with open(dpa_path, 'rt', newline='') as dpa_file:
+                yield from self._join(((DpaAddress(*row[:-1]), row[-1]) for row in csv.reader(dpa_file)), coordinates)
+
+
+def _write_coordinates(file, records: Iterable[Tuple[int, float, float]]) -> None:
+    for record in records:
+        file.write(COORDINATE_RECORD.pack(*record))
+
+
+def _read_coordinates(path: str) -> Iterator[Tuple[int, float, float]]:
+    with open(path, 'rb') as file:
+        while True:
+            data = file.read(COORDINATE_RECORD.size * SPILL_READ_RECORDS)
+            if not data:
+                return
+            yield from COORDINATE_RECORD.iter_unpack(data)
+
+
+def load_joined(client, open_files: OpenFiles, memory_budget_bytes: int, snapshot_builder=None,
+                bulk_threads: int = 1, work_dir: str = None, index_name: str = INDEX_NAME) -> Dict[str, Any]:
+    """Sends the joined actions for all the files to an index that prepare_index has already set up,
+    and returns a summary of what was done, like load_csv's
+    """
+    progress = ImportProgress('joined')
+    join = ExternalJoin(memory_budget_bytes, work_dir, progress)
+    error = None
+    try:
+        action_dicts = join.actions(open_files)
+        if snapshot_builder is not None:
+            action_dicts = _add_to_snapshot(action_dicts, snapshot_builder)
+        if index_name != INDEX_NAME:
+            action_dicts = _to_index(action_dicts, index_name)
+        for succeeded, item in _bulk_results(client, action_dicts, bulk_threads):
+            progress.count_bulk_result(succeeded)
+            if not succeeded:
+                LOGGER.warning('Bulk action failed: {}'.format(item))
+    except Exception as e:
+        LOGGER.error('An error occurred when processing a bulk update', exc_info=e)
+        error = e
+    summary = _with_error(progress.finish(), error)
+    summary['join'] = join.stats.summary()
+    return summary
+
+
+def _add_to_snapshot(action_dicts: Iterable[Dict[str, Any]], snapshot_builder) -> Iterator[Dict[str, Any]]:
+    for action_dict in action_dicts:
+        snapshot_builder.add_actions([action_dict])
+        yield action_dict
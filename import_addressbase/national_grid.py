@@ -0,0 +1,67 @@
+"""Converts British National Grid eastings and northings to latitude and longitude.
+
+AddressBase gives BLPU coordinates on the National Grid, but elasticsearch's geo_point needs latitude
+and longitude. These are on the grid's own OSGB36 datum. It differs from WGS84 (GPS) by up to about
+120 metres, so a point is in the right place relative to other addresses but not on a GPS map.
+The formulas are the Ordnance Survey's, from "A guide to coordinate systems in Great Britain".
+"""
+
+import math
+from typing import Tuple
+
+# the Airy 1830 ellipsoid
+A = 6377563.396
+B = 6356256.909
+# the National Grid's transverse Mercator projection
+F0 = 0.9996012717
+LATITUDE_0 = math.radians(49)
+LONGITUDE_0 = math.radians(-2)
+EASTING_0 = 400000.0
+NORTHING_0 = -100000.0
+
+E2 = 1 - (B * B) / (A * A)
+N = (A - B) / (A + B)
+
+
+def _meridional_arc(latitude: float) -> float:
+    difference = latitude - LATITUDE_0
+    total = latitude + LATITUDE_0
+    return B * F0 * (
+        (1 + N + 5 / 4 * N ** 2 + 5 / 4 * N ** 3) * difference
+        - (3 * N + 3 * N ** 2 + 21 / 8 * N ** 3) * math.sin(difference) * math.cos(total)
+        + (15 / 8 * N ** 2 + 15 / 8 * N ** 3) * math.sin(2 * difference) * math.cos(2 * total)
+        - 35 / 24 * N ** 3 * math.sin(3 * difference) * math.cos(3 * total)
+    )
+
+
+def to_latitude_longitude(easting: float, northing: float) -> Tuple[float, float]:
+    """Returns the OSGB36 (latitude, longitude) in degrees of a National Grid point"""
+    latitude = LATITUDE_0
+    arc = 0.0
+    # iterate until the remaining northing is under a hundredth of a millimetre
+    while True:
+        latitude += (northing - NORTHING_0 - arc) / (A * F0)
+        arc = _meridional_arc(latitude)
+        if abs(northing - NORTHING_0 - arc) < 0.00001:
+            break
+
+    sin_latitude = math.sin(latitude)
+    tan_latitude = math.tan(latitude)
+    sec_latitude = 1 / math.cos(latitude)
+    nu = A * F0 / math.sqrt(1 - E2 * sin_latitude ** 2)
+    rho = A * F0 * (1 - E2) / (1 - E2 * sin_latitude ** 2) ** 1.5
+    eta2 = nu / rho - 1
+    tan2 = tan_latitude ** 2
+
+    vii = tan_latitude / (2 * rho * nu)
+    viii = tan_latitude / (24 * rho * nu ** 3) * (5 + 3 * tan2 + eta2 - 9 * tan2 * eta2)
+    ix = tan_latitude / (720 * rho * nu ** 5) * (61 + 90 * tan2 + 45 * tan2 ** 2)
+    x = sec_latitude / nu
+    xi = sec_latitude / (6 * nu ** 3) * (nu / rho + 2 * tan2)
+    xii = sec_latitude / (120 * nu ** 5) * (5 + 28 * tan2 + 24 * tan2 ** 2)
+    xiia = sec_latitude / (5040 * nu ** 7) * (61 + 662 * tan2 + 1320 * tan2 ** 2 + 720 * tan2 ** 3)
+
+    d = easting - EASTING_0
+    latitude = latitude - vii * d ** 2 + viii * d ** 4 - ix * d ** 6
+    longitude = LONGITUDE_0 + x * d - xi * d ** 3 + xii * d ** 5 - xiia * d ** 7
+    return math.degrees(latitude), math.degrees(longitude)
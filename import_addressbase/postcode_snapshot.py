@@ -0,0 +1,161 @@
+"""A compact, read-only file which answers postcode searches without elasticsearch.
+
+Layout (all integers little-endian):
+    header      magic (8 bytes), number of postcodes (uint32), number of records (uint32)
+    directory   one entry per postcode, sorted by postcode:
+                postcode padded with NULs (8 bytes), first record number (uint32), record count (uint32)
+    offsets     number of records + 1 uint64 offsets into the data section
+    data        the JSON encoded addresses, grouped by postcode in search result order
+
+The importer builds the file once and every API worker memory-maps it, so the pages are
+shared between gunicorn processes through the OS page cache.
+"""
+
+from bisect import bisect_left
+import json
+import logging
+import mmap
+import os
+import struct
+from typing import Any, Dict, List, Tuple, Union
+
+from import_addressbase.importing import ELASTICSEARCH_ONLY_FIELDS, POSTCODE_SORT_FIELDS, make_sort_key_string
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b'ASAPCS01'
+HEADER = struct.Struct('<8sII')
+DIRECTORY_ENTRY = struct.Struct('<8sII')
+OFFSET = struct.Struct('<Q')
+POSTCODE_WIDTH = 8
+
+
+def _postcode_key(postcode: str) -> bytes:
+    return postcode.upper().encode('utf-8').ljust(POSTCODE_WIDTH, b'\0')
+
+
+def _serialise(doc: Dict[str, Union[str, float]]) -> bytes:
+    doc = {field: value for field, value in doc.items() if field not in ELASTICSEARCH_ONLY_FIELDS}
+    return json.dumps(doc, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+class PostcodeSnapshotBuilder(object):
+    """Collects the documents produced by an import and writes them out as a snapshot.
+    Intended for full loads: documents are held in memory until write() is called.
+    """
+
+    def __init__(self) -> None:
+        self._records = {}  # type: Dict[str, Tuple[bytes, Tuple, bytes]]
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def add_actions(self, action_dicts: List[Dict[str, Any]]) -> None:
+        for action in action_dicts:
+            if action['_op_type'] == 'delete':
+                self._records.pop(action['_id'], None)
+                continue
+            doc = action['_source'] if action['_op_type'] == 'index' else action['doc']
+            postcode_key = _postcode_key(doc['postcode'])
+            if len(postcode_key) > POSTCODE_WIDTH:
+                LOGGER.warning('Postcode too long for the snapshot, skipping uprn {}'.format(action['_id']))
+                continue
+            # the postcode_sort_key elasticsearch sorts on, so the two give the same order
+            sort_key = (make_sort_key_string(doc, POSTCODE_SORT_FIELDS), doc['uprn'])
+            self._records[action['_id']] = (postcode_key, sort_key, _serialise(doc))
+
+    def write(self, path: str) -> None:
+        """Writes the snapshot to a temporary file and moves it over path, so readers
+        never see a partly written file
+        """
+        records = sorted(self._records.values(), key=lambda record: (record[0], record[1]))
+        directory = []  # type: List[Tuple[bytes, int, int]]
+        for record_number, (postcode_key, _, _) in enumerate(records):
+            if directory and directory[-1][0] == postcode_key:
+                key, first, count = directory[-1]
+                directory[-1] = (key, first, count + 1)
+            else:
+                directory.append((postcode_key, record_number, 1))
+
+        temp_path = '{}.tmp'.format(path)
+        with open(temp_path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, len(directory), len(records)))
+            for entry in directory:
+                file.write(DIRECTORY_ENTRY.pack(*entry))
+            offset = 0
+            for _, _, data in records:
+                file.write(OFFSET.pack(offset))
+                offset += len(data)
+            file.write(OFFSET.pack(offset))
+            for _, _, data in records:
+                file.write(data)
+        os.replace(temp_path, path)
+        LOGGER.info('Wrote postcode snapshot with {} postcodes and {} addresses to {}'.format(
+            len(directory), len(records), path))
+
+
+class _Directory(object):
+    """A sequence view of the snapshot's postcode keys, for binary searching"""
+
+    def __init__(self, buffer: mmap.mmap, size: int) -> None:
+        self._buffer = buffer
+        self._size = size
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, index: int) -> bytes:
+        start = HEADER.size + index * DIRECTORY_ENTRY.size
+        return self._buffer[start:start + POSTCODE_WIDTH]
+
+
+class PostcodeSnapshot(object):
+    """Read-only, memory-mapped view of a snapshot file"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as file:
+            self._stat = os.fstat(file.fileno())
+            self._buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.nof_postcodes, self.nof_records = HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a postcode snapshot'.format(path))
+        self._directory = _Directory(self._buffer, self.nof_postcodes)
+        self._offsets_start = HEADER.size + self.nof_postcodes * DIRECTORY_ENTRY.size
+        self._data_start = self._offsets_start + (self.nof_records + 1) * OFFSET.size
+
+    def is_stale(self) -> bool:
+        """True if the file on disk has been replaced since this snapshot was opened"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_ino, stat.st_mtime_ns) != (self._stat.st_ino, self._stat.st_mtime_ns)
+
+    def close(self) -> None:
+        self._buffer.close()
+
+    def _offset(self, record_number: int) -> int:
+        return OFFSET.unpack_from(self._buffer, self._offsets_start + record_number * OFFSET.size)[0]
+
+    def _find(self, postcode: str) -> Tuple[int, int]:
+        key = _postcode_key(postcode)
+        if len(key) > POSTCODE_WIDTH:
+            return 0, 0
+        index = bisect_left(self._directory, key)
+        if index == self.nof_postcodes or self._directory[index] != key:
+            return 0, 0
+        _, first, count = DIRECTORY_ENTRY.unpack_from(self._buffer, HEADER.size + index * DIRECTORY_ENTRY.size)
+        return first, count
+
+    def get_addresses(self, postcode: str, start_index: int, end_index: int) -> Tuple[List[Dict[str, Any]], int]:
+        """Returns the addresses in [start_index, end_index) of the postcode's results, and the total"""
+        first, count = self._find(postcode)
+        start = first + min(start_index, count)
+        end = first + min(end_index, count)
+        addresses = []
+        for record_number in range(start, end):
+            data_offset = self._data_start + self._offset(record_number)
+            data_end = self._data_start + self._offset(record_number + 1)
+            addresses.append(json.loads(self._buffer[data_offset:data_end].decode('utf-8')))
+        return addresses, count
@@ -0,0 +1,96 @@
+import json
+import logging
+import time
+from typing import Any, Dict, Iterable, Iterator
+
+LOGGER = logging.getLogger(__name__)
+
+# how many lines are read between checks of whether a progress report is due
+LINES_PER_CHECK = 1000
+
+
+class ImportProgress(object):
+    """Counts what an import has done and periodically logs its throughput.
+
+    The final summary is logged as a single JSON object so import runs can be compared over time.
+    """
+
+    def __init__(self, file_name: str = '', report_interval_seconds: float = 10.0) -> None:
+        self.file_name = file_name
+        self.report_interval_seconds = report_interval_seconds
+        self.started_at = time.monotonic()
+        self._last_report_at = self.started_at
+        self.lines = 0
+        # AddressBase is effectively ASCII, so decoded characters stand in for bytes
+        self.bytes_read = 0
+        self.rows_by_type = {'10': 0, '21': 0, '28': 0, 'other': 0}  # type: Dict[str, int]
+        self.addresses = 0
+        self.groups_skipped = 0
+        self.bulk_succeeded = 0
+        self.bulk_failed = 0
+
+    def track_lines(self, lines: Iterable[str]) -> Iterator[str]:
+        """Passes lines through, counting them and reporting progress when it is due"""
+        # counted in locals and added up every LINES_PER_CHECK lines, as this runs for every line
+        nof_lines = 0
+        nof_bytes = 0
+        try:
+            for line in lines:
+                nof_lines += 1
+                nof_bytes += len(line)
+                if nof_lines == LINES_PER_CHECK:
+                    self.lines += nof_lines
+                    self.bytes_read += nof_bytes
+                    nof_lines = 0
+                    nof_bytes = 0
+                    self.report_if_due()
+                yield line
+        finally:
+            self.lines += nof_lines
+            self.bytes_read += nof_bytes
+
+    def count_rows(self, record_identifier: int, rows: int) -> None:
+        key = str(record_identifier)
+        self.rows_by_type[key if key in self.rows_by_type else 'other'] += rows
+
+    def count_group(self, skipped: bool) -> None:
+        if skipped:
+            self.groups_skipped += 1
+        else:
+            self.addresses += 1
+
+    def count_bulk_result(self, succeeded: bool) -> None:
+        if succeeded:
+            self.bulk_succeeded += 1
+        else:
+            self.bulk_failed += 1
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return {
+            'file': self.file_name,
+            'elapsed_seconds': round(elapsed, 3),
+            'lines': self.lines,
+            'bytes': self.bytes_read,
+            'lines_per_second': round(self.lines / elapsed, 1),
+            'bytes_per_second': round(self.bytes_read / elapsed, 1),
+            'rows_by_type': dict(self.rows_by_type),
+            'addresses': self.addresses,
+            'groups_skipped': self.groups_skipped,
+            'bulk_succeeded': self.bulk_succeeded,
+            'bulk_failed': self.bulk_failed,
+        }
+
+    def report_if_due(self) -> None:
+        now = time.monotonic()
+        if now - self._last_report_at >= self.report_interval_seconds:
+            self._last_report_at = now
+            summary = self.summary()
+            LOGGER.info('Import progress file={file} lines={lines} lines_per_second={lines_per_second} '
+                        'bytes_per_second={bytes_per_second} addresses={addresses} groups_skipped={groups_skipped} '
+                        'bulk_succeeded={bulk_succeeded} bulk_failed={bulk_failed}'.format(**summary))
+
+    def finish(self) -> Dict[str, Any]:
+        summary = self.summary()
+        LOGGER.info('Import summary {}'.format(json.dumps(summary, sort_keys=True)))
+        return summary
@@ -0,0 +1,203 @@
+"""An embedded SQLite full-text index of addresses, for serving searches without elasticsearch.
+
+The importer writes it with SqliteIndexWriter and service.sqlite_access reads it. Each address is
+a row holding its JSON document and the columns needed to find and order it, with an FTS5 table
+over joined_fields for phrase searches and suggestions and an R*Tree of the coordinates for
+searches near a point.
+"""
+
+from datetime import datetime
+import json
+import logging
+import re
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from import_addressbase.importing import (
+    BULK_CHUNK_SIZE, ELASTICSEARCH_ONLY_FIELDS, NUMERIC_SORT_FIELDS, PHRASE_SORT_FIELDS, POSTCODE_SORT_FIELDS,
+    _chunks, get_action_dicts,
+)
+from import_addressbase.progress import ImportProgress
+
+LOGGER = logging.getLogger(__name__)
+
+SORT_COLUMNS = sorted(set(POSTCODE_SORT_FIELDS + PHRASE_SORT_FIELDS))  # type: List[str]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS address (
+    id INTEGER PRIMARY KEY,
+    uprn TEXT NOT NULL UNIQUE,
+    postcode TEXT NOT NULL,
+    joined_fields TEXT NOT NULL,
+    {sort_columns},
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS address_postcode ON address (postcode);
+CREATE VIRTUAL TABLE IF NOT EXISTS address_fts USING fts5(
+    joined_fields, content='address', content_rowid='id', prefix='1 2 3'
+);
+CREATE TRIGGER IF NOT EXISTS address_inserted AFTER INSERT ON address BEGIN
+    INSERT INTO address_fts (rowid, joined_fields) VALUES (new.id, new.joined_fields);
+END;
+CREATE TRIGGER IF NOT EXISTS address_deleted AFTER DELETE ON address BEGIN
+    INSERT INTO address_fts (address_fts, rowid, joined_fields) VALUES ('delete', old.id, old.joined_fields);
+END;
+CREATE VIRTUAL TABLE IF NOT EXISTS address_rtree USING rtree(id, min_x, max_x, min_y, max_y);
+CREATE TRIGGER IF NOT EXISTS address_rtree_deleted AFTER DELETE ON address BEGIN
+    DELETE FROM address_rtree WHERE id = old.id;
+END;
+CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+""".format(sort_columns=',\n    '.join(
+    '{} {}'.format(column, 'INTEGER' if column in NUMERIC_SORT_FIELDS else 'TEXT') for column in SORT_COLUMNS))
+
+
+def _order_by(fields: List[str]) -> str:
+    # missing values are stored as NULL and, like elasticsearch's 'missing': '_last', sort after everything
+    # else. An empty string is a value, and sorts first, as it does in elasticsearch.
+    return ', '.join('{0} IS NULL, {0}'.format(field) for field in fields) + ', uprn'
+
+
+POSTCODE_ORDER_BY = _order_by(POSTCODE_SORT_FIELDS)
+PHRASE_ORDER_BY = _order_by(PHRASE_SORT_FIELDS)
+
+
+def _sort_value(doc: Dict[str, Any], field: str) -> Any:
+    """The value to sort on, as import_addressbase.importing.make_sort_key sees it: NULL for an absent
+    or null field or an empty number, and otherwise the value, including an empty string
+    """
+    value = doc.get(field)
+    if field in NUMERIC_SORT_FIELDS:
+        return int(value) if value not in (None, '') else None
+    return value
+
+
+class SqliteIndexWriter(object):
+    """Applies the importer's elasticsearch actions to a SQLite index"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def apply_actions(self, action_dicts: Iterable[Dict[str, Any]]) -> List[Tuple[bool, Any]]:
+        """Applies the actions in one transaction and returns a (succeeded, action) pair for each"""
+        results = []  # type: List[Tuple[bool, Any]]
+        with self.connection:
+            for action in action_dicts:
+                try:
+                    self._apply_action(action)
+                    results.append((True, action))
+                except (sqlite3.Error, KeyError, ValueError) as e:
+                    results.append((False, {'action': action, 'error': str(e)}))
+        return results
+
+    def _apply_action(self, action: Dict[str, Any]) -> None:
+        # deleting first makes the triggers take the old text out of the full text index
+        self.connection.execute('DELETE FROM address WHERE uprn = ?', (action['_id'],))
+        if action['_op_type'] == 'delete':
+            return
+        doc = action['_source'] if action['_op_type'] == 'index' else action['doc']
+        cursor = self.connection.execute(
+            'INSERT INTO address (uprn, postcode, joined_fields, {}, doc) VALUES (?, ?, ?, {}, ?)'.format(
+                ', '.join(SORT_COLUMNS), ', '.join('?' * len(SORT_COLUMNS))),
+            [action['_id'], doc['postcode'].upper(), doc['joined_fields']] +
+            [_sort_value(doc, column) for column in SORT_COLUMNS] +
+            [json.dumps({field: value for field, value in doc.items() if field not in ELASTICSEARCH_ONLY_FIELDS}, sort_keys=True)]
+        )
+        x_coordinate, y_coordinate = doc.get('x_coordinate'), doc.get('y_coordinate')
+        # AddressBase has 0,0 for an unknown position
+        if x_coordinate or y_coordinate:
+            self.connection.execute('INSERT INTO address_rtree VALUES (?, ?, ?, ?, ?)',
+                                    (cursor.lastrowid, x_coordinate, x_coordinate, y_coordinate, y_coordinate))
+
+    def write_data_generation(self) -> str:
+        generation = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('generation', ?)", (generation,))
+        return generation
+
+    def load_csv(self, csv_file, file_name: str = '') -> Dict[str, Any]:
+        """The SQLite counterpart of importing.load_csv. Returns a summary of what was done."""
+        progress = ImportProgress(file_name)
+        try:
+            for chunk in _chunks(get_action_dicts(csv_file, progress=progress), BULK_CHUNK_SIZE):
+                for succeeded, item in self.apply_actions(chunk):
+                    progress.count_bulk_result(succeeded)
+                    if not succeeded:
+                        LOGGER.warning('Bulk action failed: {}'.format(item))
+        except Exception as e:
+            LOGGER.error('An error occurred when processing a bulk update', exc_info=e)
+        return progress.finish()
+
+
+class SqliteIndexReader(object):
+    """Read-only queries against a SQLite index. Use one per thread."""
+
+    def __init__(self, path: str) -> None:
+        self.connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+
+    def _search(self, where: str, term: str, order_by: str, start_index: int,
+                end_index: int) -> Tuple[List[Dict[str, Any]], int]:
+        total = self.connection.execute('SELECT COUNT(*) FROM address WHERE {}'.format(where), (term,)).fetchone()[0]
+        rows = self.connection.execute(
+            'SELECT doc FROM address WHERE {} ORDER BY {} LIMIT ? OFFSET ?'.format(where, order_by),
+            (term, max(end_index - start_index, 0), start_index)
+        ).fetchall()
+        return [json.loads(doc) for doc, in rows], total
+
+    def get_addresses_for_postcode(self, postcode: str, start_index: int, end_index: int) -> Tuple[List[Dict[str, Any]], int]:
+        return self._search('postcode = ?', postcode.upper(), POSTCODE_ORDER_BY, start_index, end_index)
+
+    def get_addresses_for_phrase(self, phrase: str, start_index: int, end_index: int) -> Tuple[List[Dict[str, Any]], int]:
+        """Matches addresses containing the phrase's words in order. For the single words that
+        the elasticsearch term filter matches, the results are the same.
+        """
+        fts_query = '"{}"'.format(phrase.replace('"', '""'))
+        where = 'id IN (SELECT rowid FROM address_fts WHERE address_fts MATCH ?)'
+        return self._search(where, fts_query, PHRASE_ORDER_BY, start_index, end_index)
+
+    def get_addresses_near(self, x_coordinate: float, y_coordinate: float, radius: float, start_index: int,
+                           end_index: int) -> Tuple[List[Dict[str, Any]], int]:
+        """Returns the addresses within radius metres of the National Grid point, nearest first.
+        The R*Tree finds the ones in the bounding square, then the corners are left out. It stores
+        coordinates in single precision, so distances are to within a tenth of a metre.
+        """
+        distance = ('((min_x + max_x) / 2 - :x) * ((min_x + max_x) / 2 - :x) + '
+                    '((min_y + max_y) / 2 - :y) * ((min_y + max_y) / 2 - :y)')
+        within = ('min_x <= :x + :radius AND max_x >= :x - :radius AND min_y <= :y + :radius '
+                  'AND max_y >= :y - :radius AND {} <= :radius * :radius'.format(distance))
+        parameters = {'x': x_coordinate, 'y': y_coordinate, 'radius': radius,
+                      'limit': max(end_index - start_index, 0), 'offset': start_index}
+        total = self.connection.execute('SELECT COUNT(*) FROM address_rtree WHERE ' + within, parameters).fetchone()[0]
+        rows = self.connection.execute(
+            'SELECT address.doc FROM (SELECT id, {} AS distance FROM address_rtree WHERE {}) AS nearby '
+            'JOIN address ON address.id = nearby.id '
+            'ORDER BY nearby.distance, address.uprn LIMIT :limit OFFSET :offset'.format(distance, within), parameters
+        ).fetchall()
+        return [json.loads(doc) for doc, in rows], total
+
+    def get_suggestions(self, prefix: str, size: int) -> List[Tuple[str, str]]:
+        """Returns (uprn, joined_fields) for up to size addresses containing the prefix's words in order,
+        the last of them as a prefix. Like the completion suggester, the matches aren't ranked, which lets
+        a short prefix stop at the first few matches rather than sorting all of them.
+        """
+        words = re.findall(r'\w+', prefix)
+        if not words:
+            return []
+        fts_query = '"{}" *'.format(' '.join(words))
+        return self.connection.execute(
+            'SELECT address.uprn, address.joined_fields FROM '
+            '(SELECT rowid FROM address_fts WHERE address_fts MATCH ? LIMIT ?) AS matched '
+            'JOIN address ON address.id = matched.rowid',
+            (fts_query, size)
+        ).fetchall()
+
+    def get_data_generation(self) -> Optional[str]:
+        row = self.connection.execute("SELECT value FROM metadata WHERE key = 'generation'").fetchone()
+        return row[0] if row else None
+
+    def count_addresses(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM address').fetchone()[0]
@@ -1,12 +1,113 @@
-from elasticsearch import Elasticsearch  # type: ignore
+from collections import namedtuple
+from elasticsearch import Elasticsearch, NotFoundError  # type: ignore
 from elasticsearch_dsl import Search     # type: ignore
-from typing import Any, Dict, List, Tuple, Union
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
 
-from service import app
+from import_addressbase.national_grid import to_latitude_longitude
+from import_addressbase.postcode_snapshot import PostcodeSnapshot
+from service import app, metrics
+
+LOGGER = logging.getLogger(__name__)
 
 ELASTICSEARCH_ENDPOINT = app.config['ELASTIC_SEARCH_ENDPOINT']
 MAX_NUMBER_SEARCH_RESULTS = app.config['MAX_NUMBER_SEARCH_RESULTS']
 SEARCH_RESULTS_PER_PAGE = app.config['SEARCH_RESULTS_PER_PAGE']
+ELASTICSEARCH_MAX_CONNECTIONS = app.config['ELASTICSEARCH_MAX_CONNECTIONS']
+ELASTICSEARCH_TIMEOUT_SECONDS = app.config['ELASTICSEARCH_TIMEOUT_SECONDS']
+ELASTICSEARCH_MAX_RETRIES = app.config['ELASTICSEARCH_MAX_RETRIES']
+ELASTICSEARCH_RETRY_ON_TIMEOUT = app.config['ELASTICSEARCH_RETRY_ON_TIMEOUT']
+POSTCODE_SNAPSHOT_FILE_PATH = app.config['POSTCODE_SNAPSHOT_FILE_PATH']
+
+MSEARCH_CHUNK_SIZE = app.config['MSEARCH_CHUNK_SIZE']
+SUGGEST_TIMEOUT_SECONDS = app.config['SUGGEST_TIMEOUT_SECONDS']
+
+# has the same shape as the elasticsearch_dsl hits used by server.paginated_address_records
+AddressHits = namedtuple('AddressHits', ['hits', 'total'])
+
+# the fields of an address returned to clients
+ADDRESS_FIELDS = [
+    'uprn', 'organisation_name', 'department_name', 'sub_building_name', 'building_name', 'building_number',
+    'dependent_thoroughfare_name', 'thoroughfare_name', 'double_dependent_locality', 'dependent_locality',
+    'post_town', 'postcode', 'x_coordinate', 'y_coordinate', 'joined_fields', 'entry_datetime',
+]  # type: List[str]
+# only these parts of a search response are sent back by elasticsearch. 'took' is its own time, for the metrics.
+SEARCH_FILTER_PATH = 'took,hits.total,hits.hits._source'
+MSEARCH_FILTER_PATH = 'responses.took,responses.error,responses.hits.total,responses.hits.hits._source'
+
+# Each order is a single string field the importer works out from the address fields, see
+# import_addressbase.importing.make_sort_key_string. Addresses imported before those fields existed come last.
+POSTCODE_SORT = [{'postcode_sort_key': {'missing': '_last'}}]  # type: List[Dict[str, Dict[str, str]]]
+PHRASE_SORT = [{'phrase_sort_key': {'missing': '_last'}}]  # type: List[Dict[str, Dict[str, str]]]
+# makes the order of addresses with equal sort values stable, so a cursor can say where a page ended. It is
+# only used by cursor searches, as sorting on _uid loads it into the heap as fielddata for the whole index.
+TIE_BREAK_SORT = {'_uid': {'order': 'asc'}}
+NUMERIC_SORT_FIELDS = ['building_number']
+MISSING_INTEGER_SORT_VALUE = 2 ** 31 - 1
+
+POSTCODE_QUERY = 'postcode'
+PHRASE_QUERY = 'phrase'
+NEAR_QUERY = 'near'
+
+# may be an alias, which a full reload switches to a new version of the index
+INDEX_NAME = app.config['ELASTICSEARCH_INDEX_NAME']
+ADDRESS_DOC_TYPE = 'address'
+# the completion field written by the importer, see import_addressbase.importing.make_suggest
+SUGGEST_FIELD = 'suggest'
+# the geo_point written by the importer, see import_addressbase.importing.make_location
+LOCATION_FIELD = 'location'
+# written by the importer each time it finishes loading a file
+DATA_GENERATION_DOC_TYPE = 'data_generation'
+DATA_GENERATION_DOC_ID = 'current'
+
+# One client per process. Its urllib3 pools keep connections alive between requests,
+# so it must be created after gunicorn forks the worker (see gunicorn_settings.post_fork).
+_client = None
+_client_lock = threading.Lock()
+_snapshot = None
+
+
+def init_client():
+    """Creates (or recreates) this process's elasticsearch client"""
+    global _client
+    with _client_lock:
+        _client = Elasticsearch(
+            [ELASTICSEARCH_ENDPOINT],
+            maxsize=ELASTICSEARCH_MAX_CONNECTIONS,
+            timeout=ELASTICSEARCH_TIMEOUT_SECONDS,
+            max_retries=ELASTICSEARCH_MAX_RETRIES,
+            retry_on_timeout=ELASTICSEARCH_RETRY_ON_TIMEOUT,
+        )
+    return _client
+
+
+def get_client():
+    return _client or init_client()
+
+
+def get_pool_stats() -> List[Dict[str, Any]]:
+    """Returns usage figures for each node's connection pool.
+    'in_use' reaching 'maxsize' means requests are waiting for a free connection.
+    """
+    if _client is None:
+        return []
+    stats = []
+    for connection in _client.transport.connection_pool.connections:
+        pool = connection.pool
+        # the urllib3 queue holds idle connections plus placeholders for ones not yet opened
+        available = pool.pool.qsize() if pool.pool is not None else ELASTICSEARCH_MAX_CONNECTIONS
+        stats.append({
+            'host': connection.host,
+            'maxsize': ELASTICSEARCH_MAX_CONNECTIONS,
+            'connections_opened': pool.num_connections,
+            'requests': pool.num_requests,
+            'available': available,
+            'in_use': ELASTICSEARCH_MAX_CONNECTIONS - available,
+        })
+    return stats
 
 
 def _get_start_and_end_indexes(page_number: int, page_size: int) -> Tuple[int, int]:
@@ -15,39 +116,216 @@ def _get_start_and_end_indexes(page_number: int, page_size: int) -> Tuple[int, i
     return start_index, end_index
 
 
+def get_postcode_snapshot() -> Optional[PostcodeSnapshot]:
+    """Returns the memory-mapped postcode snapshot, reopening it if the importer has replaced it.
+    Returns None when no snapshot is configured or the file isn't there.
+    """
+    global _snapshot
+    if not POSTCODE_SNAPSHOT_FILE_PATH:
+        return None
+    if _snapshot is None or _snapshot.is_stale():
+        if not os.path.isfile(POSTCODE_SNAPSHOT_FILE_PATH):
+            return None
+        # the old mapping is left for the garbage collector, a concurrent request may still be reading it
+        _snapshot = PostcodeSnapshot(POSTCODE_SNAPSHOT_FILE_PATH)
+        LOGGER.info('Opened postcode snapshot {}'.format(POSTCODE_SNAPSHOT_FILE_PATH))
+    return _snapshot
+
+
 # TODO: write integration tests for this module
-def get_addresses_for_postcode(postcode: str, page_number: int, page_size: int):
-    search = create_search('address_by_postcode')
-    query = search.query("term", postcode=postcode.upper()).sort(
-        {'thoroughfare_name': {'missing': '_last'}},
-        {'dependent_thoroughfare_name': {'missing': '_last'}},
-        {'building_number': {'missing': '_last', 'order': 'asc'}},
-        {'building_name': {'missing': '_last'}},
-        {'sub_building_name': {'missing': '_last'}},
-    )
+def get_addresses_for_postcode(postcode: str, page_number: int, page_size: int, fields: List[str] = None):
+    """fields limits the address fields elasticsearch returns; the snapshot always returns them all"""
+    snapshot = get_postcode_snapshot()
+    if snapshot is not None:
+        start_index, end_index = _get_start_and_end_indexes(page_number, page_size)
+        addresses, total = snapshot.get_addresses(postcode, start_index, end_index)
+        return AddressHits([{'_source': address} for address in addresses], total)
+
+    return _execute(_postcode_search(postcode, page_number, page_size), fields)
+
+
+def get_addresses_for_phrase(phrase: str, page_number: int, page_size: int, fields: List[str] = None):
+    return _execute(_phrase_search(phrase, page_number, page_size), fields)
+
+
+def _execute(search, fields: List[str] = None) -> AddressHits:
+    """Runs the search with the plain client rather than Search.execute(), which wraps every hit
+    in elasticsearch_dsl Result objects that are only unpacked again by the server
+    """
+    return _to_address_hits(_search(_search_body(search, fields), SEARCH_FILTER_PATH))
+
+
+def _search(body: Dict[str, Any], filter_path: str) -> Dict[str, Any]:
+    metrics.note_query(body)
+    started = time.perf_counter()
+    response = get_client().search(index=INDEX_NAME, doc_type=ADDRESS_DOC_TYPE, body=body,
+                                    params={'filter_path': filter_path})
+    _record_elasticsearch_time(time.perf_counter() - started, response.get('took', 0))
+    return response
+
+
+def _record_elasticsearch_time(call_seconds: float, took_milliseconds: int) -> None:
+    """Splits a client call's time into what elasticsearch reports taking and the rest,
+    which is mostly the network and decoding the response
+    """
+    took_seconds = took_milliseconds / 1000
+    metrics.record_stage('elasticsearch', took_seconds)
+    metrics.record_stage('transport', max(call_seconds - took_seconds, 0.0))
+
+
+def _search_body(search, fields: List[str] = None) -> Dict[str, Any]:
+    with metrics.timed('query_build'):
+        body = search.to_dict()
+    body['_source'] = fields or ADDRESS_FIELDS
+    return body
+
+
+def _to_address_hits(response: Dict[str, Any]) -> AddressHits:
+    # filter_path leaves out 'hits.hits' altogether when nothing matched
+    hits = response['hits']
+    return AddressHits(hits.get('hits', []), hits['total'])
+
+
+def get_addresses_for_queries(queries: List[Tuple[str, str, int, int]]) -> List[Tuple[Any, Optional[str]]]:
+    """Runs (kind, term, page_number, page_size) queries as elasticsearch multi-searches,
+    MSEARCH_CHUNK_SIZE at a time. Returns a (hits, error) pair for each query, in order.
+    """
+    results = [None] * len(queries)  # type: List[Tuple[Any, Optional[str]]]
+    searches = []  # type: List[Tuple[int, Any]]
+    snapshot = get_postcode_snapshot()
+    for position, (kind, term, page_number, page_size) in enumerate(queries):
+        if kind == POSTCODE_QUERY and snapshot is not None:
+            results[position] = (get_addresses_for_postcode(term, page_number, page_size), None)
+        elif kind == POSTCODE_QUERY:
+            searches.append((position, _postcode_search(term, page_number, page_size)))
+        else:
+            searches.append((position, _phrase_search(term, page_number, page_size)))
+
+    for chunk_start in range(0, len(searches), MSEARCH_CHUNK_SIZE):
+        chunk = searches[chunk_start:chunk_start + MSEARCH_CHUNK_SIZE]
+        body = []  # type: List[Dict[str, Any]]
+        for _, search in chunk:
+            body += [{}, _search_body(search)]
+            metrics.note_query(body[-1])
+        started = time.perf_counter()
+        responses = get_client().msearch(body=body, index=INDEX_NAME, doc_type=ADDRESS_DOC_TYPE,
+                                         params={'filter_path': MSEARCH_FILTER_PATH})['responses']
+        # the searches run side by side, so the slowest is elasticsearch's time for the chunk
+        _record_elasticsearch_time(time.perf_counter() - started,
+                                   max(response.get('took', 0) for response in responses) if responses else 0)
+        for (position, _), response in zip(chunk, responses):
+            if 'error' in response:
+                results[position] = (None, str(response['error']))
+            else:
+                results[position] = (_to_address_hits(response), None)
+    return results
+
+
+def get_addresses_after(kind: str, term: str, after: Optional[List[Any]], page_size: int,
+                        fields: List[str] = None) -> AddressHits:
+    """Returns the page_size addresses that sort after the hit whose sort values are 'after'
+    (from the start if it is None). Each hit includes its 'sort' values for fetching the next page,
+    and the total is the number of hits remaining. Unlike paging by number this costs the same however
+    far into the results it is and isn't limited to MAX_NUMBER_SEARCH_RESULTS.
+    Always uses elasticsearch, as the postcode snapshot has no sort values.
+    """
+    if kind == POSTCODE_QUERY:
+        search, sort = _postcode_search(term, 0, page_size, tie_break=True), POSTCODE_SORT
+    else:
+        search, sort = _phrase_search(term, 0, page_size, tie_break=True), PHRASE_SORT
+    body = _search_body(search, fields)
+    if after is not None:
+        sort_fields = [list(sort_dict.keys())[0] for sort_dict in sort + [TIE_BREAK_SORT]]
+        if len(after) != len(sort_fields):
+            raise ValueError('Expected {} sort values'.format(len(sort_fields)))
+        body['query'] = {'filtered': {'query': body['query'], 'filter': _after_filter(sort_fields, after)}}
+    return _to_address_hits(_search(body, SEARCH_FILTER_PATH + ',hits.hits.sort'))
+
+
+def _is_missing_sort_value(field: str, value: Any) -> bool:
+    # elasticsearch reports a missing string as null and a missing number as the type's maximum value
+    return value is None or (field in NUMERIC_SORT_FIELDS and value >= MISSING_INTEGER_SORT_VALUE)
+
+
+def _after_filter(sort_fields: List[str], after: List[Any]) -> Dict[str, Any]:
+    """Builds a filter matching the hits which sort after the given sort values. All the sorts
+    are ascending with missing values last, so a hit comes after if, for some field, the earlier
+    fields are equal and that field is greater, where any value is less than a missing one.
+    """
+    def equal_to(field, value):
+        return {'missing': {'field': field}} if _is_missing_sort_value(field, value) else {'term': {field: value}}
+
+    alternatives = []  # type: List[Dict[str, Any]]
+    for position, (field, value) in enumerate(zip(sort_fields, after)):
+        if not _is_missing_sort_value(field, value):
+            greater_than = {'or': [{'range': {field: {'gt': value}}}, {'missing': {'field': field}}]}
+            equal_before = [equal_to(f, v) for f, v in zip(sort_fields[:position], after[:position])]
+            alternatives.append({'and': equal_before + [greater_than]} if equal_before else greater_than)
+    # nothing comes after a hit with every value missing except by _uid, which is never missing
+    return {'or': alternatives} if alternatives else {'not': {'match_all': {}}}
+
+
+def _postcode_search(postcode: str, page_number: int, page_size: int, tie_break: bool = False):
+    search = create_search(ADDRESS_DOC_TYPE)
+    query = search.query("term", postcode=postcode.upper()).sort(*(POSTCODE_SORT + _tie_break_sort(tie_break)))
     start_index, end_index = _get_start_and_end_indexes(page_number, page_size)
-    return query[start_index:end_index].execute().hits
-
-
-def get_addresses_for_phrase(phrase: str, page_number: int, page_size: int):
-    search = create_search('address_by_joined_fields')
-    query = search.filter('term', joined_fields=phrase.lower()).sort(
-        {'sub_building_name': {'missing': '_last'}},
-        {'building_name': {'missing': '_last'}},
-        {'building_number': {'missing': '_last'}},
-        {'dependent_thoroughfare_name': {'missing': '_last'}},
-        {'thoroughfare_name': {'missing': '_last'}},
-    )
+    return query[start_index:end_index]
+
+
+def _phrase_search(phrase: str, page_number: int, page_size: int, tie_break: bool = False):
+    search = create_search(ADDRESS_DOC_TYPE)
+    query = search.filter('term', joined_fields=phrase.lower()).sort(*(PHRASE_SORT + _tie_break_sort(tie_break)))
     start_index, end_index = _get_start_and_end_indexes(page_number, page_size)
-    return query[start_index:end_index].execute().hits
+    return query[start_index:end_index]
+
+
+def _tie_break_sort(tie_break: bool) -> List[Dict[str, Dict[str, str]]]:
+    return [TIE_BREAK_SORT] if tie_break else []
+
+
+def get_addresses_near(x_coordinate: float, y_coordinate: float, radius: float, page_number: int, page_size: int,
+                       fields: List[str] = None) -> AddressHits:
+    """Returns the addresses within radius metres of the National Grid point, nearest first.
+    The filter checks the indexed latitude and longitude against the circle's bounding box
+    before working out any distances, so its cost depends on the radius rather than the index size.
+    """
+    return _execute(_near_search(x_coordinate, y_coordinate, radius, page_number, page_size), fields)
+
+
+def _near_search(x_coordinate: float, y_coordinate: float, radius: float, page_number: int, page_size: int):
+    latitude, longitude = to_latitude_longitude(x_coordinate, y_coordinate)
+    point = {'lat': latitude, 'lon': longitude}
+    search = create_search(ADDRESS_DOC_TYPE)
+    query = search.filter(
+        'geo_distance', distance='{}m'.format(radius), optimize_bbox='indexed', **{LOCATION_FIELD: point}
+    ).sort({'_geo_distance': {LOCATION_FIELD: point, 'order': 'asc', 'unit': 'm'}})
+    start_index, end_index = _get_start_and_end_indexes(page_number, page_size)
+    return query[start_index:end_index]
 
 
 def create_search(doc_type: str):
-    client = Elasticsearch([ELASTICSEARCH_ENDPOINT])
-    search = Search(using=client, index='address-search-api-index', doc_type=doc_type)
+    search = Search(using=get_client(), index=INDEX_NAME, doc_type=doc_type)
     search = search[0:MAX_NUMBER_SEARCH_RESULTS]
     return search
 
 
+def get_suggestions(prefix: str, size: int) -> List[Dict[str, str]]:
+    """Returns up to size addresses with a part starting with prefix, from the completion
+    suggester's in-memory prefix structure rather than a search
+    """
+    body = {'address': {'text': prefix, 'completion': {'field': SUGGEST_FIELD, 'size': size}}}
+    response = get_client().suggest(index=INDEX_NAME, body=body, params={'request_timeout': SUGGEST_TIMEOUT_SECONDS})
+    return [{'uprn': option['payload']['uprn'], 'address': option['text']} for option in response['address'][0]['options']]
+
+
 def get_info():
-    return Elasticsearch([ELASTICSEARCH_ENDPOINT]).info()
+    return get_client().info()
+
+
+def get_data_generation() -> Optional[str]:
+    """Returns the generation of the data last imported, or None if nothing has recorded one"""
+    try:
+        doc = get_client().get(index=INDEX_NAME, doc_type=DATA_GENERATION_DOC_TYPE, id=DATA_GENERATION_DOC_ID)
+    except NotFoundError:
+        return None
+    return doc['_source']['generation']
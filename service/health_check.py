@@ -0,0 +1,80 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+
+class HealthChecker(object):
+    """Runs a health check every interval_seconds on a background thread, so that /health can answer
+    from the last result without going to elasticsearch. With an interval of 0 there is no thread
+    and every status() runs the check.
+
+    The thread is started by the first status() in each process, as threads don't survive gunicorn's fork.
+    A result older than stale_after_seconds counts as an error, in case the thread has stopped or hung.
+    """
+
+    def __init__(self, check: Callable[[], List[str]], interval_seconds: float, stale_after_seconds: float) -> None:
+        self._check = check
+        self.interval_seconds = interval_seconds
+        self.stale_after_seconds = stale_after_seconds
+        self._lock = threading.Lock()
+        # held by the request running a process's first check, which the others wait for
+        self._start_lock = threading.Lock()
+        self._pid = None  # type: Optional[int]
+        self._stopped = threading.Event()
+        self._errors = []  # type: List[str]
+        self._checked_at = None  # type: Optional[float]
+        self._latency_seconds = None  # type: Optional[float]
+
+    def run_check(self) -> None:
+        started_at = time.monotonic()
+        try:
+            errors = self._check()
+        except Exception as e:
+            errors = ['Health check failed: {}'.format(e)]
+        finished_at = time.monotonic()
+        with self._lock:
+            self._errors = errors
+            self._checked_at = finished_at
+            self._latency_seconds = finished_at - started_at
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval_seconds):
+            self.run_check()
+
+    def _ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # the first status has to wait for a real result, and so do any that come in while it runs.
+            # _pid is only set once there is one.
+            self._stopped.clear()
+            self.run_check()
+            threading.Thread(target=self._run, name='health-checker', daemon=True).start()
+            self._pid = os.getpid()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def status(self, deep: bool = False) -> Dict[str, Any]:
+        """Returns the last check's result. A deep status runs a fresh check first."""
+        if deep or self.interval_seconds <= 0:
+            self.run_check()
+        else:
+            self._ensure_started()
+        with self._lock:
+            errors = list(self._errors)
+            age_seconds = time.monotonic() - self._checked_at
+            latency_seconds = self._latency_seconds
+        if self.interval_seconds > 0 and age_seconds > self.stale_after_seconds:
+            errors.append('The last health check was {:.1f} seconds ago'.format(age_seconds))
+        return {
+            'errors': errors,
+            'last_check_age_seconds': round(age_seconds, 3),
+            'last_check_latency_ms': round(latency_seconds * 1000, 3),
+        }
@@ -0,0 +1,256 @@
+"""Request timings and counts for the search endpoints, and the store /metrics reports them from.
+
+Handling a request records how long each stage took in a thread-local RequestTimings, so that
+es_access can add its own stages without knowing which request it is serving. When the request
+finishes the server adds them to the MetricsStore's histograms.
+
+Each gunicorn worker keeps its histograms in its own memory-mapped file, so whichever worker answers
+/metrics can add up all of them. The file is named after the process and a random token, so a worker
+that gets the pid of one that has exited starts a new file. Files of workers that have exited are still
+counted, which keeps the totals from going backwards. The directory should be emptied when the server starts.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from contextlib import contextmanager
+import glob
+import hashlib
+from itertools import product
+import mmap
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# upper bounds in seconds; each histogram also has a +Inf bucket
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]  # type: List[float]
+
+QUERY_KINDS = ['postcode', 'phrase', 'near', 'suggest', 'batch']  # type: List[str]
+# query_build: turning the elasticsearch_dsl search into a body, elasticsearch: the 'took' elasticsearch
+# reports, transport: the rest of the client call, which is mostly the network and decoding the response,
+# backend: the whole search backend call, shaping: building the response data, encoding: encoding it as JSON
+STAGES = ['query_build', 'elasticsearch', 'transport', 'backend', 'shaping', 'encoding']  # type: List[str]
+# page sizes are counted in these buckets, so a client can't make a series for every number
+PAGE_SIZE_BUCKETS = [10, 20, 50, 100]  # type: List[int]
+NO_PAGE_SIZE = 'none'
+PAGE_SIZE_LABELS = [str(size) for size in PAGE_SIZE_BUCKETS] + ['+Inf', NO_PAGE_SIZE]  # type: List[str]
+
+Histogram = namedtuple('Histogram', ['name', 'help', 'label_names', 'label_values'])
+Counter = namedtuple('Counter', ['name', 'help', 'label_names', 'label_values'])
+
+REQUEST_DURATION = Histogram(
+    'address_search_request_duration_seconds', 'Time taken to answer a search request.',
+    ('kind', 'page_size'), list(product(QUERY_KINDS, PAGE_SIZE_LABELS)),
+)
+STAGE_DURATION = Histogram(
+    'address_search_stage_duration_seconds', 'Time spent in each stage of answering a search request.',
+    ('kind', 'stage'), list(product(QUERY_KINDS, STAGES)),
+)
+HISTOGRAMS = [REQUEST_DURATION, STAGE_DURATION]  # type: List[Histogram]
+
+COALESCED_REQUESTS = Counter(
+    'address_search_coalesced_requests_total',
+    'Searches answered by waiting for an identical search another request was already running.',
+    ('kind',), [(kind,) for kind in QUERY_KINDS],
+)
+COUNTERS = [COALESCED_REQUESTS]  # type: List[Counter]
+
+# a count for each bucket, then one for +Inf, then the sum of the observed values
+VALUES_PER_SERIES = len(DURATION_BUCKETS) + 2
+
+
+def _series_offsets() -> Tuple[Dict[Tuple[str, Tuple[str, ...]], int], int]:
+    """Returns where each series' values are, and how many values there are altogether"""
+    offsets = {}  # type: Dict[Tuple[str, Tuple[str, ...]], int]
+    position = 0
+    for group, size in [(HISTOGRAMS, VALUES_PER_SERIES), (COUNTERS, 1)]:
+        for metric in group:
+            for label_values in metric.label_values:
+                offsets[(metric.name, label_values)] = position
+                position += size
+    return offsets, position
+
+
+SERIES_OFFSETS, NUMBER_OF_VALUES = _series_offsets()
+# files written with a different set of series, by another version of the code, are ignored
+LAYOUT = hashlib.sha1(repr((DURATION_BUCKETS, sorted(SERIES_OFFSETS.items()))).encode('utf-8')).hexdigest()[:12]
+FILE_PATTERN = 'metrics-{}-*.db'
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def page_size_label(page_size: Optional[int]) -> str:
+    if page_size is None:
+        return NO_PAGE_SIZE
+    position = bisect_left(PAGE_SIZE_BUCKETS, page_size)
+    return str(PAGE_SIZE_BUCKETS[position]) if position < len(PAGE_SIZE_BUCKETS) else '+Inf'
+
+
+def clear_metrics_directory(directory: str) -> None:
+    """Removes the files of a previous run, for when the server starts"""
+    if directory:
+        for path in glob.glob(os.path.join(directory, FILE_PATTERN.format('*'))):
+            os.remove(path)
+
+
+class MetricsStore(object):
+    """Histograms of request timings and counters. With a directory they are kept in a file per process
+    and reported for all of them; without one, only this process's are kept and reported.
+    """
+
+    def __init__(self, directory: str = '') -> None:
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None  # type: Optional[int]
+        self._values = None  # type: Any
+
+    def _get_values(self):
+        # the file is made after gunicorn forks the worker, so each process has its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            if self.directory:
+                worker = '{}-{}'.format(self._pid, os.urandom(4).hex())
+                path = os.path.join(self.directory, FILE_PATTERN.format(LAYOUT).replace('*', worker))
+                # never opens an existing file, which would lose another worker's counts
+                with open(path, 'xb+') as file:
+                    file.truncate(NUMBER_OF_VALUES * 8)
+                    self._values = memoryview(mmap.mmap(file.fileno(), NUMBER_OF_VALUES * 8)).cast('d')
+            else:
+                self._values = array('d', bytes(NUMBER_OF_VALUES * 8))
+        return self._values
+
+    def observe(self, histogram: Histogram, label_values: Tuple[str, ...], seconds: float) -> None:
+        offset = SERIES_OFFSETS[(histogram.name, label_values)]
+        with self._lock:
+            values = self._get_values()
+            values[offset + bisect_left(DURATION_BUCKETS, seconds)] += 1
+            values[offset + VALUES_PER_SERIES - 1] += seconds
+
+    def increment(self, counter: Counter, label_values: Tuple[str, ...]) -> None:
+        offset = SERIES_OFFSETS[(counter.name, label_values)]
+        with self._lock:
+            self._get_values()[offset] += 1
+
+    def record(self, timings: 'RequestTimings') -> None:
+        """Adds a finished request's timings to the histograms"""
+        self.observe(REQUEST_DURATION, (timings.kind, page_size_label(timings.page_size)), timings.duration)
+        for stage, seconds in timings.stages.items():
+            self.observe(STAGE_DURATION, (timings.kind, stage), seconds)
+
+    def collect(self) -> array:
+        """Returns the values of every process added together"""
+        with self._lock:
+            totals = array('d', self._get_values())
+        if self.directory:
+            # this process's file is one of them
+            totals = array('d', bytes(NUMBER_OF_VALUES * 8))
+            for path in glob.glob(os.path.join(self.directory, FILE_PATTERN.format(LAYOUT))):
+                values = array('d')
+                with open(path, 'rb') as file:
+                    values.frombytes(file.read())
+                if len(values) == NUMBER_OF_VALUES:
+                    for position, value in enumerate(values):
+                        totals[position] += value
+        return totals
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text format, leaving out series with nothing observed"""
+        values = self.collect()
+        lines = []  # type: List[str]
+        for histogram in HISTOGRAMS:
+            lines += ['# HELP {} {}'.format(histogram.name, histogram.help), '# TYPE {} histogram'.format(histogram.name)]
+            for label_values in histogram.label_values:
+                offset = SERIES_OFFSETS[(histogram.name, label_values)]
+                count = sum(values[offset:offset + VALUES_PER_SERIES - 1])
+                if not count:
+                    continue
+                labels = ','.join('{}="{}"'.format(name, value) for name, value in zip(histogram.label_names, label_values))
+                cumulative = 0.0
+                for position, bound in enumerate(DURATION_BUCKETS + [float('inf')]):
+                    cumulative += values[offset + position]
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{{{},le="{}"}} {:g}'.format(histogram.name, labels, le, cumulative))
+                lines.append('{}_sum{{{}}} {!r}'.format(histogram.name, labels, values[offset + VALUES_PER_SERIES - 1]))
+                lines.append('{}_count{{{}}} {:g}'.format(histogram.name, labels, count))
+        for counter in COUNTERS:
+            lines += ['# HELP {} {}'.format(counter.name, counter.help), '# TYPE {} counter'.format(counter.name)]
+            for label_values in counter.label_values:
+                count = values[SERIES_OFFSETS[(counter.name, label_values)]]
+                if count:
+                    labels = ','.join('{}="{}"'.format(name, value) for name, value in zip(counter.label_names, label_values))
+                    lines.append('{}{{{}}} {:g}'.format(counter.name, labels, count))
+        return '\n'.join(lines) + '\n'
+
+
+class RequestTimings(object):
+    """The stages of one request. Only labelled requests, the searches, are recorded."""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.kind = None  # type: Optional[str]
+        self.page_size = None  # type: Optional[int]
+        self.stages = {}  # type: Dict[str, float]
+        # the elasticsearch query bodies, for the slow query log
+        self.queries = []  # type: List[Any]
+
+
+_local = None  # type: Any
+_local_lock = threading.Lock()
+
+
+def _request_local() -> Any:
+    """The thread-local the timings are kept in. It is made by the first request rather than on import,
+    as a gevent worker only monkey-patches threading.local after post_fork has imported this module,
+    and its greenlets need the patched one to keep their timings apart.
+    """
+    global _local
+    if _local is None:
+        with _local_lock:
+            if _local is None:
+                _local = threading.local()
+    return _local
+
+
+def start_request() -> RequestTimings:
+    timings = RequestTimings()
+    _request_local().timings = timings
+    return timings
+
+
+def finish_request() -> Optional[RequestTimings]:
+    local = _request_local()
+    timings = getattr(local, 'timings', None)
+    local.timings = None
+    if timings is not None:
+        timings.duration = time.perf_counter() - timings.started
+    return timings
+
+
+def label_request(kind: str, page_size: int = None) -> None:
+    timings = getattr(_request_local(), 'timings', None)
+    if timings is not None:
+        timings.kind = kind
+        timings.page_size = page_size
+
+
+def record_stage(stage: str, seconds: float) -> None:
+    """Adds to the time spent in a stage; it does nothing outside a request"""
+    timings = getattr(_request_local(), 'timings', None)
+    if timings is not None:
+        timings.stages[stage] = timings.stages.get(stage, 0.0) + seconds
+
+
+def note_query(body: Any) -> None:
+    timings = getattr(_request_local(), 'timings', None)
+    if timings is not None:
+        timings.queries.append(body)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
@@ -0,0 +1,20 @@
+"""Chooses the module that searches are run against, using the SEARCH_BACKEND setting.
+
+A backend is a module with the functions the server calls on es_access:
+get_addresses_for_postcode, get_addresses_for_phrase, get_addresses_for_queries,
+get_addresses_after, get_info, get_data_generation and get_pool_stats.
+"""
+
+from service import app, es_access, sqlite_access
+
+SEARCH_BACKENDS = {
+    'elasticsearch': es_access,
+    'sqlite': sqlite_access,
+}
+
+
+def get_search_backend(name: str = None):
+    name = name or app.config['SEARCH_BACKEND']
+    if name not in SEARCH_BACKENDS:
+        raise ValueError('Unknown search backend: {}'.format(name))
+    return SEARCH_BACKENDS[name]
@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SearchResultCache(object):
+    """A bounded LRU cache of search results for one worker process.
+
+    Entries expire after ttl_seconds and the whole cache is dropped whenever the data
+    generation written by the importer changes, so results never outlive an import.
+    The generation is looked up at most once every generation_check_seconds. If the lookup
+    fails, the last known generation is kept until the next check is due.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, generation_check_seconds: float,
+                 get_generation: Callable[[], Optional[str]]) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.generation_check_seconds = generation_check_seconds
+        self._get_generation = get_generation
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+        self._generation = None  # type: Optional[str]
+        self._generation_checked_at = None  # type: Optional[float]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.generation_check_errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        self._check_generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def generation(self) -> Optional[str]:
+        """The data generation the cached results belong to, looked up at most once every
+        generation_check_seconds. Unlike get, this works with the cache turned off.
+        """
+        self._check_generation()
+        return self._generation
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'generation_check_errors': self.generation_check_errors,
+                'generation': self._generation,
+            }
+
+    def _check_generation(self) -> None:
+        now = time.monotonic()
+        checked_at = self._generation_checked_at
+        if checked_at is not None and now - checked_at < self.generation_check_seconds:
+            return
+        try:
+            generation = self._get_generation()
+        except Exception as e:
+            # searches can still be answered; keep what is cached and try again after the interval
+            LOGGER.warning('Could not look up the data generation: {}'.format(e))
+            with self._lock:
+                self.generation_check_errors += 1
+                self._generation_checked_at = now
+            return
+        with self._lock:
+            if checked_at is not None and generation != self._generation:
+                self._entries.clear()
+                self.invalidations += 1
+            self._generation = generation
+            self._generation_checked_at = now
@@ -1,22 +1,105 @@
+import base64
 from flask import jsonify, Response, request  # type: ignore
+import gzip
+import hashlib
 import json
 import logging
 import logging.config  # type: ignore
 import math
-from typing import Any, Dict, List, Union
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
 
-from service import app, es_access
+from service import app, es_access, metrics
+from service.health_check import HealthChecker
+from service.search_backends import get_search_backend
+from service.search_cache import SearchResultCache
+from service.single_flight import SingleFlight
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
 
 MAX_NUMBER_SEARCH_RESULTS = int(app.config['MAX_NUMBER_SEARCH_RESULTS'])
 SEARCH_RESULTS_PER_PAGE = int(app.config['SEARCH_RESULTS_PER_PAGE'])
+MAX_BATCH_SEARCH_QUERIES = int(app.config['MAX_BATCH_SEARCH_QUERIES'])
+SUGGEST_SIZE = int(app.config['SUGGEST_SIZE'])
+# shorter prefixes match too much to be useful, so are answered without a lookup
+SUGGEST_MIN_PREFIX_LENGTH = 2
+SUGGEST_QUERY = 'suggest'
+BATCH_QUERY = 'batch'
+MAX_NEAR_RADIUS_METRES = float(app.config['MAX_NEAR_RADIUS_METRES'])
+DEFAULT_NEAR_RADIUS_METRES = 100.0
+
+# named sets of address fields for the fields parameter of /search. 'full' is the same as leaving it out.
+FIELD_PRESETS = {
+    'label': ['uprn', 'joined_fields'],
+    'full': None,
+}  # type: Dict[str, Optional[List[str]]]
+
+# searches taking at least this long are logged with their elasticsearch queries; 0 logs none
+SLOW_QUERY_LOG_THRESHOLD_SECONDS = float(app.config['SLOW_QUERY_LOG_THRESHOLD_MS']) / 1000
+SLOW_QUERY_LOGGER = logging.getLogger('service.slow_queries')
+
+# /search responses are compressed when the client accepts it, unless they are too small to gain anything
+COMPRESSION_MIN_BYTES = 256
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# 0 makes clients and CDNs revalidate every time, which the ETag makes cheap
+SEARCH_RESPONSE_MAX_AGE_SECONDS = int(app.config['SEARCH_RESPONSE_MAX_AGE_SECONDS'])
+POSTCODE_SNAPSHOT_FILE_PATH = app.config['POSTCODE_SNAPSHOT_FILE_PATH']
 
 INTERNAL_SERVER_ERROR_RESPONSE_BODY = json.dumps({'error': 'Internal server error'})
 JSON_CONTENT_TYPE = 'application/json'
 LOGGER = logging.getLogger(__name__)
 
+search_backend = get_search_backend()
+
+SEARCH_CACHE = SearchResultCache(
+    max_entries=int(app.config['SEARCH_CACHE_MAX_ENTRIES']),
+    ttl_seconds=float(app.config['SEARCH_CACHE_TTL_SECONDS']),
+    generation_check_seconds=float(app.config['DATA_GENERATION_CHECK_SECONDS']),
+    get_generation=search_backend.get_data_generation,
+)
+
+# identical searches running at the same time in this worker share one backend call
+IN_FLIGHT_SEARCHES = SingleFlight()
+
+HEALTH_CHECKER = HealthChecker(
+    check=lambda: _check_elasticsearch_connection(),
+    interval_seconds=float(app.config['HEALTH_CHECK_INTERVAL_SECONDS']),
+    stale_after_seconds=float(app.config['HEALTH_CHECK_STALE_SECONDS']),
+)
+
+METRICS = metrics.MetricsStore(app.config['METRICS_DIRECTORY'])
+
 ADDRESS_NOT_FOUND_RESPONSE = Response(json.dumps({'error': 'Address not found'}), status=404, mimetype=JSON_CONTENT_TYPE)
 
 
+@app.before_request
+def start_request_timings():
+    metrics.start_request()
+
+
+@app.after_request
+def record_request_timings(response: Response) -> Response:
+    timings = metrics.finish_request()
+    if timings is not None and timings.kind is not None:
+        METRICS.record(timings)
+        if SLOW_QUERY_LOG_THRESHOLD_SECONDS and timings.duration >= SLOW_QUERY_LOG_THRESHOLD_SECONDS:
+            _log_slow_query(timings)
+    return response
+
+
+def _log_slow_query(timings: metrics.RequestTimings) -> None:
+    SLOW_QUERY_LOGGER.warning('Slow search: {}'.format(json.dumps({
+        'request': request.full_path,
+        'duration_ms': round(timings.duration * 1000, 1),
+        'stages_ms': {stage: round(seconds * 1000, 1) for stage, seconds in timings.stages.items()},
+        'queries': timings.queries,
+    }, sort_keys=True)))
+
+
 @app.errorhandler(Exception)
 def handle_server_error(error: BaseException):
     LOGGER.error('An error occurred when processing a request', exc_info=error)
@@ -27,20 +110,43 @@ def handle_server_error(error: BaseException):
 @app.route('/', methods=['GET'])
 @app.route('/health', methods=['GET'])
 def healthcheck():
-    errors = _check_elasticsearch_connection()
+    """Answers from the last background check, so probes don't add load on elasticsearch"""
+    return _health_response(HEALTH_CHECKER.status())
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics() -> Response:
+    """Search timing histograms for all the workers, in the Prometheus text format"""
+    return Response(METRICS.render(), mimetype=metrics.CONTENT_TYPE)
+
+
+@app.route('/health/deep', methods=['GET'])
+def deep_healthcheck():
+    """Checks elasticsearch now, for when the cached status isn't enough"""
+    return _health_response(HEALTH_CHECKER.status(deep=True))
+
+
+def _health_response(health: Dict[str, Any]) -> Response:
+    errors = health['errors']
     status = 'error' if errors else 'ok'
     http_status = 500 if errors else 200
 
-    response_body = {'status': status}
+    response_body = {
+        'status': status,
+        'elasticsearch_pool': search_backend.get_pool_stats(),
+        'last_check_age_seconds': health['last_check_age_seconds'],
+        'last_check_latency_ms': health['last_check_latency_ms'],
+    }
     if errors:
         response_body['errors'] = errors
 
     return Response(json.dumps(response_body), status=http_status, mimetype=JSON_CONTENT_TYPE)
 
 
-def paginated_address_records(address_records, page_number: int, page_size: int) -> Dict[str, Union[List[Dict[str, Any]], int]]:
+def paginated_address_records(address_records, page_number: int, page_size: int,
+                              fields: List[str] = None) -> Dict[str, Union[List[Dict[str, Any]], int]]:
     if address_records:
-        address_dicts = [hit['_source'] for hit in address_records.hits]
+        address_dicts = [_project(hit['_source'], fields) for hit in address_records.hits]
         nof_results = min(address_records.total, MAX_NUMBER_SEARCH_RESULTS)
         nof_pages = math.ceil(nof_results / page_size)  # 0 if no results
         page_number = min(page_number, nof_pages - 1) if nof_pages > 0 else 0  # 0 indexed
@@ -49,27 +155,318 @@ def paginated_address_records(address_records, page_number: int, page_size: int)
     return {'addresses': address_dicts, 'total': nof_results, 'page_number': page_number, 'page_size': page_size}
 
 
+def _project(address: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    if fields is None:
+        return address
+    return {field: address[field] for field in fields if field in address}
+
+
+def _parse_fields(fields_parameter: Optional[str]) -> Optional[List[str]]:
+    """Turns the fields parameter, a preset name or comma separated field names, into a list
+    of address fields. Returns None for all fields.
+    """
+    if not fields_parameter:
+        return None
+    if fields_parameter in FIELD_PRESETS:
+        return FIELD_PRESETS[fields_parameter]
+    fields = [field.strip() for field in fields_parameter.split(',') if field.strip()]
+    unknown_fields = [field for field in fields if field not in es_access.ADDRESS_FIELDS]
+    if unknown_fields or not fields:
+        raise ValueError('Unknown fields: {}'.format(', '.join(unknown_fields) or fields_parameter))
+    return fields
+
+
+def _cache_key(kind: str, term: str, page_number: int, page_size: int,
+               fields: List[str] = None) -> Tuple[str, str, int, int, Optional[Tuple[str, ...]]]:
+    normalised_term = term.upper() if kind == es_access.POSTCODE_QUERY else term.lower()
+    return kind, normalised_term, page_number, page_size, tuple(fields) if fields is not None else None
+
+
+def _parse_near(near: str, radius_parameter: Optional[str]) -> Tuple[float, float, float]:
+    """Turns the near parameter, an 'x,y' National Grid point, and the radius in metres
+    into (x_coordinate, y_coordinate, radius)
+    """
+    try:
+        x_coordinate, y_coordinate = (float(value) for value in near.split(','))
+        radius = float(radius_parameter) if radius_parameter else DEFAULT_NEAR_RADIUS_METRES
+    except ValueError:
+        raise ValueError('near must be x,y coordinates and radius a number of metres')
+    if not all(math.isfinite(value) for value in (x_coordinate, y_coordinate, radius)):
+        raise ValueError('near must be x,y coordinates and radius a number of metres')
+    if not 0 < radius <= MAX_NEAR_RADIUS_METRES:
+        raise ValueError('radius must be more than 0 and at most {:g} metres'.format(MAX_NEAR_RADIUS_METRES))
+    return x_coordinate, y_coordinate, radius
+
+
 @app.route('/search', methods=['GET'])
 def get_search_results() -> str:
     phrase = request.args.get('phrase')
     postcode = request.args.get('postcode')
+    near = request.args.get('near')
     page_number = int(request.args.get('page_number', 0))
     page_size = int(request.args.get('page_size', SEARCH_RESULTS_PER_PAGE))
 
     if phrase:
-        address_records = es_access.get_addresses_for_phrase(phrase, page_number, page_size)
+        kind, search_term = es_access.PHRASE_QUERY, phrase.strip()
+        search_function = search_backend.get_addresses_for_phrase
     elif postcode:
-        address_records = es_access.get_addresses_for_postcode(postcode, page_number, page_size)
+        kind, search_term = es_access.POSTCODE_QUERY, postcode.strip()
+        search_function = search_backend.get_addresses_for_postcode
+    elif near:
+        try:
+            x_coordinate, y_coordinate, radius = _parse_near(near, request.args.get('radius'))
+        except ValueError as e:
+            return Response(json.dumps({'errors': str(e)}), status=400, mimetype=JSON_CONTENT_TYPE)
+        kind, search_term = es_access.NEAR_QUERY, '{!r},{!r},{!r}'.format(x_coordinate, y_coordinate, radius)
+
+        def search_function(term, page_number, page_size, fields=None):
+            return search_backend.get_addresses_near(x_coordinate, y_coordinate, radius, page_number, page_size,
+                                                     fields=fields)
     else:
         return jsonify({'errors': 'No parameters provided for searching'})
-    result = paginated_address_records(address_records, page_number, page_size)
-    return jsonify({'data': result})
+
+    try:
+        fields = _parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return Response(json.dumps({'errors': str(e)}), status=400, mimetype=JSON_CONTENT_TYPE)
+
+    metrics.label_request(kind, page_size)
+    if 'cursor' in request.args:
+        if kind == es_access.NEAR_QUERY:
+            return Response(json.dumps({'errors': 'Cursor paging is not supported for near searches'}),
+                            status=400, mimetype=JSON_CONTENT_TYPE)
+        return _get_search_results_after_cursor(kind, search_term, request.args['cursor'], page_size, fields)
+
+    cache_key = _cache_key(kind, search_term, page_number, page_size, fields)
+    etag = _search_etag(cache_key)
+    if etag is not None:
+        matching_etag = _matching_etag(etag)
+        if matching_etag is not None:
+            return _not_modified_response(matching_etag)
+
+    result = SEARCH_CACHE.get(cache_key)
+    if result is None:
+        def search():
+            with metrics.timed('backend'):
+                address_records = search_function(search_term, page_number, page_size, fields=fields)
+            with metrics.timed('shaping'):
+                search_result = paginated_address_records(address_records, page_number, page_size, fields)
+            SEARCH_CACHE.put(cache_key, search_result)
+            return search_result
+
+        result, shared = IN_FLIGHT_SEARCHES.run(cache_key, search)
+        if shared:
+            METRICS.increment(metrics.COALESCED_REQUESTS, (kind,))
+    return _search_response({'data': result}, etag)
+
+
+def _search_etag(cache_key: Tuple) -> Optional[str]:
+    """An ETag for a search's results, known before searching: they only change when an import writes
+    a new data generation. The generation is only looked up when the cache or the postcode snapshot
+    already keeps track of it. Returns None otherwise, or if it can't be found, and the response is
+    tagged with a hash of its body instead.
+    """
+    if not (SEARCH_CACHE.enabled or POSTCODE_SNAPSHOT_FILE_PATH):
+        return None
+    try:
+        generation = SEARCH_CACHE.generation()
+    except Exception as e:
+        LOGGER.warning('Could not look up the data generation for an ETag: {}'.format(e))
+        return None
+    if generation is None:
+        return None
+    return hashlib.sha1(json.dumps([generation, cache_key]).encode('utf-8')).hexdigest()
+
+
+def _encoded_etag(etag: str, encoding: Optional[str]) -> str:
+    # each encoding is a different representation, so it needs its own strong ETag
+    return '{}-{}'.format(etag, encoding) if encoding else etag
+
+
+def _matching_etag(etag: str) -> Optional[str]:
+    """Returns whichever of the search's ETags the client's If-None-Match has, if any. The comparison
+    is weak, as If-None-Match's is meant to be, so a CDN's W/ version of the tag matches too.
+    """
+    for encoding in [None, 'gzip', 'br']:
+        encoded_etag = _encoded_etag(etag, encoding)
+        if request.if_none_match.contains_weak(encoded_etag):
+            return encoded_etag
+    return None
+
+
+def _set_caching_headers(response: Response) -> None:
+    response.headers['Vary'] = 'Accept-Encoding'
+    if SEARCH_RESPONSE_MAX_AGE_SECONDS > 0:
+        response.headers['Cache-Control'] = 'public, max-age={}'.format(SEARCH_RESPONSE_MAX_AGE_SECONDS)
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'
+
+
+def _not_modified_response(etag: str) -> Response:
+    response = Response(status=304)
+    response.set_etag(etag)
+    _set_caching_headers(response)
+    return response
+
+
+def _search_response(body: Dict[str, Any], etag: Optional[str] = None) -> Response:
+    """Encodes a /search response as JSON, compressed with brotli or gzip if the client accepts either.
+    Without an etag it is tagged with a hash of the JSON, and a client that already has it gets a 304.
+    """
+    with metrics.timed('encoding'):
+        response = jsonify(body)
+        data = response.get_data()
+        if etag is None:
+            etag = hashlib.sha1(data).hexdigest()
+            matching_etag = _matching_etag(etag)
+            if matching_etag is not None:
+                return _not_modified_response(matching_etag)
+        encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+        encoding = request.accept_encodings.best_match(encodings) if len(data) >= COMPRESSION_MIN_BYTES else None
+        if encoding == 'br':
+            response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+        elif encoding == 'gzip':
+            response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.set_etag(_encoded_etag(etag, encoding))
+        _set_caching_headers(response)
+    return response
+
+
+@app.route('/suggest', methods=['GET'])
+def get_suggestions() -> Response:
+    """Typeahead suggestions: a fixed number of addresses with a part starting with the prefix"""
+    prefix = request.args.get('prefix', '').strip()
+    if not prefix:
+        return Response(json.dumps({'errors': 'No prefix provided'}), status=400, mimetype=JSON_CONTENT_TYPE)
+    if len(prefix) < SUGGEST_MIN_PREFIX_LENGTH:
+        return jsonify({'suggestions': []})
+
+    metrics.label_request(SUGGEST_QUERY)
+    cache_key = (SUGGEST_QUERY, prefix.lower())
+    suggestions = SEARCH_CACHE.get(cache_key)
+    if suggestions is None:
+        with metrics.timed('backend'):
+            suggestions = search_backend.get_suggestions(prefix, SUGGEST_SIZE)
+        SEARCH_CACHE.put(cache_key, suggestions)
+    with metrics.timed('encoding'):
+        return jsonify({'suggestions': suggestions})
+
+
+def _encode_cursor(kind: str, sort_values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps([kind, sort_values]).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(kind: str, cursor: str) -> Optional[List[Any]]:
+    """Returns the sort values in the cursor, or None for an empty cursor (the first page)"""
+    if not cursor:
+        return None
+    try:
+        cursor_kind, sort_values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if cursor_kind != kind or not isinstance(sort_values, list):
+        raise ValueError('Invalid cursor')
+    return sort_values
+
+
+def _get_search_results_after_cursor(kind: str, search_term: str, cursor: str, page_size: int,
+                                     fields: List[str] = None) -> Response:
+    """Pages through the results using the sort values of the last address on the previous page.
+    An empty cursor gets the first page; next_cursor is null on the last page.
+    """
+    page_size = min(page_size, MAX_NUMBER_SEARCH_RESULTS)
+    try:
+        after = _decode_cursor(kind, cursor)
+        with metrics.timed('backend'):
+            address_records = search_backend.get_addresses_after(kind, search_term, after, page_size, fields)
+    except ValueError as e:
+        return Response(json.dumps({'errors': str(e)}), status=400, mimetype=JSON_CONTENT_TYPE)
+
+    with metrics.timed('shaping'):
+        hits = address_records.hits
+        next_cursor = _encode_cursor(kind, hits[-1]['sort']) if len(hits) == page_size else None
+        result = {
+            'addresses': [_project(hit['_source'], fields) for hit in hits],
+            'remaining': address_records.total,
+            'page_size': page_size,
+            'next_cursor': next_cursor,
+        }
+    return _search_response({'data': result})
+
+
+def _parse_batch_query(query: Any) -> Tuple[str, str, int, int]:
+    """Turns one item of a batch search request into (kind, term, page_number, page_size)"""
+    if not isinstance(query, dict):
+        raise ValueError('Query must be an object')
+    phrase = query.get('phrase')
+    postcode = query.get('postcode')
+    if phrase and isinstance(phrase, str):
+        kind, term = es_access.PHRASE_QUERY, phrase.strip()
+    elif postcode and isinstance(postcode, str):
+        kind, term = es_access.POSTCODE_QUERY, postcode.strip()
+    else:
+        raise ValueError('No parameters provided for searching')
+    try:
+        page_number = int(query.get('page_number', 0))
+        page_size = int(query.get('page_size', SEARCH_RESULTS_PER_PAGE))
+    except (TypeError, ValueError):
+        raise ValueError('page_number and page_size must be integers')
+    return kind, term, page_number, page_size
+
+
+@app.route('/search/batch', methods=['POST'])
+def get_batch_search_results() -> Response:
+    """Runs a list of postcode/phrase searches in one go. Each result has the same shape
+    as a /search response, or is an error for that query alone.
+    """
+    body = request.get_json(silent=True)
+    queries = body.get('queries') if isinstance(body, dict) else None
+    if not isinstance(queries, list):
+        return Response(json.dumps({'errors': 'Expected a JSON object with a list of queries'}),
+                        status=400, mimetype=JSON_CONTENT_TYPE)
+    if len(queries) > MAX_BATCH_SEARCH_QUERIES:
+        return Response(json.dumps({'errors': 'No more than {} queries are allowed'.format(MAX_BATCH_SEARCH_QUERIES)}),
+                        status=400, mimetype=JSON_CONTENT_TYPE)
+
+    metrics.label_request(BATCH_QUERY)
+    results = [None] * len(queries)  # type: List[Dict[str, Any]]
+    uncached = []  # type: List[Tuple[int, Tuple[str, str, int, int]]]
+    for position, query in enumerate(queries):
+        try:
+            parsed_query = _parse_batch_query(query)
+        except ValueError as e:
+            results[position] = {'errors': str(e)}
+            continue
+        cached_result = SEARCH_CACHE.get(_cache_key(*parsed_query))
+        if cached_result is not None:
+            results[position] = {'data': cached_result}
+        else:
+            uncached.append((position, parsed_query))
+
+    with metrics.timed('backend'):
+        search_results = search_backend.get_addresses_for_queries([parsed_query for _, parsed_query in uncached])
+    shaping_started = time.perf_counter()
+    for (position, parsed_query), (address_records, error) in zip(uncached, search_results):
+        if error:
+            LOGGER.error('A batch search query failed: {}'.format(error))
+            results[position] = {'errors': 'Search failed'}
+            continue
+        _, _, page_number, page_size = parsed_query
+        result = paginated_address_records(address_records, page_number, page_size)
+        SEARCH_CACHE.put(_cache_key(*parsed_query), result)
+        results[position] = {'data': result}
+    metrics.record_stage('shaping', time.perf_counter() - shaping_started)
+
+    with metrics.timed('encoding'):
+        return jsonify({'results': results})
 
 
 def _check_elasticsearch_connection() -> List[str]:
     """Checks elasticsearch connection and returns a list of errors"""
     try:
-        status = es_access.get_info()['status']
+        status = search_backend.get_info()['status']
         if status == 200:
             return []
         else:
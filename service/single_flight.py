@@ -0,0 +1,52 @@
+import threading
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class _Call(object):
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None  # type: Any
+        self.error = None  # type: BaseException
+
+
+class SingleFlight(object):
+    """Runs at most one call at a time for each key in this worker process. Requests arriving while
+    a call for the same key is running wait for it and share its result, or its exception, instead
+    of making their own. Unlike the cache it holds nothing once the call is done.
+    """
+
+    def __init__(self) -> None:
+        self._calls = {}  # type: Dict[Hashable, _Call]
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def run(self, key: Hashable, function: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Returns the result of function(), or of the call already running for the key,
+        and whether it was shared from that call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
@@ -0,0 +1,80 @@
+"""The SQLite search backend. It has the same functions as es_access, reading an index
+written by `import.py --sqlite-database`, so the API can run without an elasticsearch cluster.
+"""
+
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from import_addressbase.sqlite_index import SqliteIndexReader
+from service import app
+from service.es_access import POSTCODE_QUERY, AddressHits, _get_start_and_end_indexes
+
+SQLITE_DATABASE_FILE_PATH = app.config['SQLITE_DATABASE_FILE_PATH']
+
+# sqlite3 connections can't be shared between threads
+_local = threading.local()
+
+
+def _get_reader() -> SqliteIndexReader:
+    reader = getattr(_local, 'reader', None)
+    if reader is None:
+        reader = _local.reader = SqliteIndexReader(SQLITE_DATABASE_FILE_PATH)
+    return reader
+
+
+def _project(addresses: List[Dict[str, Any]], fields: Optional[List[str]]) -> List[Dict[str, Any]]:
+    if fields is None:
+        return addresses
+    return [{field: address[field] for field in fields if field in address} for address in addresses]
+
+
+def get_addresses_for_postcode(postcode: str, page_number: int, page_size: int, fields: List[str] = None) -> AddressHits:
+    start_index, end_index = _get_start_and_end_indexes(page_number, page_size)
+    addresses, total = _get_reader().get_addresses_for_postcode(postcode, start_index, end_index)
+    return AddressHits([{'_source': address} for address in _project(addresses, fields)], total)
+
+
+def get_addresses_for_phrase(phrase: str, page_number: int, page_size: int, fields: List[str] = None) -> AddressHits:
+    start_index, end_index = _get_start_and_end_indexes(page_number, page_size)
+    addresses, total = _get_reader().get_addresses_for_phrase(phrase, start_index, end_index)
+    return AddressHits([{'_source': address} for address in _project(addresses, fields)], total)
+
+
+def get_addresses_near(x_coordinate: float, y_coordinate: float, radius: float, page_number: int, page_size: int,
+                       fields: List[str] = None) -> AddressHits:
+    start_index, end_index = _get_start_and_end_indexes(page_number, page_size)
+    addresses, total = _get_reader().get_addresses_near(x_coordinate, y_coordinate, radius, start_index, end_index)
+    return AddressHits([{'_source': address} for address in _project(addresses, fields)], total)
+
+
+def get_addresses_for_queries(queries: List[Tuple[str, str, int, int]]) -> List[Tuple[Any, Optional[str]]]:
+    results = []  # type: List[Tuple[Any, Optional[str]]]
+    for kind, term, page_number, page_size in queries:
+        search_function = get_addresses_for_postcode if kind == POSTCODE_QUERY else get_addresses_for_phrase
+        try:
+            results.append((search_function(term, page_number, page_size), None))
+        except Exception as e:
+            results.append((None, str(e)))
+    return results
+
+
+def get_addresses_after(kind: str, term: str, after: Optional[List[Any]], page_size: int,
+                        fields: List[str] = None) -> AddressHits:
+    raise ValueError('Cursor paging is not supported by the sqlite search backend')
+
+
+def get_suggestions(prefix: str, size: int) -> List[Dict[str, str]]:
+    return [{'uprn': uprn, 'address': address} for uprn, address in _get_reader().get_suggestions(prefix, size)]
+
+
+def get_info() -> Dict[str, Any]:
+    # shaped like elasticsearch's info response, which is what the health check reads
+    return {'status': 200, 'addresses': _get_reader().count_addresses()}
+
+
+def get_data_generation() -> Optional[str]:
+    return _get_reader().get_data_generation()
+
+
+def get_pool_stats() -> List[Dict[str, Any]]:
+    return []
@@ -0,0 +1,17 @@
+import os
+import tempfile
+
+from benchmarks.generate_addressbase import write_zip
+from benchmarks.import_benchmark import run_benchmark
+
+
+def test_benchmark_runs_on_generated_file():
+    zip_path = write_zip(os.path.join(tempfile.mkdtemp(), 'synthetic.csv.zip'), 2000)
+
+    results = run_benchmark(zip_path)
+
+    assert 2000 <= results['rows'] <= 2010
+    assert results['actions'] > 0
+    assert results['bulk_bytes'] > 0
+    assert set(results['stages']) == {'scan', 'actions', 'serialise'}
+    assert results['csv_reader_rows_per_second'] > 0
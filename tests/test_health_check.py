@@ -0,0 +1,87 @@
+import mock
+import threading
+
+from service.health_check import HealthChecker
+
+
+def test_status_is_answered_from_the_last_check():
+    check = mock.Mock(return_value=[])
+    checker = HealthChecker(check, interval_seconds=60, stale_after_seconds=180)
+
+    try:
+        first = checker.status()
+        second = checker.status()
+    finally:
+        checker.stop()
+
+    assert first['errors'] == second['errors'] == []
+    assert check.call_count == 1
+    assert second['last_check_latency_ms'] >= 0
+
+
+def test_deep_status_runs_a_fresh_check():
+    check = mock.Mock(side_effect=[[], ['Problem talking to elasticsearch']])
+    checker = HealthChecker(check, interval_seconds=60, stale_after_seconds=180)
+
+    try:
+        checker.status()
+        deep = checker.status(deep=True)
+        cached = checker.status()
+    finally:
+        checker.stop()
+
+    assert deep['errors'] == cached['errors'] == ['Problem talking to elasticsearch']
+
+
+def test_stale_status_is_an_error():
+    checker = HealthChecker(mock.Mock(return_value=[]), interval_seconds=60, stale_after_seconds=10)
+
+    try:
+        checker.status()
+        with mock.patch('service.health_check.time.monotonic', return_value=checker._checked_at + 11):
+            status = checker.status()
+    finally:
+        checker.stop()
+
+    assert status['errors'] == ['The last health check was 11.0 seconds ago']
+
+
+def test_failing_check_is_reported_as_an_error():
+    checker = HealthChecker(mock.Mock(side_effect=RuntimeError('boom')), interval_seconds=0, stale_after_seconds=10)
+
+    assert checker.status()['errors'] == ['Health check failed: boom']
+
+
+def test_concurrent_first_statuses_wait_for_the_first_check():
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_check():
+        started.set()
+        release.wait(5)
+        return []
+
+    check = mock.Mock(side_effect=slow_check)
+    checker = HealthChecker(check, interval_seconds=60, stale_after_seconds=180)
+    statuses = []
+
+    def get_status():
+        try:
+            statuses.append(checker.status())
+        except Exception as e:
+            statuses.append(e)
+
+    threads = [threading.Thread(target=get_status) for _ in range(4)]
+    try:
+        threads[0].start()
+        assert started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+    finally:
+        checker.stop()
+
+    assert [status['errors'] for status in statuses] == [[]] * 4
+    assert check.call_count == 1
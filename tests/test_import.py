@@ -0,0 +1,103 @@
+import importlib
+import os
+from zipfile import ZipFile
+
+import mock
+import pytest
+
+import_script = importlib.import_module('import')
+
+NEW_VERSION = 'address-search-api-index-20160101000000'
+FINISHING_STEPS = ['finish_bulk_load', 'write_data_generation', 'switch_alias', 'prune_versions']
+
+
+def _summary(file_name, bulk_failed=0, error=None):
+    summary = {'file': file_name, 'bulk_succeeded': 10, 'bulk_failed': bulk_failed}
+    if error is not None:
+        summary['error'] = error
+    return summary
+
+
+def _full_reload(summaries):
+    """Runs a full reload of two zip files, which load with the given summaries. Returns the client,
+    the steps run after loading and the error the reload stopped with, if any.
+    """
+    client = mock.Mock()
+    steps = {step: mock.Mock() for step in FINISHING_STEPS}
+    with mock.patch.object(import_script, '_make_client', return_value=client), \
+            mock.patch.object(import_script, 'create_bulk_load_index', return_value=NEW_VERSION), \
+            mock.patch.object(import_script, 'find_zip_files', return_value=['one.zip', 'two.zip']), \
+            mock.patch.object(import_script, 'import_zip_file', side_effect=summaries), \
+            mock.patch.multiple(import_script, **steps):
+        try:
+            import_script.handle_zip_files_in_folder('/data', full_reload=True)
+        except RuntimeError as e:
+            return client, [step for step in FINISHING_STEPS if steps[step].called], e
+    return client, [step for step in FINISHING_STEPS if steps[step].called], None
+
+
+def test_full_reload_switches_the_alias_when_every_file_loads():
+    client, steps_run, error = _full_reload([[_summary('one.csv')], [_summary('two.csv')]])
+
+    assert error is None
+    assert steps_run == FINISHING_STEPS
+    assert not client.indices.delete.called
+
+
+@pytest.mark.parametrize('failed_summary', [
+    _summary('two.csv', bulk_failed=1),
+    _summary('two.csv', error='ConnectionError: connection refused'),
+])
+def test_failed_full_reload_is_not_switched_to(failed_summary):
+    client, steps_run, error = _full_reload([[_summary('one.csv')], [failed_summary]])
+
+    assert 'two.csv' in str(error)
+    assert steps_run == []
+    client.indices.delete.assert_called_once_with(index=NEW_VERSION)
+
+
+def test_import_zip_file_logs_the_current_and_peak_rss(tmpdir):
+    zip_path = os.path.join(str(tmpdir), 'addressbase.zip')
+    with ZipFile(zip_path, 'w') as zipfile:
+        zipfile.writestr('one.csv', 'row\n')
+    with mock.patch.object(import_script, 'LOGGER') as logger:
+        summaries = import_script.import_zip_file(zip_path, lambda csv_file, name: {'file': name})
+
+    assert summaries == [{'file': 'one.csv'}]
+    message = logger.info.call_args[0][0]
+    assert message.startswith('Imported one.csv from {}, RSS '.format(zip_path))
+    assert 'peak RSS since the import started' in message
+
+
+def test_current_rss_is_read_from_proc():
+    with mock.patch('builtins.open', mock.mock_open(read_data='5000 300 100 1 0 200 0\n')), \
+            mock.patch.object(import_script.resource, 'getpagesize', return_value=4096):
+        assert import_script._rss_kb() == 1200
+    with mock.patch('builtins.open', side_effect=FileNotFoundError):
+        assert import_script._rss_kb() is None
+
+
+def test_options_are_parsed():
+    args = import_script.parse_args(['/data', '--full-reload', '--bulk-threads', '4'])
+
+    assert (args.directory, args.full_reload, args.bulk_threads) == ('/data', True, 4)
+
+
+@pytest.mark.parametrize('argv', [
+    [],
+    ['/data', '--postcode-snapshot', 'postcodes.snapshot', '--workers', '2'],
+    ['/data', '--sqlite-database', 'addresses.db', '--workers', '2'],
+    ['/data', '--checkpoint-dir', 'checkpoints', '--sqlite-database', 'addresses.db'],
+    ['/data', '--join-across-files', '--workers', '2'],
+    ['/data', '--full-reload', '--checkpoint-dir', 'checkpoints'],
+])
+def test_options_that_cannot_be_used_together_are_rejected(argv):
+    with pytest.raises(SystemExit) as exit_info:
+        import_script.parse_args(argv)
+
+    assert exit_info.value.code == 2
+
+
+@pytest.mark.parametrize('argv', [['--migrate-to-single-type'], ['--delete-legacy-types'], ['--rollback-to', 'index']])
+def test_index_maintenance_options_need_no_directory(argv):
+    assert import_script.parse_args(argv).directory is None
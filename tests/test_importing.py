@@ -1,14 +1,47 @@
-from collections import namedtuple
+from collections import deque, namedtuple
+from io import StringIO
 import mock
 
 from import_addressbase import make_es_actions, make_es_mappings
+from import_addressbase.checkpoints import ImportCheckpoints
+from import_addressbase.importing import (
+    PHRASE_SORT_FIELDS, POSTCODE_SORT_FIELDS, _parallel_bulk, delete_legacy_types, get_action_dicts, load_csv,
+    load_failed, make_location, make_sort_key, make_sort_key_string, migrate_to_single_type, scan_record_groups,
+)
+from import_addressbase.national_grid import to_latitude_longitude
+from import_addressbase.progress import ImportProgress
 from record_types import DPA
 
 BLPU_COORDINATES_ONLY = namedtuple('BLPU_coordinates_only', ['x_coordinate', 'y_coordinate'])
 
 
+EXPECTED_SUGGEST = {
+    'input': [
+        'sub_building_name, building_name, 12, dependent_thoroughfare_name, thoroughfare_name, double_dependent_locality, dependent_locality, post_town, postcode',
+        'building_name, 12, dependent_thoroughfare_name, thoroughfare_name, double_dependent_locality, dependent_locality, post_town, postcode',
+        '12, dependent_thoroughfare_name, thoroughfare_name, double_dependent_locality, dependent_locality, post_town, postcode',
+        'dependent_thoroughfare_name, thoroughfare_name, double_dependent_locality, dependent_locality, post_town, postcode',
+        'thoroughfare_name, double_dependent_locality, dependent_locality, post_town, postcode',
+        'double_dependent_locality, dependent_locality, post_town, postcode',
+        'dependent_locality, post_town, postcode',
+        'post_town, postcode',
+        'postcode',
+    ],
+    'output': 'sub_building_name, building_name, 12, dependent_thoroughfare_name, thoroughfare_name, double_dependent_locality, dependent_locality, post_town, postcode',
+    'payload': {'uprn': 'uprn'},
+}
+EXPECTED_POSTCODE_SORT_KEY = (
+    '0thoroughfare_name\x01' '0dependent_thoroughfare_name\x01' '00000000012' '0building_name\x01' '0sub_building_name\x01'
+)
+EXPECTED_PHRASE_SORT_KEY = (
+    '0sub_building_name\x01' '0building_name\x01' '00000000012' '0dependent_thoroughfare_name\x01' '0thoroughfare_name\x01'
+)
+EXPECTED_LATITUDE, EXPECTED_LONGITUDE = to_latitude_longitude(12.34, 56.78)
+EXPECTED_LOCATION = {'lat': EXPECTED_LATITUDE, 'lon': EXPECTED_LONGITUDE}
+
+
 def test_correct_action_for_insert():
-    field_vals = ['I' if f == 'change_type' else f for f in DPA._fields]
+    field_vals = ['I' if f == 'change_type' else '12' if f == 'building_number' else f for f in DPA._fields]
     dpa = DPA(*field_vals)
     blpu = BLPU_COORDINATES_ONLY(x_coordinate=12.34, y_coordinate=56.78)
     entry_datetime = '2015-03-05T12:00:00'
@@ -18,41 +51,17 @@ def test_correct_action_for_insert():
         {
             '_op_type': 'index',
             '_index': 'address-search-api-index',
-            '_type': 'address_by_joined_fields',
-            '_id': 'uprn',
-            '_source': {
-                'building_name': 'building_name',
-                'building_number': 'building_number',
-                'department_name': 'department_name',
-                'dependent_locality': 'dependent_locality',
-                'dependent_thoroughfare_name': 'dependent_thoroughfare_name',
-                'double_dependent_locality': 'double_dependent_locality',
-                'entry_datetime': '2015-03-05T12:00:00',
-                'joined_fields': 'sub_building_name, building_name, building_number, dependent_thoroughfare_name, thoroughfare_name, double_dependent_locality, dependent_locality, post_town, postcode',
-                'postcode': 'postcode',
-                'organisation_name': 'organisation_name',
-                'post_town': 'post_town',
-                'sub_building_name': 'sub_building_name',
-                'thoroughfare_name': 'thoroughfare_name',
-                'uprn': 'uprn',
-                'x_coordinate': 12.34,
-                'y_coordinate': 56.78,
-            },
-        },
-        {
-            '_op_type': 'index',
-            '_index': 'address-search-api-index',
-            '_type': 'address_by_postcode',
+            '_type': 'address',
             '_id': 'uprn',
             '_source': {
                 'building_name': 'building_name',
-                'building_number': 'building_number',
+                'building_number': '12',
                 'department_name': 'department_name',
                 'dependent_locality': 'dependent_locality',
                 'dependent_thoroughfare_name': 'dependent_thoroughfare_name',
                 'double_dependent_locality': 'double_dependent_locality',
                 'entry_datetime': '2015-03-05T12:00:00',
-                'joined_fields': 'sub_building_name, building_name, building_number, dependent_thoroughfare_name, thoroughfare_name, double_dependent_locality, dependent_locality, post_town, postcode',
+                'joined_fields': 'sub_building_name, building_name, 12, dependent_thoroughfare_name, thoroughfare_name, double_dependent_locality, dependent_locality, post_town, postcode',
                 'postcode': 'postcode',
                 'organisation_name': 'organisation_name',
                 'post_town': 'post_town',
@@ -61,6 +70,10 @@ def test_correct_action_for_insert():
                 'uprn': 'uprn',
                 'x_coordinate': 12.34,
                 'y_coordinate': 56.78,
+                'suggest': EXPECTED_SUGGEST,
+                'location': EXPECTED_LOCATION,
+                'postcode_sort_key': EXPECTED_POSTCODE_SORT_KEY,
+                'phrase_sort_key': EXPECTED_PHRASE_SORT_KEY,
             },
         },
     ]
@@ -70,7 +83,7 @@ def test_correct_action_for_insert():
 
 
 def test_correct_action_for_update():
-    field_vals = ['U' if f == 'change_type' else f for f in DPA._fields]
+    field_vals = ['U' if f == 'change_type' else '12' if f == 'building_number' else f for f in DPA._fields]
     dpa = DPA(*field_vals)
     blpu = BLPU_COORDINATES_ONLY(x_coordinate=12.34, y_coordinate=56.78)
     entry_datetime = '2015-03-05T12:00:00'
@@ -80,41 +93,17 @@ def test_correct_action_for_update():
         {
             '_op_type': 'update',
             '_index': 'address-search-api-index',
-            '_type': 'address_by_joined_fields',
-            '_id': 'uprn',
-            'doc': {
-                'building_name': 'building_name',
-                'building_number': 'building_number',
-                'department_name': 'department_name',
-                'dependent_locality': 'dependent_locality',
-                'dependent_thoroughfare_name': 'dependent_thoroughfare_name',
-                'double_dependent_locality': 'double_dependent_locality',
-                'entry_datetime': '2015-03-05T12:00:00',
-                'joined_fields': 'sub_building_name, building_name, building_number, dependent_thoroughfare_name, thoroughfare_name, double_dependent_locality, dependent_locality, post_town, postcode',
-                'postcode': 'postcode',
-                'organisation_name': 'organisation_name',
-                'post_town': 'post_town',
-                'sub_building_name': 'sub_building_name',
-                'thoroughfare_name': 'thoroughfare_name',
-                'uprn': 'uprn',
-                'x_coordinate': 12.34,
-                'y_coordinate': 56.78,
-            },
-        },
-        {
-            '_op_type': 'update',
-            '_index': 'address-search-api-index',
-            '_type': 'address_by_postcode',
+            '_type': 'address',
             '_id': 'uprn',
             'doc': {
                 'building_name': 'building_name',
-                'building_number': 'building_number',
+                'building_number': '12',
                 'department_name': 'department_name',
                 'dependent_locality': 'dependent_locality',
                 'dependent_thoroughfare_name': 'dependent_thoroughfare_name',
                 'double_dependent_locality': 'double_dependent_locality',
                 'entry_datetime': '2015-03-05T12:00:00',
-                'joined_fields': 'sub_building_name, building_name, building_number, dependent_thoroughfare_name, thoroughfare_name, double_dependent_locality, dependent_locality, post_town, postcode',
+                'joined_fields': 'sub_building_name, building_name, 12, dependent_thoroughfare_name, thoroughfare_name, double_dependent_locality, dependent_locality, post_town, postcode',
                 'postcode': 'postcode',
                 'organisation_name': 'organisation_name',
                 'post_town': 'post_town',
@@ -123,6 +112,10 @@ def test_correct_action_for_update():
                 'uprn': 'uprn',
                 'x_coordinate': 12.34,
                 'y_coordinate': 56.78,
+                'suggest': EXPECTED_SUGGEST,
+                'location': EXPECTED_LOCATION,
+                'postcode_sort_key': EXPECTED_POSTCODE_SORT_KEY,
+                'phrase_sort_key': EXPECTED_PHRASE_SORT_KEY,
             },
         },
     ]
@@ -132,7 +125,7 @@ def test_correct_action_for_update():
 
 
 def test_correct_action_for_delete():
-    field_vals = ['D' if f == 'change_type' else f for f in DPA._fields]
+    field_vals = ['D' if f == 'change_type' else '12' if f == 'building_number' else f for f in DPA._fields]
     dpa = DPA(*field_vals)
     blpu = BLPU_COORDINATES_ONLY(x_coordinate=12.34, y_coordinate=56.78)
     entry_datetime = '2015-03-05T12:00:00'
@@ -142,13 +135,7 @@ def test_correct_action_for_delete():
         {
             '_op_type': 'delete',
             '_index': 'address-search-api-index',
-            '_type': 'address_by_joined_fields',
-            '_id': 'uprn',
-        },
-        {
-            '_op_type': 'delete',
-            '_index': 'address-search-api-index',
-            '_type': 'address_by_postcode',
+            '_type': 'address',
             '_id': 'uprn',
         },
     ]
@@ -157,14 +144,14 @@ def test_correct_action_for_delete():
     assert all(action in expected_actions for action in actions)
 
 
-def miss_out_test_mappings_made_correctly():
+def test_mappings_made_correctly():
     with mock.patch('import_addressbase.importing.IndicesClient') as client:
         mock_put_mapping = client.return_value.put_mapping
 
         make_es_mappings(None)
 
         expected_body = {
-            'address_by_postcode': {
+            'address': {
                 'properties': {
                     'uprn': {'type': 'string', 'index': 'no'},
                     'organisation_name': {'type': 'string', 'index': 'no'},
@@ -177,36 +164,222 @@ def miss_out_test_mappings_made_correctly():
                     'double_dependent_locality': {'type': 'string', 'index': 'no'},
                     'dependent_locality': {'type': 'string', 'index': 'no'},
                     'post_town': {'type': 'string', 'index': 'no'},
-                    'postcode': {'type': 'string', 'index': 'not_analysed'},
+                    'postcode': {'type': 'string', 'index': 'not_analyzed'},
                     'x_coordinate': {'type': 'float', 'index': 'no'},
                     'y_coordinate': {'type': 'float', 'index': 'no'},
-                    'joined_fields': {'type': 'string', 'index': 'no'},
-                    'entry_datetime': {'type': 'date', 'format': 'date_time_no_millis', 'index': 'no'}
+                    'joined_fields': {'type': 'string', 'index': 'analyzed'},
+                    'entry_datetime': {'type': 'date', 'format': 'date_time_no_millis', 'index': 'no'},
+                    'suggest': {'type': 'completion', 'analyzer': 'standard', 'payloads': True},
+                    'location': {'type': 'geo_point', 'lat_lon': True},
+                    'postcode_sort_key': {'type': 'string', 'index': 'not_analyzed', 'doc_values': True},
+                    'phrase_sort_key': {'type': 'string', 'index': 'not_analyzed', 'doc_values': True},
                 }
             }
         }
-        mock_put_mapping.assert_any_call(index='address-search-api-index', body=expected_body, doc_type='address_by_postcode')
+        mock_put_mapping.assert_called_once_with(index='address-search-api-index', body=expected_body, doc_type='address')
 
-        expected_body2 = {
-            'address_by_joined_fields': {
-                'properties': {
-                    'uprn': {'type': 'string', 'index': 'no'},
-                    'organisation_name': {'type': 'string', 'index': 'no'},
-                    'department_name': {'type': 'string', 'index': 'no'},
-                    'sub_building_name': {'type': 'string', 'index': 'not_analyzed'},
-                    'building_name': {'type': 'string', 'index': 'not_analyzed'},
-                    'building_number': {'type': 'string', 'index': 'not_analyzed'},
-                    'dependent_thoroughfare_name': {'type': 'string', 'index': 'no'},
-                    'thoroughfare_name': {'type': 'string', 'index': 'not_analyzed'},
-                    'double_dependent_locality': {'type': 'string', 'index': 'no'},
-                    'dependent_locality': {'type': 'string', 'index': 'no'},
-                    'post_town': {'type': 'string', 'index': 'no'},
-                    'postcode': {'type': 'string', 'index': 'no'},
-                    'joined_fields': {'type': 'string', 'index': 'analyzed'},
-                    'x_coordinate': {'type': 'float', 'index': 'no'},
-                    'y_coordinate': {'type': 'float', 'index': 'no'},
-                    'entry_datetime': {'format': 'date_time_no_millis', 'type': 'date', 'index': 'no'},
-                }
-            },
-        }
-        mock_put_mapping.assert_any_call(index='address-search-api-index', body=expected_body2, doc_type='address_by_joined_fields')
+
+def test_progress_counts_rows_and_skipped_groups():
+    blpu_row = ','.join(['21', 'I', '1', '100'] + [''] * 4 + ['291124.22', '94250.89'] + [''] * 9)
+    dpa_row = ','.join(['28', 'I', '2', '100'] + [''] * 12 + ['EX4 4QU'] + [''] * 12)
+    lpi_row = ','.join(['24', 'I', '3', '200'] + [''] * 10)
+    csv_file = StringIO('\n'.join([
+        '10,"OS",7655,2015-03-05,1,2015-03-05,12:00:00,1.0,F',
+        blpu_row,
+        dpa_row,
+        lpi_row,
+    ]) + '\n')
+    progress = ImportProgress()
+
+    actions = list(get_action_dicts(csv_file, progress=progress))
+
+    assert len(actions) == 1
+    summary = progress.summary()
+    assert summary['lines'] == 4
+    assert summary['rows_by_type'] == {'10': 1, '21': 1, '28': 1, 'other': 1}
+    assert summary['addresses'] == 1
+    assert summary['groups_skipped'] == 1
+
+
+def test_parallel_bulk_sends_every_chunk_in_order():
+    def fake_streaming_bulk(client, chunk, chunk_size, raise_on_error):
+        return [(True, action) for action in chunk]
+
+    with mock.patch('import_addressbase.importing.streaming_bulk', side_effect=fake_streaming_bulk), \
+            mock.patch('import_addressbase.importing.BULK_CHUNK_SIZE', 3):
+        results = list(_parallel_bulk(None, iter(range(10)), bulk_threads=2))
+
+    assert results == [(True, i) for i in range(10)]
+
+
+def _two_address_csv():
+    rows = ['10,"OS",7655,2015-03-05,1,2015-03-05,12:00:00,1.0,F']
+    for uprn in ['100', '200']:
+        rows.append(','.join(['21', 'I', '1', uprn] + [''] * 4 + ['291124.22', '94250.89'] + [''] * 9))
+        rows.append(','.join(['28', 'I', '2', uprn] + [''] * 12 + ['EX4 4QU'] + [''] * 12))
+    return '\n'.join(rows) + '\n'
+
+
+def test_get_action_dicts_resumes_after_skipped_rows():
+    resume_rows = deque()
+
+    actions = list(get_action_dicts(StringIO(_two_address_csv()), skip_rows=3, resume_rows=resume_rows))
+
+    assert [action['_id'] for action in actions] == ['200']
+    # the entry date comes from the skipped header
+    assert actions[0]['_source']['entry_datetime'] == '2015-03-05T12:00:00+00'
+    assert list(resume_rows) == [5]
+
+
+def test_load_csv_saves_checkpoints_and_resumes(tmpdir):
+    sent = []
+
+    def fake_streaming_bulk(client, actions, chunk_size, raise_on_error):
+        for action in actions:
+            sent.append(action['_id'])
+            yield True, action
+
+    checkpoints = ImportCheckpoints(str(tmpdir))
+    with mock.patch('import_addressbase.importing.streaming_bulk', side_effect=fake_streaming_bulk), \
+            mock.patch('import_addressbase.importing.BULK_CHUNK_SIZE', 1):
+        checkpoint = checkpoints.for_file('file-a')
+        checkpoint.save(3)
+        load_csv(None, StringIO(_two_address_csv()), checkpoint=checkpoints.for_file('file-a'))
+
+    assert sent == ['200']
+    saved = checkpoints.for_file('file-a')
+    assert saved.rows_done == 5
+    assert saved.completed
+    assert not checkpoints.for_file('file-b').completed
+
+
+def test_scan_record_groups_only_keeps_the_columns_used_but_splits_groups_on_skipped_lines():
+    csv_file = StringIO('\n'.join([
+        ','.join(['21', '"I"', '1', '100'] + [''] * 4 + ['291124.22', '094250.89'] + [''] * 9),
+        ','.join(['24', '"I"', '2', '200'] + [''] * 10),
+        ','.join(['28', '"I"', '3', '100'] + [''] * 12 + ['"EX4 4QU"'] + [''] * 12),
+        '99,0,4,2015-03-05,12:00:00',
+    ]) + '\n')
+    progress = ImportProgress()
+
+    groups = list(scan_record_groups(csv_file, progress))
+
+    assert [group.rows for group in groups] == [1, 1, 1, 1]
+    assert groups[0].blpus == [('291124.22', '094250.89')]
+    assert groups[2].dpas[0].postcode == 'EX4 4QU'
+    assert groups[2].dpas[0].change_type == 'I'
+    assert progress.rows_by_type == {'10': 0, '21': 1, '28': 1, 'other': 2}
+
+
+def test_load_csv_sends_actions_to_the_given_index():
+    sent = []
+
+    def fake_streaming_bulk(client, actions, chunk_size, raise_on_error):
+        for action in actions:
+            sent.append(action['_index'])
+            yield True, action
+
+    with mock.patch('import_addressbase.importing.streaming_bulk', side_effect=fake_streaming_bulk):
+        load_csv(None, StringIO(_two_address_csv()), index_name='address-search-api-index-20160101000000')
+
+    assert sent == ['address-search-api-index-20160101000000'] * 2
+
+
+def test_national_grid_conversion():
+    # the worked example in the Ordnance Survey's guide to coordinate systems in Great Britain
+    latitude, longitude = to_latitude_longitude(651409.903, 313177.270)
+
+    assert round(latitude, 6) == 52.657570
+    assert round(longitude, 6) == 1.717922
+
+
+def test_location_left_out_for_unknown_coordinates():
+    assert make_location(0.0, 0.0) is None
+    location = make_location(651409.903, 313177.270)
+    assert (round(location['lat'], 6), round(location['lon'], 6)) == (52.657570, 1.717922)
+
+
+# (thoroughfare_name, dependent_thoroughfare_name, building_number, building_name, sub_building_name)
+SORT_TEST_ADDRESSES = {
+    'number 2': ('GLENTHORNE ROAD', '', '2', '', ''),
+    'number 10': ('GLENTHORNE ROAD', '', '10', '', ''),
+    'flat 1': ('GLENTHORNE ROAD', '', '', 'THE CYPRESS HOUSE', 'FLAT 1'),
+    'cypress house': ('GLENTHORNE ROAD', '', '', 'THE CYPRESS HOUSE', ''),
+    'mews': ('GLENTHORNE ROAD', 'MEWS', '1', '', ''),
+    'no street': ('', '', '', 'ROSE COTTAGE', ''),
+    'shorter street': ('GLENTHORNE', '', '3', '', ''),
+    'number 2a': ('GLENTHORNE ROAD', '', '2', 'A', ''),
+    'null street': (None, '', '5', '', ''),
+}
+
+
+def _sort_test_docs():
+    docs = []
+    for name, values in SORT_TEST_ADDRESSES.items():
+        doc = dict(zip(POSTCODE_SORT_FIELDS, values), name=name)
+        if doc['thoroughfare_name'] is None:
+            del doc['thoroughfare_name']
+        docs.append(doc)
+    return docs
+
+
+def test_sort_keys_order_addresses_like_elasticsearch():
+    # ascending with 'missing': '_last': empty strings are values and come first, and empty
+    # building numbers and absent fields are missing
+    expected_orders = [
+        (POSTCODE_SORT_FIELDS, [
+            'no street', 'shorter street', 'number 2', 'number 2a', 'number 10', 'cypress house', 'flat 1', 'mews',
+            'null street',
+        ]),
+        (PHRASE_SORT_FIELDS, [
+            'mews', 'number 2', 'shorter street', 'null street', 'number 10', 'number 2a', 'no street',
+            'cypress house', 'flat 1',
+        ]),
+    ]
+    for fields, expected_order in expected_orders:
+        docs = _sort_test_docs()
+        by_fields = sorted(docs, key=lambda doc: make_sort_key(doc, fields))
+        by_key = sorted(docs, key=lambda doc: make_sort_key_string(doc, fields))
+        assert [doc['name'] for doc in by_fields] == expected_order
+        assert [doc['name'] for doc in by_key] == expected_order
+
+
+def test_sort_key_strings_keep_empty_strings_and_leave_out_missing_values():
+    doc = {
+        'sub_building_name': '', 'building_name': 'THE CYPRESS HOUSE', 'building_number': '',
+        'dependent_thoroughfare_name': '',
+    }
+
+    assert make_sort_key_string(doc, PHRASE_SORT_FIELDS) == '0\x01' '0THE CYPRESS HOUSE\x01' '1' '0\x01' '1'
+
+
+def test_load_csv_reports_an_error_that_stopped_it():
+    def failing_streaming_bulk(client, actions, chunk_size, raise_on_error):
+        raise ConnectionError('connection refused')
+        yield
+
+    with mock.patch('import_addressbase.importing.streaming_bulk', side_effect=failing_streaming_bulk):
+        summary = load_csv(None, StringIO(_two_address_csv()))
+
+    assert summary['error'] == 'ConnectionError: connection refused'
+    assert load_failed(summary)
+
+
+def test_migration_keeps_the_legacy_types_until_they_are_deleted():
+    client = mock.Mock()
+    legacy_hits = [{'_id': '1', '_source': {'uprn': '1'}}]
+    with mock.patch('import_addressbase.importing.scan', return_value=legacy_hits), \
+            mock.patch('import_addressbase.importing.bulk', return_value=(1, [])) as mock_bulk, \
+            mock.patch('import_addressbase.importing.make_es_mappings'):
+        copied = migrate_to_single_type(client, 'addresses')
+
+    assert copied == 1
+    assert [action['_type'] for action in mock_bulk.call_args[0][1]] == ['address']
+    assert not client.indices.delete_mapping.called
+
+    delete_legacy_types(client, 'addresses')
+
+    assert client.indices.delete_mapping.mock_calls == [
+        mock.call(index='addresses', doc_type='address_by_joined_fields'),
+        mock.call(index='addresses', doc_type='address_by_postcode'),
+    ]
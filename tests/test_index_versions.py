@@ -0,0 +1,86 @@
+from datetime import datetime
+import mock
+import pytest
+
+from import_addressbase.index_versions import (
+    BULK_LOAD_SETTINGS, create_bulk_load_index, finish_bulk_load, list_versions, prune_versions, switch_alias,
+    version_name,
+)
+
+ALIAS = 'address-search-api-index'
+
+
+def _client(aliased=None, versions=None):
+    client = mock.MagicMock()
+    if aliased:
+        client.indices.get_alias.return_value = {name: {'aliases': {ALIAS: {}}} for name in aliased}
+    else:
+        client.indices.get_alias.return_value = {}
+    settings = {name: {'settings': {'index': {'number_of_replicas': '2', 'refresh_interval': '5s'}}}
+                for name in (versions or [])}
+    client.indices.get_settings.side_effect = lambda index: (
+        settings if index.endswith('*') else {index: settings[index]})
+    return client
+
+
+def test_version_names_sort_in_the_order_they_were_made():
+    assert version_name(ALIAS, datetime(2016, 1, 2, 3, 4, 5)) == 'address-search-api-index-20160102030405'
+
+
+def test_bulk_load_index_is_created_without_refreshes_or_replicas():
+    client = _client()
+
+    with mock.patch('import_addressbase.index_versions.make_es_mappings') as mock_make_es_mappings:
+        index_name = create_bulk_load_index(client, ALIAS)
+
+    assert index_name.startswith(ALIAS + '-')
+    client.indices.create.assert_called_once_with(index=index_name, body={'settings': BULK_LOAD_SETTINGS})
+    mock_make_es_mappings.assert_called_once_with(client, index_name)
+
+
+def test_finished_index_gets_the_live_index_settings_and_is_merged():
+    live = ALIAS + '-20160101000000'
+    client = _client(aliased=[live], versions=[live])
+
+    finish_bulk_load(client, ALIAS + '-20160201000000', ALIAS)
+
+    client.indices.put_settings.assert_called_once_with(
+        index=ALIAS + '-20160201000000', body={'index': {'number_of_replicas': '2', 'refresh_interval': '5s'}})
+    client.indices.optimize.assert_called_once_with(index=ALIAS + '-20160201000000', max_num_segments=1)
+    assert client.search.call_count == 2
+
+
+def test_switch_alias_moves_the_alias_in_one_update():
+    old = ALIAS + '-20160101000000'
+    new = ALIAS + '-20160201000000'
+    client = _client(aliased=[old])
+
+    previous = switch_alias(client, new, ALIAS)
+
+    assert previous == [old]
+    client.indices.update_aliases.assert_called_once_with(body={'actions': [
+        {'remove': {'index': old, 'alias': ALIAS}},
+        {'add': {'index': new, 'alias': ALIAS}},
+    ]})
+
+
+def test_switch_alias_only_deletes_an_unaliased_index_when_asked():
+    client = _client()
+    client.indices.exists.return_value = True
+
+    with pytest.raises(ValueError):
+        switch_alias(client, ALIAS + '-20160201000000', ALIAS)
+    client.indices.delete.assert_not_called()
+
+    switch_alias(client, ALIAS + '-20160201000000', ALIAS, replace_unaliased_index=True)
+    client.indices.delete.assert_called_once_with(index=ALIAS)
+
+
+def test_prune_versions_keeps_the_newest_and_the_live_versions():
+    versions = [ALIAS + '-2016010{}000000'.format(day) for day in range(1, 6)]
+    client = _client(aliased=[versions[0]], versions=versions + [ALIAS + '-backup'])
+
+    assert list_versions(client, ALIAS) == versions
+    deleted = prune_versions(client, ALIAS, keep=2)
+
+    assert deleted == versions[1:3]
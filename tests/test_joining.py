@@ -0,0 +1,84 @@
+from io import StringIO
+
+from import_addressbase.importing import get_action_dicts
+from import_addressbase.joining import PEAK_BYTES_PER_COORDINATE, CoordinateIndex, ExternalJoin
+
+HEADER_ROW = '10,"OS",7655,2015-03-05,1,2015-03-05,12:00:00,1.0,F'
+
+
+def _blpu_row(uprn, x):
+    return ','.join(['21', 'I', '1', uprn] + [''] * 4 + [x, '94250.89'] + [''] * 9)
+
+
+def _dpa_row(uprn):
+    return ','.join(['28', 'I', '2', uprn] + [''] * 12 + ['EX4 4QU'] + [''] * 12)
+
+
+# uprn 100 is joined as before, 200's BLPU is in the other file, 300's is out of order,
+# 400 has no BLPU and 500 has two, which used to drop its DPA
+FILES = [
+    ('one.csv', '\n'.join([HEADER_ROW, _blpu_row('100', '1.0'), _dpa_row('100'), _dpa_row('200'),
+                           _dpa_row('300'), _dpa_row('400'), _blpu_row('300', '3.0'),
+                           _blpu_row('500', '4.0'), _blpu_row('500', '5.0'), _dpa_row('500')]) + '\n'),
+    ('two.csv', '\n'.join([HEADER_ROW, _blpu_row('200', '2.0')]) + '\n'),
+]
+
+
+def _open_files():
+    return [(name, StringIO(data)) for name, data in FILES]
+
+
+def _coordinates_by_uprn(actions):
+    return {action['_id']: action['_source']['x_coordinate'] for action in actions}
+
+
+def test_coordinate_index_keeps_the_last_coordinates_for_a_uprn():
+    coordinates = CoordinateIndex()
+    coordinates.add(5, 1.0, 1.0)
+    coordinates.add(2, 2.0, 2.0)
+    coordinates.add(5, 3.0, 3.0)
+    coordinates.freeze()
+
+    assert coordinates.get(5) == (3.0, 3.0)
+    assert coordinates.get(2) == (2.0, 2.0)
+    assert coordinates.get(4) is None
+
+
+def test_join_finds_blpus_in_other_files_and_out_of_order():
+    contiguous = [action for _, data in FILES for action in get_action_dicts(StringIO(data))]
+    join = ExternalJoin(memory_budget_bytes=1024 * 1024)
+
+    actions = list(join.actions(_open_files))
+
+    assert _coordinates_by_uprn(contiguous) == {'100': 1.0, '200': 0.0, '300': 0.0, '400': 0.0}
+    assert _coordinates_by_uprn(actions) == {'100': 1.0, '200': 2.0, '300': 3.0, '400': 0.0, '500': 5.0}
+    assert actions[0]['_source']['entry_datetime'] == '2015-03-05T12:00:00+00'
+    summary = join.stats.summary()
+    assert summary['joined'] == 4
+    assert summary['contiguous_joins'] == 1
+    assert summary['contiguous_dropped'] == 1
+    assert summary['recovered_joins'] == 3
+    assert summary['partitions'] == 1
+
+
+def test_join_gives_the_same_actions_when_partitioned_on_disk(tmpdir):
+    in_memory = list(ExternalJoin(memory_budget_bytes=1024 * 1024).actions(_open_files))
+    join = ExternalJoin(memory_budget_bytes=24, work_dir=str(tmpdir))
+
+    actions = list(join.actions(_open_files))
+
+    assert join.stats.partitions > 1
+    assert sorted(actions, key=lambda action: action['_id']) == in_memory
+    assert tmpdir.listdir() == []
+
+
+def test_join_is_partitioned_when_sorting_the_coordinates_would_exceed_the_budget(tmpdir):
+    # the files have five BLPUs
+    within_budget = ExternalJoin(memory_budget_bytes=6 * PEAK_BYTES_PER_COORDINATE, work_dir=str(tmpdir))
+    over_budget = ExternalJoin(memory_budget_bytes=4 * PEAK_BYTES_PER_COORDINATE, work_dir=str(tmpdir))
+
+    list(within_budget.actions(_open_files))
+    list(over_budget.actions(_open_files))
+
+    assert within_budget.stats.partitions == 1
+    assert over_budget.stats.partitions == 3
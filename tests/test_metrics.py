@@ -0,0 +1,68 @@
+import mock
+import tempfile
+
+from service import metrics
+from service.metrics import REQUEST_DURATION, STAGE_DURATION, MetricsStore
+
+
+def test_page_sizes_are_counted_in_buckets():
+    assert [metrics.page_size_label(size) for size in [None, 1, 10, 11, 100, 5000]] == [
+        'none', '10', '10', '20', '100', '+Inf',
+    ]
+
+
+def test_histograms_are_rendered_cumulatively():
+    store = MetricsStore()
+    store.observe(REQUEST_DURATION, ('postcode', '20'), 0.003)
+    store.observe(REQUEST_DURATION, ('postcode', '20'), 0.02)
+    store.observe(REQUEST_DURATION, ('postcode', '20'), 30.0)
+
+    lines = store.render().splitlines()
+
+    assert 'address_search_request_duration_seconds_bucket{kind="postcode",page_size="20",le="0.0025"} 0' in lines
+    assert 'address_search_request_duration_seconds_bucket{kind="postcode",page_size="20",le="0.005"} 1' in lines
+    assert 'address_search_request_duration_seconds_bucket{kind="postcode",page_size="20",le="10.0"} 2' in lines
+    assert 'address_search_request_duration_seconds_bucket{kind="postcode",page_size="20",le="+Inf"} 3' in lines
+    assert 'address_search_request_duration_seconds_count{kind="postcode",page_size="20"} 3' in lines
+    assert 'address_search_request_duration_seconds_sum{kind="postcode",page_size="20"} 30.023' in lines
+    # series with nothing observed are left out
+    assert not [line for line in lines if 'phrase' in line]
+
+
+def test_workers_sharing_a_directory_are_added_together():
+    directory = tempfile.mkdtemp()
+    workers = [MetricsStore(directory), MetricsStore(directory)]
+    for pid, store in zip([101, 102], workers):
+        with mock.patch('os.getpid', return_value=pid):
+            store.observe(STAGE_DURATION, ('phrase', 'elasticsearch'), 0.004)
+
+    with mock.patch('os.getpid', return_value=101):
+        lines = workers[0].render().splitlines()
+
+    assert 'address_search_stage_duration_seconds_count{kind="phrase",stage="elasticsearch"} 2' in lines
+
+    metrics.clear_metrics_directory(directory)
+    assert 'address_search_stage_duration_seconds_count' not in MetricsStore(directory).render()
+
+
+def test_a_worker_reusing_a_pid_keeps_the_old_workers_counts():
+    directory = tempfile.mkdtemp()
+    with mock.patch('os.getpid', return_value=101):
+        MetricsStore(directory).observe(STAGE_DURATION, ('phrase', 'elasticsearch'), 0.004)
+        MetricsStore(directory).observe(STAGE_DURATION, ('phrase', 'elasticsearch'), 0.004)
+        lines = MetricsStore(directory).render().splitlines()
+
+    assert 'address_search_stage_duration_seconds_count{kind="phrase",stage="elasticsearch"} 2' in lines
+
+
+def test_stages_are_only_recorded_during_a_request():
+    metrics.record_stage('backend', 1.0)
+    timings = metrics.start_request()
+    metrics.label_request('phrase', 20)
+    metrics.record_stage('backend', 0.5)
+    metrics.record_stage('backend', 0.25)
+
+    assert metrics.finish_request() is timings
+    assert timings.stages == {'backend': 0.75}
+    assert timings.duration > 0
+    assert metrics.finish_request() is None
@@ -0,0 +1,96 @@
+import os
+import tempfile
+
+from import_addressbase import PostcodeSnapshot, PostcodeSnapshotBuilder
+from import_addressbase.importing import POSTCODE_SORT_FIELDS, make_sort_key_string
+
+
+def _make_action(uprn, postcode, thoroughfare_name, building_number, op_type='index'):
+    doc = {
+        'uprn': uprn,
+        'postcode': postcode,
+        'thoroughfare_name': thoroughfare_name,
+        'dependent_thoroughfare_name': '',
+        'building_number': building_number,
+        'building_name': '',
+        'sub_building_name': '',
+    }
+    action = {'_op_type': op_type, '_index': 'address-search-api-index', '_type': 'address', '_id': uprn}
+    if op_type == 'index':
+        action['_source'] = doc
+    elif op_type == 'update':
+        action['doc'] = doc
+    return action
+
+
+def _write_snapshot(actions):
+    builder = PostcodeSnapshotBuilder()
+    builder.add_actions(actions)
+    path = os.path.join(tempfile.mkdtemp(), 'postcodes.snapshot')
+    builder.write(path)
+    return PostcodeSnapshot(path)
+
+
+def test_addresses_are_returned_in_search_order():
+    snapshot = _write_snapshot([
+        _make_action('1', 'EX4 4QU', 'GLENTHORNE ROAD', '10'),
+        _make_action('2', 'EX4 4QU', 'GLENTHORNE ROAD', '9'),
+        _make_action('3', 'EX4 4QU', '', '1'),
+        _make_action('4', 'EX4 4QU', 'ALPHA ROAD', ''),
+        _make_action('5', 'PL1 1AA', 'ALPHA ROAD', '1'),
+    ])
+
+    addresses, total = snapshot.get_addresses('ex4 4qu', 0, 10)
+
+    assert total == 4
+    # as elasticsearch sorts them: the empty street name first and the empty building number last
+    assert [address['uprn'] for address in addresses] == ['3', '4', '2', '1']
+
+
+def test_addresses_are_returned_in_the_elasticsearch_sort_key_order():
+    actions = [
+        _make_action('1', 'EX4 4QU', 'GLENTHORNE ROAD', ''),
+        _make_action('2', 'EX4 4QU', '', '7'),
+        _make_action('3', 'EX4 4QU', 'GLENTHORNE', '12'),
+        _make_action('4', 'EX4 4QU', 'GLENTHORNE ROAD', '3'),
+        _make_action('5', 'EX4 4QU', '', ''),
+    ]
+    actions[0]['_source']['building_name'] = 'THE CYPRESS HOUSE'
+    actions[4]['_source']['sub_building_name'] = 'FLAT 1'
+    snapshot = _write_snapshot(actions)
+
+    addresses, _ = snapshot.get_addresses('EX4 4QU', 0, 10)
+
+    # the order of elasticsearch's sort on postcode_sort_key, then the uprn
+    docs = sorted((action['_source'] for action in actions),
+                  key=lambda doc: (make_sort_key_string(doc, POSTCODE_SORT_FIELDS), doc['uprn']))
+    assert [address['uprn'] for address in addresses] == [doc['uprn'] for doc in docs] == ['2', '5', '3', '4', '1']
+
+
+def test_addresses_are_paged():
+    snapshot = _write_snapshot([_make_action(str(i), 'EX4 4QU', 'ROAD', str(i)) for i in range(1, 6)])
+
+    addresses, total = snapshot.get_addresses('EX4 4QU', 2, 4)
+
+    assert total == 5
+    assert [address['uprn'] for address in addresses] == ['3', '4']
+    assert snapshot.get_addresses('EX4 4QU', 10, 12) == ([], 5)
+
+
+def test_unknown_postcode_has_no_addresses():
+    snapshot = _write_snapshot([_make_action('1', 'EX4 4QU', 'ROAD', '1')])
+
+    assert snapshot.get_addresses('EX4 4QA', 0, 20) == ([], 0)
+    assert snapshot.get_addresses('A' * 20, 0, 20) == ([], 0)
+
+
+def test_updates_and_deletes_are_applied():
+    snapshot = _write_snapshot([
+        _make_action('1', 'EX4 4QU', 'ROAD', '1'),
+        _make_action('2', 'EX4 4QU', 'ROAD', '2'),
+        _make_action('1', 'PL1 1AA', 'ROAD', '1', op_type='update'),
+        _make_action('2', 'EX4 4QU', 'ROAD', '2', op_type='delete'),
+    ])
+
+    assert snapshot.get_addresses('EX4 4QU', 0, 20) == ([], 0)
+    assert snapshot.get_addresses('PL1 1AA', 0, 20)[1] == 1
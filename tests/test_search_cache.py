@@ -0,0 +1,75 @@
+import mock
+
+from service.search_cache import SearchResultCache
+
+
+def _make_cache(max_entries=2, ttl_seconds=60, generation='1'):
+    get_generation = mock.Mock(return_value=generation)
+    return SearchResultCache(max_entries, ttl_seconds, generation_check_seconds=0, get_generation=get_generation)
+
+
+def test_cached_result_is_returned():
+    cache = _make_cache()
+    cache.put(('postcode', 'EX4 4QU', 0, 20), {'total': 2})
+
+    assert cache.get(('postcode', 'EX4 4QU', 0, 20)) == {'total': 2}
+    assert cache.get(('postcode', 'EX4 4QU', 1, 20)) is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = _make_cache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_expired_entry_is_not_returned():
+    cache = _make_cache(ttl_seconds=0)
+    cache.put('a', 1)
+
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_new_data_generation_clears_cache():
+    cache = _make_cache()
+    cache.get('a')
+    cache.put('a', 1)
+    cache._get_generation.return_value = '2'
+
+    assert cache.get('a') is None
+    assert cache.stats()['invalidations'] == 1
+    assert cache.stats()['generation'] == '2'
+
+
+def test_disabled_cache_does_not_look_up_generation():
+    cache = _make_cache(max_entries=0)
+    cache.put('a', 1)
+
+    assert cache.get('a') is None
+    assert cache._get_generation.mock_calls == []
+
+
+def test_failed_generation_lookup_keeps_the_last_generation_until_the_next_check():
+    get_generation = mock.Mock(return_value='1')
+    cache = SearchResultCache(2, 600, generation_check_seconds=30, get_generation=get_generation)
+    with mock.patch('service.search_cache.time.monotonic', return_value=100.0):
+        cache.get('a')
+        cache.put('a', 1)
+    get_generation.side_effect = Exception('connection refused')
+    with mock.patch('service.search_cache.time.monotonic', return_value=200.0):
+        assert cache.get('a') == 1
+        assert cache.get('a') == 1
+
+    assert get_generation.call_count == 2
+    assert cache.stats()['generation'] == '1'
+    assert cache.stats()['generation_check_errors'] == 1
+    assert cache.stats()['invalidations'] == 0
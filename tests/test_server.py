@@ -1,8 +1,14 @@
 from collections import namedtuple
+import gzip
+import hashlib
 import json
 import mock
+import threading
+import time
 from service.server import app
-from service import es_access
+from service import es_access, server
+from service.search_cache import SearchResultCache
+from service.single_flight import SingleFlight
 
 FakeElasticsearchHits = namedtuple('address_records', ['hits', 'total'])
 
@@ -93,7 +99,7 @@ def test_search_results_using_postcode(mock_es_access):
     postcode = 'EX4 4QU'
     response = app.test_client().get('/search?postcode=EX4 4QU')
 
-    mock_es_access.assert_called_once_with(postcode, PAGE_NUMBER, PAGE_SIZE)
+    mock_es_access.assert_called_once_with(postcode, PAGE_NUMBER, PAGE_SIZE, fields=None)
 
     json_body = json.loads(response.data.decode())
     assert json_body == EXPECTED_RESPONSE
@@ -104,7 +110,7 @@ def test_search_results_using_phrase(mock_es_access):
 
     response = app.test_client().get('/search?phrase=someaddress')
 
-    mock_es_access.assert_called_once_with('someaddress', PAGE_NUMBER, PAGE_SIZE)
+    mock_es_access.assert_called_once_with('someaddress', PAGE_NUMBER, PAGE_SIZE, fields=None)
 
     json_body = json.loads(response.data.decode())
     assert json_body == EXPECTED_RESPONSE
@@ -118,3 +124,408 @@ def test_search_results_with_no_parameters(mock_es_access):
 
     json_body = json.loads(response.data.decode())
     assert json_body == EXPECTED_ERROR_RESPONSE
+
+
+@mock.patch.object(es_access, 'get_pool_stats', return_value=[{'host': 'http://localhost:9200', 'in_use': 1}])
+@mock.patch.object(es_access, 'get_info', return_value={'status': 200})
+def test_healthcheck_includes_pool_stats(mock_get_info, mock_get_pool_stats):
+    response = app.test_client().get('/health')
+
+    assert response.status_code == 200
+    json_body = json.loads(response.data.decode())
+    assert json_body['status'] == 'ok'
+    assert json_body['elasticsearch_pool'] == [{'host': 'http://localhost:9200', 'in_use': 1}]
+    assert 'last_check_age_seconds' in json_body
+    assert 'last_check_latency_ms' in json_body
+
+
+@mock.patch.object(es_access, 'get_pool_stats', return_value=[])
+@mock.patch.object(es_access, 'get_info', side_effect=Exception('connection refused'))
+def test_deep_healthcheck_reports_errors(mock_get_info, mock_get_pool_stats):
+    response = app.test_client().get('/health/deep')
+
+    assert response.status_code == 500
+    json_body = json.loads(response.data.decode())
+    assert json_body['errors'] == ['Problem talking to elasticsearch: connection refused']
+
+
+@mock.patch.object(es_access, '_client', None)
+def test_client_is_reused_between_calls():
+    with mock.patch.object(es_access, 'Elasticsearch') as mock_elasticsearch:
+        es_access.get_client()
+        es_access.get_client()
+
+        assert mock_elasticsearch.call_count == 1
+
+
+@mock.patch.object(es_access, 'get_addresses_for_postcode', return_value=_get_esearch_results(1, 2))
+def test_repeated_search_is_served_from_cache(mock_es_access):
+    cache = SearchResultCache(10, 60, 60, get_generation=lambda: '1')
+    with mock.patch.object(server, 'SEARCH_CACHE', cache):
+        app.test_client().get('/search?postcode=EX4 4QU')
+        response = app.test_client().get('/search?postcode=ex4 4qu')
+
+    mock_es_access.assert_called_once_with('EX4 4QU', PAGE_NUMBER, PAGE_SIZE, fields=None)
+    assert json.loads(response.data.decode()) == EXPECTED_RESPONSE
+
+
+@mock.patch.object(es_access, 'get_addresses_for_queries')
+def test_batch_search_returns_results_in_order(mock_get_addresses_for_queries):
+    mock_get_addresses_for_queries.return_value = [
+        (_get_esearch_results(1, 2), None),
+        (None, 'SearchPhaseExecutionException'),
+    ]
+    body = {'queries': [{'postcode': 'EX4 4QU'}, {'nothing': 'here'}, {'phrase': 'someaddress', 'page_size': 5}]}
+
+    response = app.test_client().post('/search/batch', data=json.dumps(body), content_type='application/json')
+
+    mock_get_addresses_for_queries.assert_called_once_with([
+        ('postcode', 'EX4 4QU', PAGE_NUMBER, PAGE_SIZE),
+        ('phrase', 'someaddress', PAGE_NUMBER, 5),
+    ])
+    json_body = json.loads(response.data.decode())
+    assert json_body['results'] == [
+        EXPECTED_RESPONSE,
+        {'errors': 'No parameters provided for searching'},
+        {'errors': 'Search failed'},
+    ]
+
+
+def test_batch_search_without_queries_is_rejected():
+    response = app.test_client().post('/search/batch', data='{}', content_type='application/json')
+
+    assert response.status_code == 400
+
+
+def test_batch_queries_are_sent_as_chunked_multi_searches():
+    mock_client = mock.Mock()
+    mock_client.msearch.side_effect = lambda body, **kwargs: {
+        'responses': [{'hits': {'hits': [], 'total': 0}} for _ in range(len(body) // 2)]
+    }
+    queries = [('postcode', 'EX4 4QU', 0, 20)] * 3 + [('phrase', 'someaddress', 0, 20)] * 2
+
+    with mock.patch.object(es_access, 'get_client', return_value=mock_client), \
+            mock.patch.object(es_access, 'MSEARCH_CHUNK_SIZE', 2):
+        results = es_access.get_addresses_for_queries(queries)
+
+    assert mock_client.msearch.call_count == 3
+    assert [error for _, error in results] == [None] * 5
+    assert all(hits.total == 0 for hits, _ in results)
+
+
+def test_search_hits_are_read_from_the_raw_response():
+    mock_client = mock.Mock()
+    mock_client.search.return_value = {'hits': {'total': 1, 'hits': [_get_es_postcode_result(1)]}}
+
+    with mock.patch.object(es_access, 'get_client', return_value=mock_client):
+        address_records = es_access.get_addresses_for_postcode('EX4 4QU', 0, 20)
+
+    assert address_records.total == 1
+    assert address_records.hits == [_get_es_postcode_result(1)]
+    search_kwargs = mock_client.search.call_args[1]
+    assert search_kwargs['params'] == {'filter_path': 'took,hits.total,hits.hits._source'}
+    assert search_kwargs['body']['_source'] == es_access.ADDRESS_FIELDS
+
+
+def test_search_with_no_hits_has_no_addresses():
+    mock_client = mock.Mock()
+    mock_client.search.return_value = {'hits': {'total': 0}}
+
+    with mock.patch.object(es_access, 'get_client', return_value=mock_client):
+        address_records = es_access.get_addresses_for_phrase('nowhere', 0, 20)
+
+    assert address_records == es_access.AddressHits([], 0)
+
+
+def _get_esearch_results_with_sort(*house_numbers, total=None):
+    results = _get_esearch_results(*house_numbers, total=total)
+    for hit in results.hits:
+        hit['sort'] = ['GLENTHORNE ROAD', None, int(hit['_source']['building_number']), 'THE CYPRESS HOUSE', None,
+                       'address#10023118807']
+    return results
+
+
+@mock.patch.object(es_access, 'get_addresses_after', return_value=_get_esearch_results_with_sort(1, 2, total=5))
+def test_cursor_search_returns_next_cursor(mock_get_addresses_after):
+    response = app.test_client().get('/search?postcode=EX4 4QU&page_size=2&cursor=')
+
+    mock_get_addresses_after.assert_called_once_with('postcode', 'EX4 4QU', None, 2, None)
+    data = json.loads(response.data.decode())['data']
+    assert data['addresses'] == EXPECTED_RESPONSE['data']['addresses']
+    assert data['remaining'] == 5
+
+    app.test_client().get('/search?postcode=EX4 4QU&page_size=2&cursor={}'.format(data['next_cursor']))
+
+    assert mock_get_addresses_after.call_args[0][2] == [
+        'GLENTHORNE ROAD', None, 2, 'THE CYPRESS HOUSE', None, 'address#10023118807',
+    ]
+
+
+@mock.patch.object(es_access, 'get_addresses_after', return_value=_get_esearch_results_with_sort(1))
+def test_cursor_search_has_no_next_cursor_on_last_page(mock_get_addresses_after):
+    response = app.test_client().get('/search?phrase=someaddress&page_size=2&cursor=')
+
+    assert json.loads(response.data.decode())['data']['next_cursor'] is None
+
+
+def test_invalid_cursor_is_rejected():
+    response = app.test_client().get('/search?phrase=someaddress&cursor=notacursor')
+
+    assert response.status_code == 400
+
+
+def test_after_filter_skips_missing_values():
+    after_filter = es_access._after_filter(['thoroughfare_name', 'building_number', '_uid'],
+                                           ['GLENTHORNE ROAD', 2 ** 31 - 1, 'address#1'])
+
+    assert after_filter == {'or': [
+        {'or': [{'range': {'thoroughfare_name': {'gt': 'GLENTHORNE ROAD'}}}, {'missing': {'field': 'thoroughfare_name'}}]},
+        {'and': [
+            {'term': {'thoroughfare_name': 'GLENTHORNE ROAD'}},
+            {'missing': {'field': 'building_number'}},
+            {'or': [{'range': {'_uid': {'gt': 'address#1'}}}, {'missing': {'field': '_uid'}}]},
+        ]},
+    ]}
+
+
+@mock.patch.object(es_access, 'get_addresses_for_postcode', return_value=_get_esearch_results(1, 2))
+def test_search_results_with_label_fields(mock_es_access):
+    response = app.test_client().get('/search?postcode=EX4 4QU&fields=label')
+
+    mock_es_access.assert_called_once_with('EX4 4QU', PAGE_NUMBER, PAGE_SIZE, fields=['uprn', 'joined_fields'])
+    addresses = json.loads(response.data.decode())['data']['addresses']
+    assert addresses == [
+        {'uprn': '10023118807', 'joined_fields': '1 THE CYPRESS HOUSE, GLENTHORNE ROAD, EXETER, EX4 4QU'},
+        {'uprn': '10023118807', 'joined_fields': '2 THE CYPRESS HOUSE, GLENTHORNE ROAD, EXETER, EX4 4QU'},
+    ]
+
+
+@mock.patch.object(es_access, 'get_addresses_for_phrase', return_value=_get_esearch_results(1))
+def test_search_results_with_listed_fields(mock_es_access):
+    response = app.test_client().get('/search?phrase=someaddress&fields=uprn,postcode')
+
+    mock_es_access.assert_called_once_with('someaddress', PAGE_NUMBER, PAGE_SIZE, fields=['uprn', 'postcode'])
+    assert json.loads(response.data.decode())['data']['addresses'] == [{'uprn': '10023118807', 'postcode': 'EX4 4QU'}]
+
+
+def test_search_with_unknown_fields_is_rejected():
+    response = app.test_client().get('/search?phrase=someaddress&fields=uprn,shoe_size')
+
+    assert response.status_code == 400
+    assert json.loads(response.data.decode()) == {'errors': 'Unknown fields: shoe_size'}
+
+
+def test_suggest_returns_completion_suggester_options():
+    mock_client = mock.Mock()
+    mock_client.suggest.return_value = {'address': [{'text': 'glenth', 'offset': 0, 'length': 6, 'options': [
+        {'text': '1 GLENTHORNE ROAD, EXETER, EX4 4QU', 'score': 1.0, 'payload': {'uprn': '10023118807'}},
+    ]}]}
+
+    with mock.patch.object(es_access, 'get_client', return_value=mock_client):
+        response = app.test_client().get('/suggest?prefix=glenth')
+
+    assert response.status_code == 200
+    assert json.loads(response.data.decode()) == {
+        'suggestions': [{'uprn': '10023118807', 'address': '1 GLENTHORNE ROAD, EXETER, EX4 4QU'}],
+    }
+    body = mock_client.suggest.call_args[1]['body']
+    assert body == {'address': {'text': 'glenth', 'completion': {'field': 'suggest', 'size': server.SUGGEST_SIZE}}}
+
+
+@mock.patch.object(es_access, 'get_suggestions')
+def test_suggest_needs_a_prefix(mock_get_suggestions):
+    assert app.test_client().get('/suggest').status_code == 400
+    response = app.test_client().get('/suggest?prefix=g')
+
+    assert json.loads(response.data.decode()) == {'suggestions': []}
+    mock_get_suggestions.assert_not_called()
+
+
+def test_near_search_filters_and_sorts_by_distance():
+    mock_client = mock.Mock()
+    mock_client.search.return_value = {'hits': {'total': 1, 'hits': [_get_es_postcode_result(1)]}}
+
+    with mock.patch.object(es_access, 'get_client', return_value=mock_client):
+        response = app.test_client().get('/search?near=651409.903,313177.270&radius=250')
+
+    assert response.status_code == 200
+    assert json.loads(response.data.decode())['data']['total'] == 1
+    body = json.dumps(mock_client.search.call_args[1]['body'])
+    assert '"geo_distance": {"distance": "250.0m", "optimize_bbox": "indexed", "location": {"lat": 52.657570' in body
+    assert '"_geo_distance": {"location": {"lat": 52.657570' in body
+
+
+@mock.patch.object(es_access, 'get_addresses_near', return_value=_get_esearch_results(1))
+def test_near_search_has_a_default_radius(mock_get_addresses_near):
+    app.test_client().get('/search?near=651409,313177&page_size=5')
+
+    mock_get_addresses_near.assert_called_once_with(651409.0, 313177.0, 100.0, PAGE_NUMBER, 5, fields=None)
+
+
+@mock.patch.object(es_access, 'get_addresses_near')
+def test_invalid_near_search_is_rejected(mock_get_addresses_near):
+    for query in ['near=651409', 'near=a,b', 'near=651409,313177&radius=0', 'near=651409,313177&radius=nan',
+                  'near=651409,313177&radius={}'.format(server.MAX_NEAR_RADIUS_METRES + 1),
+                  'near=651409,313177&cursor=']:
+        assert app.test_client().get('/search?' + query).status_code == 400
+
+    mock_get_addresses_near.assert_not_called()
+
+
+def test_search_timings_are_reported_by_metrics():
+    mock_client = mock.Mock()
+    mock_client.search.return_value = {'took': 3, 'hits': {'total': 1, 'hits': [_get_es_postcode_result(1)]}}
+
+    with mock.patch.object(es_access, 'get_client', return_value=mock_client), \
+            mock.patch.object(server, 'METRICS', server.metrics.MetricsStore()):
+        app.test_client().get('/search?phrase=glenthorne&page_size=15')
+        response = app.test_client().get('/metrics')
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    lines = response.data.decode().splitlines()
+    assert 'address_search_request_duration_seconds_count{kind="phrase",page_size="20"} 1' in lines
+    assert 'address_search_stage_duration_seconds_sum{kind="phrase",stage="elasticsearch"} 0.003' in lines
+    for stage in ['query_build', 'transport', 'backend', 'shaping', 'encoding']:
+        assert 'address_search_stage_duration_seconds_count{{kind="phrase",stage="{}"}} 1'.format(stage) in lines
+
+
+def test_slow_searches_are_logged_with_their_queries():
+    mock_client = mock.Mock()
+    mock_client.search.return_value = {'took': 3, 'hits': {'total': 0}}
+
+    with mock.patch.object(es_access, 'get_client', return_value=mock_client), \
+            mock.patch.object(server, 'SLOW_QUERY_LOG_THRESHOLD_SECONDS', 0.000001), \
+            mock.patch.object(server, 'SLOW_QUERY_LOGGER') as mock_logger:
+        app.test_client().get('/search?postcode=EX4 4QU')
+
+    logged = json.loads(mock_logger.warning.call_args[0][0][len('Slow search: '):])
+    assert logged['request'] == '/search?postcode=EX4 4QU'
+    assert logged['queries'] == [mock_client.search.call_args[1]['body']]
+    assert set(logged['stages_ms']) == {'query_build', 'elasticsearch', 'transport', 'backend', 'shaping', 'encoding'}
+
+
+def test_identical_concurrent_searches_share_one_backend_call():
+    release = threading.Event()
+    calls = []
+
+    def slow_search(*args, **kwargs):
+        calls.append(args)
+        release.wait()
+        return _get_esearch_results(1, 2)
+
+    responses = []
+
+    def client_request():
+        responses.append(app.test_client().get('/search?postcode=ex4 4qu'))
+
+    in_flight_searches = SingleFlight()
+    with mock.patch.object(es_access, 'get_addresses_for_postcode', side_effect=slow_search), \
+            mock.patch.object(server, 'METRICS', server.metrics.MetricsStore()), \
+            mock.patch.object(server, 'IN_FLIGHT_SEARCHES', in_flight_searches):
+        threads = [threading.Thread(target=client_request) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        # finish the search once the other requests are waiting for it
+        deadline = time.monotonic() + 5
+        while in_flight_searches.coalesced < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        waiting = in_flight_searches.coalesced
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        assert waiting == 3
+        assert not any(thread.is_alive() for thread in threads)
+        metrics_lines = app.test_client().get('/metrics').data.decode().splitlines()
+
+    assert len(calls) == 1
+    assert [json.loads(response.data.decode()) for response in responses] == [EXPECTED_RESPONSE] * 4
+    assert 'address_search_coalesced_requests_total{kind="postcode"} 3' in metrics_lines
+
+
+@mock.patch.object(es_access, 'get_addresses_for_postcode', return_value=_get_esearch_results(1, 2))
+def test_search_results_are_gzipped_when_accepted(mock_es_access):
+    response = app.test_client().get('/search?postcode=EX4 4QU', headers={'Accept-Encoding': 'gzip'})
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert response.headers['Cache-Control'] == 'public, no-cache'
+    assert response.headers['ETag'].endswith('-gzip"')
+    assert json.loads(gzip.decompress(response.data).decode()) == EXPECTED_RESPONSE
+
+
+@mock.patch.object(es_access, 'get_addresses_for_postcode', return_value=_get_esearch_results(1, 2))
+def test_search_results_prefer_brotli(mock_es_access):
+    mock_brotli = mock.Mock()
+    mock_brotli.compress.side_effect = lambda data, quality: b'br:' + data
+    with mock.patch.object(server, 'brotli', mock_brotli):
+        response = app.test_client().get('/search?postcode=EX4 4QU', headers={'Accept-Encoding': 'gzip, br'})
+
+    assert response.headers['Content-Encoding'] == 'br'
+    assert response.headers['ETag'].endswith('-br"')
+    assert json.loads(response.data[len(b'br:'):].decode()) == EXPECTED_RESPONSE
+
+
+@mock.patch.object(es_access, 'get_addresses_for_postcode', return_value=_get_esearch_results())
+def test_small_search_results_are_not_compressed(mock_es_access):
+    response = app.test_client().get('/search?postcode=EX4 4QU', headers={'Accept-Encoding': 'gzip'})
+
+    assert len(response.data) < server.COMPRESSION_MIN_BYTES
+    assert 'Content-Encoding' not in response.headers
+    assert json.loads(response.data.decode())['data']['addresses'] == []
+
+
+@mock.patch.object(es_access, 'get_addresses_for_postcode', return_value=_get_esearch_results(1, 2))
+def test_search_with_a_matching_etag_is_not_modified(mock_es_access):
+    first = app.test_client().get('/search?postcode=EX4 4QU', headers={'Accept-Encoding': 'gzip'})
+    # a CDN may pass the tag on as a weak one
+    response = app.test_client().get('/search?postcode=EX4 4QU',
+                                     headers={'If-None-Match': 'W/' + first.headers['ETag']})
+
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == first.headers['ETag']
+    assert response.headers['Vary'] == 'Accept-Encoding'
+
+
+@mock.patch.object(es_access, 'get_addresses_for_postcode', return_value=_get_esearch_results(1, 2))
+def test_search_etag_comes_from_the_data_generation_without_searching(mock_es_access):
+    cache = SearchResultCache(10, 60, 60, get_generation=lambda: '1')
+    with mock.patch.object(server, 'SEARCH_CACHE', cache), \
+            mock.patch.object(server, 'SEARCH_RESPONSE_MAX_AGE_SECONDS', 300):
+        first = app.test_client().get('/search?postcode=EX4 4QU')
+        cache.clear()
+        response = app.test_client().get('/search?postcode=EX4 4QU', headers={'If-None-Match': first.headers['ETag']})
+        etag = server._search_etag(server._cache_key('postcode', 'EX4 4QU', PAGE_NUMBER, PAGE_SIZE))
+
+    assert first.headers['ETag'] == '"{}"'.format(etag)
+    assert response.status_code == 304
+    assert response.headers['Cache-Control'] == 'public, max-age=300'
+    assert mock_es_access.call_count == 1
+
+
+@mock.patch.object(es_access, 'get_addresses_for_postcode', return_value=_get_esearch_results(1, 2))
+def test_search_etag_falls_back_to_the_body_when_the_generation_is_unavailable(mock_es_access):
+    cache = SearchResultCache(10, 60, 60, get_generation=lambda: '1')
+    with mock.patch.object(server, 'SEARCH_CACHE', cache), \
+            mock.patch.object(cache, 'generation', side_effect=Exception('connection refused')):
+        response = app.test_client().get('/search?postcode=EX4 4QU')
+
+    assert response.status_code == 200
+    assert response.headers['ETag'] == '"{}"'.format(hashlib.sha1(response.data).hexdigest())
+
+
+def test_only_cursor_searches_tie_break_on_uid():
+    mock_client = mock.Mock()
+    mock_client.search.return_value = {'hits': {'total': 1, 'hits': [_get_es_postcode_result(1)]}}
+
+    with mock.patch.object(es_access, 'get_client', return_value=mock_client):
+        app.test_client().get('/search?postcode=EX4 4QU')
+        app.test_client().get('/search?phrase=glenthorne')
+        app.test_client().get('/search?near=651409.903,313177.270')
+        paged_sorts = [call[1]['body']['sort'] for call in mock_client.search.call_args_list]
+        es_access.get_addresses_after('postcode', 'EX4 4QU', None, 2)
+        cursor_sort = mock_client.search.call_args[1]['body']['sort']
+
+    assert not any('_uid' in json.dumps(sort) for sort in paged_sorts)
+    assert cursor_sort[-1] == {'_uid': {'order': 'asc'}}
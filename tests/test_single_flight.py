@@ -0,0 +1,81 @@
+import threading
+import time
+
+import pytest
+
+from service.single_flight import SingleFlight
+
+WAIT_SECONDS = 5
+
+
+def _run_concurrently(single_flight, key, function, release, number_of_callers):
+    """Holds the first call until the other callers are waiting for it, and returns what each got"""
+    results = [None] * number_of_callers
+
+    def caller(position):
+        try:
+            results[position] = single_flight.run(key, function)
+        except Exception as e:
+            results[position] = e
+
+    threads = [threading.Thread(target=caller, args=(position,)) for position in range(number_of_callers)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + WAIT_SECONDS
+    while single_flight.coalesced < number_of_callers - 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # let the callers finish either way, so a failure doesn't leave them waiting
+    waiting = single_flight.coalesced
+    release.set()
+    for thread in threads:
+        thread.join(WAIT_SECONDS)
+    assert waiting == number_of_callers - 1
+    assert not any(thread.is_alive() for thread in threads)
+    return results
+
+
+def _held_call(release, result=None, error=None):
+    calls = []
+
+    def function():
+        calls.append(1)
+        release.wait()
+        if error is not None:
+            raise error
+        return result
+
+    return function, calls
+
+
+def test_concurrent_calls_for_a_key_share_one_result():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    function, calls = _held_call(release, result={'total': 1})
+
+    results = _run_concurrently(single_flight, ('postcode', 'EX4 4QU'), function, release, 5)
+
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+    assert all(result == {'total': 1} for result, _ in results)
+    assert (single_flight.calls, single_flight.coalesced) == (1, 4)
+
+
+def test_waiting_callers_get_the_calls_exception():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    function, calls = _held_call(release, error=ValueError('elasticsearch is down'))
+
+    results = _run_concurrently(single_flight, 'key', function, release, 3)
+
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_calls_are_not_remembered_once_done():
+    single_flight = SingleFlight()
+
+    assert single_flight.run('key', lambda: 1) == (1, False)
+    assert single_flight.run('key', lambda: 2) == (2, False)
+    with pytest.raises(KeyError):
+        single_flight.run('other', lambda: {}['missing'])
+    assert single_flight.run('other', lambda: 3) == (3, False)
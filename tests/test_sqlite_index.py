@@ -0,0 +1,132 @@
+import os
+import tempfile
+
+from import_addressbase.importing import POSTCODE_SORT_FIELDS, make_sort_key_string
+from import_addressbase.sqlite_index import SqliteIndexReader, SqliteIndexWriter
+
+
+def _make_action(uprn, postcode, thoroughfare_name, building_number, op_type='index'):
+    doc = {
+        'uprn': uprn,
+        'postcode': postcode,
+        'thoroughfare_name': thoroughfare_name,
+        'dependent_thoroughfare_name': '',
+        'building_number': building_number,
+        'building_name': '',
+        'sub_building_name': '',
+        'joined_fields': ', '.join(f for f in [building_number, thoroughfare_name, 'EXETER', postcode] if f),
+    }
+    action = {'_op_type': op_type, '_index': 'address-search-api-index', '_type': 'address', '_id': uprn}
+    if op_type == 'index':
+        action['_source'] = doc
+    elif op_type == 'update':
+        action['doc'] = doc
+    return action
+
+
+def _make_index(actions):
+    path = os.path.join(tempfile.mkdtemp(), 'addresses.db')
+    writer = SqliteIndexWriter(path)
+    results = writer.apply_actions(actions)
+    writer.write_data_generation()
+    writer.close()
+    assert all(succeeded for succeeded, _ in results)
+    return SqliteIndexReader(path)
+
+
+def test_postcode_search_is_ordered_and_paged():
+    reader = _make_index([
+        _make_action('1', 'EX4 4QU', 'GLENTHORNE ROAD', '10'),
+        _make_action('2', 'EX4 4QU', 'GLENTHORNE ROAD', '9'),
+        _make_action('3', 'EX4 4QU', '', '1'),
+        _make_action('4', 'EX4 4QU', 'ALPHA ROAD', ''),
+        _make_action('5', 'PL1 1AA', 'ALPHA ROAD', '1'),
+    ])
+
+    addresses, total = reader.get_addresses_for_postcode('ex4 4qu', 1, 3)
+
+    assert total == 4
+    # the empty street name sorts first, as in elasticsearch: '3', '4', '2', '1'
+    assert [address['uprn'] for address in addresses] == ['4', '2']
+
+
+def test_postcode_search_matches_the_elasticsearch_sort_key_order():
+    actions = [
+        _make_action('1', 'EX4 4QU', 'GLENTHORNE ROAD', ''),
+        _make_action('2', 'EX4 4QU', '', '7'),
+        _make_action('3', 'EX4 4QU', 'GLENTHORNE', '12'),
+        _make_action('4', 'EX4 4QU', 'GLENTHORNE ROAD', '3'),
+        _make_action('5', 'EX4 4QU', '', ''),
+    ]
+    actions[0]['_source']['building_name'] = 'THE CYPRESS HOUSE'
+    actions[4]['_source']['sub_building_name'] = 'FLAT 1'
+    reader = _make_index(actions)
+
+    addresses, _ = reader.get_addresses_for_postcode('EX4 4QU', 0, 10)
+
+    docs = sorted((action['_source'] for action in actions),
+                  key=lambda doc: (make_sort_key_string(doc, POSTCODE_SORT_FIELDS), doc['uprn']))
+    assert [address['uprn'] for address in addresses] == [doc['uprn'] for doc in docs] == ['2', '5', '3', '4', '1']
+
+
+def test_phrase_search_uses_full_text_index():
+    reader = _make_index([
+        _make_action('1', 'EX4 4QU', 'GLENTHORNE ROAD', '1'),
+        _make_action('2', 'EX4 3QG', 'NORTHERNHAY PLACE', '2'),
+    ])
+
+    addresses, total = reader.get_addresses_for_phrase('glenthorne', 0, 20)
+
+    assert total == 1
+    assert addresses[0]['uprn'] == '1'
+
+
+def test_updates_and_deletes_are_applied():
+    reader = _make_index([
+        _make_action('1', 'EX4 4QU', 'GLENTHORNE ROAD', '1'),
+        _make_action('2', 'EX4 4QU', 'GLENTHORNE ROAD', '2'),
+        _make_action('1', 'EX4 3QG', 'NORTHERNHAY PLACE', '1', op_type='update'),
+        _make_action('2', 'EX4 4QU', 'GLENTHORNE ROAD', '2', op_type='delete'),
+    ])
+
+    assert reader.get_addresses_for_postcode('EX4 4QU', 0, 20) == ([], 0)
+    assert reader.get_addresses_for_phrase('glenthorne', 0, 20) == ([], 0)
+    assert reader.get_addresses_for_phrase('northernhay', 0, 20)[1] == 1
+    assert reader.get_data_generation() is not None
+
+
+def test_suggestions_match_the_start_of_words_in_order():
+    reader = _make_index([
+        _make_action('1', 'EX4 4QU', 'GLENTHORNE ROAD', '10'),
+        _make_action('2', 'EX4 4QU', 'GLENTHORNE ROAD', '9'),
+        _make_action('3', 'PL1 1AA', 'ALPHA ROAD', '1'),
+    ])
+
+    assert reader.get_suggestions('glenthorne ro', 5) == [
+        ('1', '10, GLENTHORNE ROAD, EXETER, EX4 4QU'), ('2', '9, GLENTHORNE ROAD, EXETER, EX4 4QU'),
+    ]
+    assert reader.get_suggestions('10 glen', 5) == [('1', '10, GLENTHORNE ROAD, EXETER, EX4 4QU')]
+    assert reader.get_suggestions('road alpha', 5) == []
+    assert reader.get_suggestions('-', 5) == []
+
+
+def _with_coordinates(action, x_coordinate, y_coordinate):
+    action['_source'].update(x_coordinate=x_coordinate, y_coordinate=y_coordinate)
+    return action
+
+
+def test_near_search_orders_by_distance_within_the_radius():
+    reader = _make_index([
+        _with_coordinates(_make_action('1', 'EX4 4QU', 'GLENTHORNE ROAD', '1'), 291000.0, 93030.0),
+        _with_coordinates(_make_action('2', 'EX4 4QU', 'GLENTHORNE ROAD', '2'), 291010.0, 93000.0),
+        # inside the bounding square but not the circle
+        _with_coordinates(_make_action('3', 'EX4 4QU', 'GLENTHORNE ROAD', '3'), 291090.0, 93090.0),
+        _with_coordinates(_make_action('4', 'EX4 3QG', 'NORTHERNHAY PLACE', '4'), 292000.0, 93000.0),
+        _with_coordinates(_make_action('5', 'EX4 3QG', 'NORTHERNHAY PLACE', '5'), 0.0, 0.0),
+    ])
+
+    addresses, total = reader.get_addresses_near(291000.0, 93000.0, 100.0, 0, 20)
+
+    assert total == 2
+    assert [address['uprn'] for address in addresses] == ['2', '1']
+    assert reader.get_addresses_near(291000.0, 93000.0, 100.0, 1, 2) == ([addresses[1]], 2)